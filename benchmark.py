@@ -0,0 +1,173 @@
+"""
+Scaling benchmark of every figure on synthetic data.
+
+For every size, a synthetic dataset of that many SAIR rows is written (or
+reused) under --data-root (see synthetic.py). Each figure then runs in its
+own process, with SAIR_DATA_DIR pointing at the dataset, the draft profile
+and no figure cache, in a scratch directory so the real figs/ and data/
+are left alone. Three stages are timed per figure: load (the session reads
+the parquet files the figure declares, if any), compute (compute_figure_data
+on the loaded session, including building any missing views, cubes or
+bitmaps) and render. Figures that fail, e.g. out of memory, are recorded as
+such and the run goes on.
+
+Every run appends one row per size and figure, tagged with the commit, to
+a CSV, so scaling regressions show up across commits.
+
+    python benchmark.py                              # 1M, 10M and 50M rows
+    python benchmark.py --rows 100000 affinity folder
+    python benchmark.py --repeat 2                   # also time warm runs
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SIZES = [1_000_000, 10_000_000, 50_000_000]
+DATA_ROOT = os.path.join(tempfile.gettempdir(), "sair_synthetic")
+RESULTS = os.path.join(REPO_DIR, "data", "benchmark_scaling.csv")
+STAGES = ["load", "compute", "render"]
+
+
+def time_stages(name):
+    """
+    Seconds spent loading, computing and rendering the figure, and the peak
+    RSS in MB. Runs in the worker process.
+    """
+    from common import Session
+    from instrument import peak_rss_mb
+    from make_plots import load_figures
+
+    figure = load_figures()[name]
+    session = Session()
+    timings = {}
+    start = time.perf_counter()
+    for path, columns, filters in figure.reads():
+        session.plan(path, columns, filters)
+    for path, columns, filters in figure.reads():
+        session.load(path, columns, filters)
+    timings["load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    data = figure.compute(session)
+    timings["compute"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    figure.render(data)
+    timings["render"] = time.perf_counter() - start
+    timings["peak_rss_mb"] = peak_rss_mb()
+    return timings
+
+
+def run_figure(name, data_dir, timeout=None):
+    """
+    Runs time_stages() for the figure in a fresh process on the dataset.
+    """
+    env = dict(
+        os.environ,
+        SAIR_DATA_DIR=data_dir,
+        SAIR_PROFILE="draft",
+        PYTHONPATH=os.pathsep.join([REPO_DIR, os.environ.get("PYTHONPATH", "")]),
+    )
+    with tempfile.TemporaryDirectory(prefix="sair_benchmark_") as scratch:
+        for directory in ["figs", "data"]:
+            os.makedirs(os.path.join(scratch, directory))
+        try:
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", name],
+                cwd=scratch,
+                env=env,
+                capture_output=True,
+                text=True,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return {"status": "timeout"}
+    if result.returncode != 0:
+        error = (result.stderr.strip().splitlines() or ["killed"])[-1]
+        return {"status": f"failed: {error}"}
+    return {"status": "ok", **json.loads(result.stdout.strip().splitlines()[-1])}
+
+
+def git_commit():
+    result = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip() or "unknown"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("figures", nargs="*", help="figure names (default: all)")
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=SIZES, help="dataset sizes"
+    )
+    parser.add_argument(
+        "--data-root", default=DATA_ROOT, help="where the datasets are kept"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="runs per figure and size"
+    )
+    parser.add_argument("--timeout", type=float, help="seconds per figure run")
+    parser.add_argument("--output", default=RESULTS, help="CSV to append to")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(time_stages(args.worker)))
+        sys.exit()
+
+    import pandas as pd
+    from make_plots import load_figures
+    from synthetic import write_dataset
+
+    names = args.figures or list(load_figures())
+    commit = git_commit()
+    rows = []
+    for size in args.rows:
+        start = time.perf_counter()
+        data_dir = write_dataset(os.path.join(args.data_root, str(size)), size)
+        print(f"{size} rows: dataset ready in {time.perf_counter() - start:.1f} s")
+        for name in names:
+            for run in range(args.repeat):
+                result = run_figure(name, data_dir, args.timeout)
+                rows.append(
+                    {"commit": commit, "rows": size, "figure": name, "run": run}
+                    | result
+                )
+                timings = " ".join(
+                    f"{stage} {result[stage]:.1f} s"
+                    for stage in STAGES
+                    if stage in result
+                )
+                print(f"  {name} (run {run + 1}): {timings or result['status']}")
+
+    results = pd.DataFrame(
+        rows,
+        columns=["commit", "rows", "figure", "run"]
+        + STAGES
+        + ["peak_rss_mb", "status"],
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    results.to_csv(
+        args.output,
+        mode="a",
+        header=not os.path.exists(args.output),
+        index=False,
+    )
+    # Best run of every stage, by figure and size
+    summary = (
+        results[results["status"] == "ok"]
+        .groupby(["figure", "rows"], sort=False)[STAGES]
+        .min()
+        .unstack("rows")
+    )
+    print(summary.to_string(float_format="%.1f"))
@@ -0,0 +1,287 @@
+"""
+Bit-packed PoseBusters checks.
+
+CheckBits holds one bitmap per check with a bit set for every row of the
+parquet file failing it, plus one bitmap per check of the rows where it is
+set at all (validity), a bitmap of the rows failing overall (all_passed is
+False), one per value of the slicing columns and one per view. Each bitmap
+packs eight rows per byte, so a slice is the AND of a few bitmaps and a
+count is a popcount over len(rows) / 8 bytes, without touching the rows.
+
+cofailures() gives the check x check matrix of failed structures failing
+both checks, for any slice, which with pandas would be a pass over the rows
+per pair. Its diagonal holds the per-check failure counts, which the
+PoseBusters figure reads from the summary cube (cube.py) instead.
+
+The bitmaps are stored with the views of the source file (see views.py),
+named after a fingerprint of the source and of the checks, and rebuilt when
+either changes.
+
+    python bitsets.py   # checks against pandas and times both
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from cache import file_fingerprint
+from external import BATCH_ROWS, scan
+from instrument import stage
+from views import view_directory, view_rows
+
+SLICE_COLUMNS = ["source", "assay", "family"]
+VIEWS = ["deduplicated"]
+
+LOADED = {}  # bitmaps read in this process, by file
+
+
+def check_columns():
+    # Imported here, plot_posebusters itself reads the bitmaps
+    from plot_posebusters import pb_columns
+
+    return pb_columns
+
+
+def pack(mask):
+    return np.packbits(mask, bitorder="little")
+
+
+# Set bits of every byte value, for numpy < 2, which has no bitwise_count
+BYTE_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(
+    axis=1
+)
+
+
+def popcount(bits):
+    if hasattr(np, "bitwise_count"):
+        return int(np.bitwise_count(bits).sum())
+    return int(BYTE_POPCOUNT[bits].sum())
+
+
+class CheckBits:
+    def __init__(self, checks, failed, valid, all_failed, slices, views, n_rows):
+        self.checks = checks
+        self.failed = failed  # (n_checks, n_bytes), rows failing each check
+        self.valid = valid  # (n_checks, n_bytes), rows where each check is set
+        self.all_failed = all_failed  # rows with all_passed False
+        self.slices = slices  # {(column, value): bitmap}
+        self.views = views  # {view name: bitmap}
+        self.n_rows = n_rows
+
+    def select(self, filters=None, view="deduplicated"):
+        """
+        Bitmap of the rows of the view (default: all rows) passing filters,
+        which may use "==", "!=", "in" and "not in" on SLICE_COLUMNS. As in
+        pyarrow, missing values pass "not in" and nothing else.
+        """
+        bits = self.views[view].copy() if view else pack(np.ones(self.n_rows, bool))
+        for column, op, value in filters or []:
+            if op not in ("==", "=", "!=", "in", "not in"):
+                raise ValueError(f"Unsupported filter on packed checks: {op!r}")
+            values = [value] if op in ("==", "=", "!=") else value
+            matches = np.zeros_like(bits)
+            for v in values:
+                matches |= self.slices.get((column, v), 0)
+            if op == "not in":
+                matches = ~matches
+            elif op == "!=":
+                present = np.zeros_like(bits)
+                for (c, _), slice_bits in self.slices.items():
+                    if c == column:
+                        present |= slice_bits
+                matches = present & ~matches
+            bits &= matches
+        return bits
+
+    def failed_complete(self, bits):
+        # Failing structures with every check set
+        return bits & self.all_failed & np.bitwise_and.reduce(self.valid, axis=0)
+
+    def cofailures(self, checks=None, filters=None, view="deduplicated"):
+        """
+        Counts of failing structures with every check set that fail both
+        checks, for every pair of the checks (default: all). The diagonal
+        holds each check's own count.
+        """
+        checks = checks or self.checks
+        base = self.failed_complete(self.select(filters, view))
+        failed = [base & self.failed[self.checks.index(c)] for c in checks]
+        counts = np.array([[popcount(a & b) for b in failed] for a in failed])
+        return pd.DataFrame(counts, index=checks, columns=checks)
+
+    def save(self, path):
+        slices = list(self.slices)
+        np.savez(
+            path,
+            checks=np.array(self.checks),
+            failed=self.failed,
+            valid=self.valid,
+            all_failed=self.all_failed,
+            slice_columns=np.array([c for c, _ in slices]),
+            slice_values=np.array([v for _, v in slices]),
+            slice_bits=np.array([self.slices[s] for s in slices]),
+            view_names=np.array(list(self.views)),
+            view_bits=np.array(list(self.views.values())),
+            n_rows=self.n_rows,
+        )
+
+    @classmethod
+    def read(cls, path):
+        with np.load(path) as f:
+            return cls(
+                f["checks"].tolist(),
+                f["failed"],
+                f["valid"],
+                f["all_failed"],
+                dict(
+                    zip(
+                        zip(f["slice_columns"].tolist(), f["slice_values"].tolist()),
+                        f["slice_bits"],
+                    )
+                ),
+                dict(zip(f["view_names"].tolist(), f["view_bits"])),
+                int(f["n_rows"]),
+            )
+
+
+class BitWriter:
+    """
+    Packs rows of boolean columns arriving in batches of any length.
+    """
+
+    def __init__(self, n_columns, leading_rows=0):
+        self.parts = []
+        self.pending = np.zeros((n_columns, leading_rows), dtype=bool)
+
+    def add(self, masks):
+        masks = np.concatenate([self.pending, masks], axis=1)
+        whole = masks.shape[1] - masks.shape[1] % 8
+        self.parts.append(np.packbits(masks[:, :whole], axis=1, bitorder="little"))
+        self.pending = masks[:, whole:]
+
+    def bits(self):
+        last = np.packbits(self.pending, axis=1, bitorder="little")
+        return np.concatenate(self.parts + [last], axis=1)
+
+
+@stage("aggregate")
+def build_bits(path, batch_rows=BATCH_ROWS):
+    """
+    Packs the checks, the slicing columns and the views of the parquet file
+    in one streaming pass.
+    """
+    checks = check_columns()
+    failed = BitWriter(len(checks))
+    valid = BitWriter(len(checks))
+    all_failed = BitWriter(1)
+    slices = {}
+    n_rows = 0
+    for batch in scan(path, checks + ["all_passed"] + SLICE_COLUMNS, None, batch_rows):
+        # Missing flags neither fail nor pass, whether None or NA
+        failed.add(batch[checks].eq(False).to_numpy(bool, na_value=False).T)
+        valid.add(batch[checks].notna().values.T)
+        all_failed.add(
+            batch["all_passed"].eq(False).to_numpy(bool, na_value=False)[None]
+        )
+        for column in SLICE_COLUMNS:
+            values = batch[column]
+            for value in values.dropna().unique():
+                if (column, value) not in slices:
+                    # All earlier rows had other values
+                    slices[column, value] = BitWriter(1, leading_rows=n_rows)
+            for (c, value), writer in slices.items():
+                if c == column:
+                    writer.add(values.eq(value).fillna(False).values[None])
+        n_rows += len(batch)
+
+    views = {}
+    for name in VIEWS:
+        mask = np.zeros(n_rows, dtype=bool)
+        mask[view_rows(name, path)] = True
+        views[name] = pack(mask)
+    return CheckBits(
+        checks,
+        failed.bits(),
+        valid.bits(),
+        all_failed.bits()[0],
+        {key: writer.bits()[0] for key, writer in slices.items()},
+        views,
+        n_rows,
+    )
+
+
+def bits_path(path):
+    key = repr([file_fingerprint(path), check_columns(), SLICE_COLUMNS, VIEWS])
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(view_directory(path), f"checks-{digest}.npz")
+
+
+def load_bits(path, rebuild=False):
+    """
+    The packed checks of the parquet file, built if missing or stale.
+    """
+    target = bits_path(path)
+    if target in LOADED and not rebuild:
+        return LOADED[target]
+    if os.path.exists(target) and not rebuild:
+        LOADED[target] = CheckBits.read(target)
+        return LOADED[target]
+
+    bits = build_bits(path)
+    directory = os.path.dirname(target)
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        bits.save(f)
+    os.replace(temporary, target)
+    for entry in os.listdir(directory):
+        stale = os.path.join(directory, entry)
+        if entry.startswith("checks-") and stale != target:
+            os.remove(stale)
+    LOADED[target] = bits
+    return bits
+
+
+if __name__ == "__main__":
+    import time
+
+    from common import PATH_TO_DF
+    from data import filter_mask, read_sair
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--path", default=PATH_TO_DF, help="source parquet file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    bits = load_bits(args.path)
+    print(f"Loaded or built in {time.perf_counter() - start:.1f} s")
+    checks = bits.checks
+    df = read_sair(args.path, checks + ["all_passed"] + SLICE_COLUMNS)
+    df = df.iloc[view_rows("deduplicated", args.path)]
+
+    for filters in [None, [("assay", "==", "biochem")], [("assay", "==", "cell")]]:
+        start = time.perf_counter()
+        subset = df[filter_mask(df, filters)]
+        failed = subset[subset["all_passed"] == False].dropna(subset=checks)
+        pairs = pd.DataFrame(
+            [
+                [((failed[a] == False) & (failed[b] == False)).sum() for b in checks]
+                for a in checks
+            ],
+            index=checks,
+            columns=checks,
+        )
+        pandas_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cofailures = bits.cofailures(filters=filters)
+        bits_time = time.perf_counter() - start
+
+        assert (cofailures.values == pairs.values).all()
+        print(
+            f"{filters or 'all'}: pandas {pandas_time * 1e3:.0f} ms, "
+            f"bits {bits_time * 1e3:.1f} ms"
+        )
@@ -0,0 +1,189 @@
+"""
+On-disk cache of computed figure data, keyed by content.
+
+A figure's key combines a fingerprint of every file it reads (size, mtime
+and, for parquet files, the footer metadata), the columns and filters it
+reads them with, the session options that change results, and the source of
+its compute step: the figure module without its render_figure(), plus every
+module of this repo it depends on. Restyling a figure therefore redraws it
+from cached data, while any change to its inputs or its analysis recomputes.
+
+Entries are pickles in CACHE_DIR. A hit refreshes the entry's mtime, and
+when the cache grows past max_bytes the least recently used entries are
+evicted.
+
+    python cache.py          # list the cached entries
+    python cache.py --clear  # delete them
+"""
+
+import argparse
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import tempfile
+import types
+
+import pyarrow.parquet as pq
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(REPO_DIR, ".cache", "figures")
+MAX_BYTES = 2**30
+
+
+def file_fingerprint(path):
+    if not os.path.exists(path):
+        return (path, None)
+    stat = os.stat(path)
+    fingerprint = [path, stat.st_size, stat.st_mtime_ns]
+    if os.path.isfile(path) and path.endswith(".parquet"):
+        metadata = pq.ParquetFile(path).metadata.to_dict()
+        fingerprint.append(hashlib.sha256(repr(metadata).encode()).hexdigest())
+    return tuple(fingerprint)
+
+
+def repo_dependencies(module):
+    """
+    The module and every module of this repo it imports from, transitively.
+    """
+    seen = {}
+    stack = [module]
+    while stack:
+        current = stack.pop()
+        if current.__name__ in seen:
+            continue
+        seen[current.__name__] = current
+        for value in vars(current).values():
+            dependency = (
+                value
+                if isinstance(value, types.ModuleType)
+                else inspect.getmodule(value)
+            )
+            path = getattr(dependency, "__file__", None)
+            if path and os.path.dirname(os.path.abspath(path)) == REPO_DIR:
+                stack.append(dependency)
+    return [seen[name] for name in sorted(seen)]
+
+
+def source_fingerprint(module):
+    sources = []
+    for dependency in repo_dependencies(module):
+        source = inspect.getsource(dependency)
+        render = getattr(dependency, "render_figure", None)
+        if render is not None and inspect.getmodule(render) is dependency:
+            # Drawing code does not change the computed data
+            source = source.replace(inspect.getsource(render), "")
+        sources.append((dependency.__name__, source))
+    return sources
+
+
+class FigureCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, figure, session):
+        parts = [
+            figure.name,
+            [
+                (file_fingerprint(path), columns, filters)
+                for path, columns, filters in figure.reads()
+            ],
+            [file_fingerprint(path) for path in figure.inputs],
+            session.memory_budget,
+            session.approximate,
+            session.resample,
+            source_fingerprint(sys.modules[figure.compute.__module__]),
+        ]
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def compute(self, figure, session):
+        """
+        figure.compute(session), or its cached result. Returns the data and
+        whether it came from the cache.
+        """
+        path = os.path.join(
+            self.directory, f"{figure.name}-{self.key(figure, session)}.pkl"
+        )
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+            os.utime(path)
+            self.hits += 1
+            return data, True
+        except FileNotFoundError:
+            pass  # not cached, or evicted by a concurrent process
+
+        data = figure.compute(session)
+        self.misses += 1
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+        self.evict(keep=path)
+        return data, False
+
+    def entries(self):
+        """
+        (path, size, last use) of every entry, least recently used first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pkl"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue  # evicted by a concurrent process
+                entries.append(
+                    (os.path.join(self.directory, name), stat.st_size, stat.st_mtime)
+                )
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                remove(path)
+                total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            remove(path)
+
+
+def remove(path):
+    # Concurrent processes may evict the same entry
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+if __name__ == "__main__":
+    import time
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clear", action="store_true", help="delete every entry")
+    args = parser.parse_args()
+
+    cache = FigureCache()
+    if args.clear:
+        cache.clear()
+    for path, size, last_use in cache.entries():
+        print(
+            f"{os.path.basename(path):<84}{size / 1e6:>10.1f} MB  "
+            f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(last_use))}"
+        )
+    print(f"Total: {cache.size() / 1e6:.1f} MB of {cache.max_bytes / 1e6:.0f} MB")
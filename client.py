@@ -0,0 +1,141 @@
+"""
+Thin client of the local analysis server (see server.py).
+
+Only the standard library is imported, so a request costs neither the
+parquet load nor the pandas and matplotlib imports. The server address is
+read from SAIR_SERVER, e.g. http://127.0.0.1:8765 (the default) or
+unix:/tmp/sair.sock.
+
+    python client.py table affinity assay=cell "where=confidence_score>0.8"
+    python client.py table potency source=ChEMBL --format png -o potency.png
+    python client.py figure folder -o folder.png
+    python client.py run affinity folder   # writes each figure's outputs here
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import socket
+import sys
+from urllib.parse import urlencode, urlsplit
+
+DEFAULT_PORT = 8765
+DEFAULT_ADDRESS = f"http://127.0.0.1:{DEFAULT_PORT}"
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def connection(address=None, timeout=None):
+    address = address or os.environ.get("SAIR_SERVER", DEFAULT_ADDRESS)
+    if address.startswith("unix:"):
+        return UnixHTTPConnection(address[len("unix:") :], timeout=timeout)
+    parts = urlsplit(address)
+    return http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+
+
+def request(path, query=None, address=None, timeout=None):
+    """
+    The body of GET path?query, raising RuntimeError with the server's
+    message on errors.
+    """
+    if query:
+        path = f"{path}?{urlencode(query)}"
+    conn = connection(address, timeout)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        body = response.read()
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"{response.status} {path}: {body.decode().strip()}")
+    return body
+
+
+def table(name, filters=(), address=None, **values):
+    """
+    The analysis as a dict with "columns" and "data" (a list of rows), on
+    the slice given by column=value keywords and where filters such as
+    "confidence_score>0.8".
+    """
+    query = list(values.items()) + [("where", f) for f in filters]
+    return json.loads(request(f"/table/{name}", query, address))
+
+
+def run(names, address=None):
+    """
+    Writes the output files of the figures as the server renders them,
+    relative to the current directory, and returns their paths.
+    """
+    written = []
+    for name in names:
+        outputs = json.loads(request(f"/run/{name}", address=address))
+        for path, content in outputs.items():
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(base64.b64decode(content))
+            written.append(path)
+    return written
+
+
+def parse_slice(arguments):
+    # column=value arguments, with "where" repeatable
+    query = []
+    for argument in arguments:
+        key, _, value = argument.partition("=")
+        query.append((key, value))
+    return query
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--address", help="server address (default: SAIR_SERVER)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    table_parser = commands.add_parser("table", help="an analysis table")
+    table_parser.add_argument("name", help="analysis name")
+    table_parser.add_argument("slice", nargs="*", help="column=value or where=...")
+    table_parser.add_argument(
+        "--format", default="csv", choices=["json", "csv", "png", "svg"]
+    )
+    table_parser.add_argument("-o", "--output", help="file to write (default: stdout)")
+    figure_parser = commands.add_parser("figure", help="a rendered figure")
+    figure_parser.add_argument("name", help="figure name")
+    figure_parser.add_argument("--format", default="png", choices=["png", "svg"])
+    figure_parser.add_argument("-o", "--output", required=True, help="file to write")
+    run_parser = commands.add_parser("run", help="every output of figures")
+    run_parser.add_argument("names", nargs="+", help="figure names")
+    commands.add_parser("list", help="the analyses and figures served")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "table":
+            query = parse_slice(args.slice) + [("format", args.format)]
+            body = request(f"/table/{args.name}", query, args.address)
+        elif args.command == "figure":
+            query = [("format", args.format)]
+            body = request(f"/figure/{args.name}", query, args.address)
+        elif args.command == "run":
+            for path in run(args.names, args.address):
+                print(f"Wrote {path}")
+            sys.exit()
+        else:
+            body = request("/", address=args.address)
+    except (RuntimeError, OSError) as error:
+        sys.exit(f"client.py: {error}")
+
+    if getattr(args, "output", None):
+        with open(args.output, "wb") as f:
+            f.write(body)
+    else:
+        sys.stdout.buffer.write(body)
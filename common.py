@@ -1 +1,146 @@
-PATH_TO_DF = "/scratch/buckets/sb-alg-dgx-2q25/pablo/final_dfs/sair_v1.parquet"
+import os
+from dataclasses import dataclass, field
+from typing import Callable
+
+from data import filter_mask, merge_requests, read_sair, same_filters
+from instrument import stage
+from views import read_view, view_rows
+
+# Reads every input file from this directory instead, by file name, e.g.
+# the synthetic data of synthetic.py
+DATA_DIR = os.environ.get("SAIR_DATA_DIR")
+
+
+def data_path(path):
+    """
+    The input file at path, or the file of the same name in SAIR_DATA_DIR.
+    """
+    return os.path.join(DATA_DIR, os.path.basename(path)) if DATA_DIR else path
+
+
+PATH_TO_DF = data_path(
+    "/scratch/buckets/sb-alg-dgx-2q25/pablo/final_dfs/sair_v1.parquet"
+)
+TARGET_COLUMN = "input_receptor"  # protein sequence, identifies the target
+# Processes of the figures that parallelise internally, SAIR_N_JOBS lets a
+# parallel runner lower it
+N_JOBS = int(os.environ.get("SAIR_N_JOBS", os.cpu_count()))
+
+
+@dataclass
+class Figure:
+    name: str
+    compute: Callable  # compute(session) -> data needed to draw the figure
+    render: Callable  # render(data) -> draws and saves the figure
+    path: str = None  # parquet file read through the session, if any
+    columns: list = None  # None reads every column
+    filters: list = field(default_factory=list)
+    # Other (path, columns, filters) reads, for figures using several files
+    extra_reads: list = field(default_factory=list)
+    # Other files read directly (CSV, text), fingerprinted by the cache
+    inputs: list = field(default_factory=list)
+    # Files written by render, relative to the repo root
+    outputs: list = field(default_factory=list)
+
+    def reads(self):
+        main = [(self.path, self.columns, self.filters)] if self.path else []
+        return main + self.extra_reads
+
+
+FIGURES = {}
+
+
+def register_figure(
+    name,
+    compute,
+    render,
+    path=None,
+    columns=None,
+    filters=None,
+    extra_reads=None,
+    inputs=None,
+    outputs=None,
+):
+    FIGURES[name] = Figure(
+        name=name,
+        compute=compute,
+        render=render,
+        path=path,
+        columns=columns,
+        filters=filters or [],
+        extra_reads=extra_reads or [],
+        inputs=inputs or [],
+        outputs=outputs or [],
+    )
+
+
+class Session:
+    """
+    Holds the datasets loaded during a run so every figure shares one copy.
+    Figures must treat the returned frames as read-only.
+
+    Calling plan() for every figure before the first load() lets the session
+    read each file once with the union of the columns the figures need.
+
+    load(view=name) returns the rows of a materialized view (see views.py),
+    taken from the shared frame when the file is planned without filters.
+
+    With a memory_budget (bytes), figures that support it stream the files
+    out of core instead of loading them (see external.py). With approximate,
+    they compute from sketches and samples of the files instead (see
+    sketches.py). Bootstrap intervals and permutation tests (see
+    resampling.py) cost far more than the metrics, so figures only add them
+    with resample. Figures that parallelise internally use n_jobs processes
+    (default N_JOBS).
+    """
+
+    def __init__(
+        self, memory_budget=None, approximate=False, resample=False, n_jobs=None
+    ):
+        self.memory_budget = memory_budget
+        self.approximate = approximate
+        self.resample = resample
+        self.n_jobs = n_jobs or N_JOBS
+        self._frames = {}
+        self._requests = {}
+
+    def plan(self, path, columns=None, filters=None):
+        self._requests.setdefault(path, []).append((columns, filters))
+
+    def load(self, path=PATH_TO_DF, columns=None, filters=None, view=None):
+        if view is not None:
+            return self._load_view(path, columns, filters, view)
+        if path not in self._frames:
+            requests = self._requests.get(path) or [(columns, filters)]
+            read_columns, read_filters = merge_requests(requests)
+            df = read_sair(path, read_columns, read_filters)
+            self._frames[path] = (df, read_columns, read_filters)
+        df, read_columns, read_filters = self._frames[path]
+
+        has_columns = read_columns is None or (
+            columns is not None and set(columns) <= set(read_columns)
+        )
+        has_rows = not read_filters or same_filters(read_filters, filters)
+        if not (has_columns and has_rows):
+            # Not covered by the plan, so read it on its own
+            return read_sair(path, columns, filters)
+
+        if filters and not read_filters:
+            df = df[filter_mask(df, filters)]
+        if columns is not None:
+            df = df[columns]
+        return df
+
+    def _load_view(self, path, columns, filters, view):
+        requests = self._requests.get(path)
+        if requests and not merge_requests(requests)[1]:
+            # The shared frame holds every row of the file, in file order
+            df = self.load(path, columns)
+            with stage("view") as s:
+                df = df.iloc[view_rows(view, path)]
+                s.rows = len(df)
+        else:
+            df = read_view(view, path, columns)
+        if filters:
+            df = df[filter_mask(df, filters)]
+        return df
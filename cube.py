@@ -0,0 +1,367 @@
+"""
+Pre-aggregated summary cube for the count-based figures.
+
+One pass over the parquet file, spread over its row groups on a process
+pool (see mapreduce.py), aggregates for every cell of
+(source, assay, family, confidence bucket):
+
+    rows, first_row         all rows, and the first row number of the cell
+    entries, pIC50_*        one row per entry_id (the unique_entries view):
+                            the count, min, max, a histogram of pIC50 on
+                            POTENCY_EDGES, and the values below and above
+                            its range, which the histogram leaves out
+    structures, failed, ... one row per (entry_id, index) (the deduplicated
+                            view): the PoseBusters structures, those failing,
+                            those failing with every check set, and for each
+                            check how many of the latter fail it
+
+Every measure is a sum, min or max, so SummaryCube.rollup() adds the cells
+up to any slice on those dimensions, e.g. per family, without rescanning.
+Confidence buckets are labelled by their lower edge, so
+("confidence_bucket", ">=", 0.8) keeps confidence_score >= 0.8.
+
+The cube is a small parquet file stored with the views of the source file
+(see views.py), named after a fingerprint of the source and of the cube
+definition, and rebuilt when either changes.
+
+Building it needs the row numbers of the views. count_rows() counts rows
+per cell without them, in constant memory, for the approximate mode.
+
+    python cube.py                       # build, and time a few roll-ups
+    python cube.py --by family assay     # print one roll-up
+"""
+
+import argparse
+import hashlib
+import math
+import os
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+from cache import file_fingerprint
+from data import filter_mask
+from external import BATCH_ROWS
+from instrument import stage
+from mapreduce import map_reduce
+from views import view_directory, view_rows
+
+DIMENSIONS = ["source", "assay", "family", "confidence_bucket"]
+CONFIDENCE_BUCKETS = 10  # equal-width buckets of confidence_score in [0, 1]
+# 0.05 wide, so re-binning to a figure's bins moves a value by at most 0.025
+POTENCY_EDGES = np.linspace(0, 16, 321)
+BIN_COLUMNS = [f"pIC50_bin_{i}" for i in range(len(POTENCY_EDGES) - 1)]
+OUT_OF_RANGE_COLUMNS = ["pIC50_below", "pIC50_above"]
+
+LOADED = {}  # cubes read in this process, by file
+
+
+def check_columns():
+    # Imported here, plot_posebusters itself reads the cube
+    from plot_posebusters import pb_columns
+
+    return pb_columns
+
+
+def failure_columns():
+    return [f"{check}_failures" for check in check_columns()]
+
+
+def sum_columns():
+    counts = ["rows", "entries", "structures", "failed", "failed_complete"]
+    return counts + failure_columns() + BIN_COLUMNS + OUT_OF_RANGE_COLUMNS
+
+
+MIN_COLUMNS = ["first_row", "pIC50_min"]
+MAX_COLUMNS = ["pIC50_max"]
+
+
+def aggregate(frame, **groupby):
+    """
+    Adds up the measures present in frame over groups of cells or rows.
+    """
+    grouped = frame.groupby(dropna=False, **groupby)
+
+    def present(columns):
+        return [column for column in columns if column in frame.columns]
+
+    return pd.concat(
+        [
+            grouped[present(sum_columns())].sum(),
+            grouped[present(MIN_COLUMNS)].min(),
+            grouped[present(MAX_COLUMNS)].max(),
+        ],
+        axis=1,
+    )
+
+
+def confidence_buckets(confidence):
+    bucket = np.clip(
+        np.floor(confidence * CONFIDENCE_BUCKETS), 0, CONFIDENCE_BUCKETS - 1
+    )
+    return bucket / CONFIDENCE_BUCKETS
+
+
+def in_rows(rows, start, stop):
+    """
+    Mask of the rows start..stop-1 that appear in the sorted row numbers.
+    """
+    mask = np.zeros(stop - start, dtype=bool)
+    inside = rows[np.searchsorted(rows, start) : np.searchsorted(rows, stop)]
+    mask[inside - start] = True
+    return mask
+
+
+def structure_measures(batch, structure):
+    """
+    The PoseBusters measures of every row of batch, counting the rows of
+    the structure mask.
+    """
+    checks = check_columns()
+    # Missing flags fail no check, and leave all_passed neither true nor false
+    failed = structure & batch["all_passed"].eq(False).to_numpy(bool, na_value=False)
+    complete = failed & batch[checks].notna().all(axis=1).values
+    measures = {
+        "structures": structure.astype(np.int64),
+        "failed": failed.astype(np.int64),
+        "failed_complete": complete.astype(np.int64),
+    }
+    for check, column in zip(checks, failure_columns()):
+        failing = batch[check].eq(False).to_numpy(bool, na_value=False)
+        measures[column] = (complete & failing).astype(np.int64)
+    return measures
+
+
+def aggregate_batch(batch, start, entry_rows, structure_rows):
+    stop = start + len(batch)
+    row = np.arange(start, stop)
+    entry = in_rows(entry_rows, start, stop)
+    structure = in_rows(structure_rows, start, stop)
+    potency = batch["pIC50"].values.astype(np.float64)
+    measured = entry & ~np.isnan(potency)
+    below = measured & (potency < POTENCY_EDGES[0])
+    above = measured & (potency > POTENCY_EDGES[-1])
+
+    measures = {
+        "rows": np.ones(len(batch), dtype=np.int64),
+        "first_row": row,
+        "entries": entry.astype(np.int64),
+        "pIC50_min": np.where(measured, potency, np.inf),
+        "pIC50_max": np.where(measured, potency, -np.inf),
+        "pIC50_below": below.astype(np.int64),
+        "pIC50_above": above.astype(np.int64),
+        **structure_measures(batch, structure),
+    }
+    frame = pd.DataFrame(measures)
+    for column in DIMENSIONS[:-1]:
+        frame[column] = batch[column].values
+    frame["confidence_bucket"] = confidence_buckets(
+        batch["confidence_score"].values.astype(np.float64)
+    )
+
+    codes = frame.groupby(DIMENSIONS, dropna=False).ngroup().values
+    cells = aggregate(frame, by=DIMENSIONS)
+
+    # Histogram of every cell in one bincount over (cell, bin) codes, the
+    # upper edge closing the last bin
+    n_bins = len(BIN_COLUMNS)
+    binned = measured & ~below & ~above
+    bins = np.minimum(
+        np.searchsorted(POTENCY_EDGES, potency[binned], side="right") - 1, n_bins - 1
+    )
+    counts = np.bincount(codes[binned] * n_bins + bins, minlength=len(cells) * n_bins)
+    histogram = pd.DataFrame(
+        counts.reshape(len(cells), n_bins), index=cells.index, columns=BIN_COLUMNS
+    )
+    return pd.concat([cells, histogram], axis=1)
+
+
+def cube_columns():
+    return (
+        DIMENSIONS[:-1] + ["confidence_score", "pIC50", "all_passed"] + check_columns()
+    )
+
+
+def combine_cells(parts):
+    return aggregate(pd.concat(parts), level=DIMENSIONS)
+
+
+@stage("aggregate")
+def build_cube(path, batch_rows=BATCH_ROWS, n_jobs=None):
+    state = {
+        "entry_rows": view_rows("unique_entries", path),
+        "structure_rows": view_rows("deduplicated", path),
+    }
+    cells = map_reduce(
+        path,
+        aggregate_batch,
+        combine_cells,
+        cube_columns(),
+        state,
+        n_jobs=n_jobs,
+        batch_rows=batch_rows,
+    )
+    return SummaryCube(cells.reset_index())
+
+
+def count_batch(batch, start, dimensions):
+    frame = batch[dimensions].assign(
+        rows=np.ones(len(batch), dtype=np.int64),
+        first_row=np.arange(start, start + len(batch)),
+    )
+    return aggregate(frame, by=dimensions)
+
+
+def combine_counts(parts):
+    return aggregate(pd.concat(parts), level=list(parts[0].index.names))
+
+
+@stage("aggregate")
+def count_rows(path, dimensions, n_jobs=None):
+    """
+    A cube of the rows and first row of every cell of dimensions, counted
+    exactly in one streaming pass. Unlike the summary cube it needs no
+    views, so it takes constant memory, for the approximate mode.
+    """
+    cells = map_reduce(
+        path,
+        count_batch,
+        combine_counts,
+        dimensions,
+        {"dimensions": dimensions},
+        n_jobs=n_jobs,
+    )
+    return SummaryCube(cells.reset_index())
+
+
+def cube_path(path):
+    key = repr(
+        [
+            file_fingerprint(path),
+            DIMENSIONS,
+            CONFIDENCE_BUCKETS,
+            POTENCY_EDGES.tolist(),
+            check_columns(),
+            sum_columns(),
+        ]
+    )
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(view_directory(path), f"cube-{digest}.parquet")
+
+
+def warn_out_of_range(cube):
+    below, above = cube.cells[OUT_OF_RANGE_COLUMNS].sum()
+    if below or above:
+        warnings.warn(
+            f"{below} pIC50 values below {POTENCY_EDGES[0]} and {above} above "
+            f"{POTENCY_EDGES[-1]} are left out of the cube's histograms"
+        )
+
+
+def load_cube(path, rebuild=False, n_jobs=None):
+    """
+    The summary cube of the parquet file, built if missing or stale. Warns
+    if any pIC50 falls outside POTENCY_EDGES. A build runs on n_jobs
+    processes (default common.N_JOBS).
+    """
+    target = cube_path(path)
+    if target in LOADED and not rebuild:
+        return LOADED[target]
+    if os.path.exists(target) and not rebuild:
+        LOADED[target] = SummaryCube(pd.read_parquet(target))
+        warn_out_of_range(LOADED[target])
+        return LOADED[target]
+
+    cube = build_cube(path, n_jobs=n_jobs)
+    warn_out_of_range(cube)
+    directory = os.path.dirname(target)
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        cube.cells.to_parquet(f, index=False)
+    os.replace(temporary, target)
+    for entry in os.listdir(directory):
+        stale = os.path.join(directory, entry)
+        if entry.startswith("cube-") and stale != target:
+            os.remove(stale)
+    LOADED[target] = cube
+    return cube
+
+
+class SummaryCube:
+    def __init__(self, cells):
+        self.cells = cells  # one row per non-empty cell
+
+    def rollup(self, by=None, filters=None):
+        """
+        The measures summed over the cells passing filters, one row per
+        combination of the by dimensions (a single row without by).
+        """
+        cells = self.cells[filter_mask(self.cells, filters)]
+        if not by:
+            cells = cells.assign(total="All")
+            by = ["total"]
+        return aggregate(cells, by=by)
+
+    def total(self, filters=None):
+        # As objects, so the counts stay integers next to the float measures
+        return self.rollup(filters=filters).astype(object).iloc[0]
+
+
+def potency_histogram(measures, bins=20):
+    """
+    hist() arguments drawing the pIC50 histogram of a roll-up row with bins
+    equal-width bins over the range of the data, as hist() does for raw
+    values, but with edges snapped to POTENCY_EDGES so the counts are exact.
+    Values outside POTENCY_EDGES are not drawn.
+    """
+    width = POTENCY_EDGES[1] - POTENCY_EDGES[0]
+    n_bins = len(BIN_COLUMNS)
+    first = np.searchsorted(POTENCY_EDGES, measures["pIC50_min"], side="right") - 1
+    last = np.searchsorted(POTENCY_EDGES, measures["pIC50_max"], side="right")
+    first, last = np.clip(first, 0, n_bins - 1), np.clip(last, first + 1, n_bins)
+    step = max(1, math.ceil((last - first) / bins))
+    return {
+        "x": (POTENCY_EDGES[:-1] + POTENCY_EDGES[1:]) / 2,
+        "weights": measures[BIN_COLUMNS].values.astype(np.float64),
+        "bins": POTENCY_EDGES[0] + width * (first + step * np.arange(bins + 1)),
+    }
+
+
+if __name__ == "__main__":
+    import time
+
+    from common import PATH_TO_DF
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--path", default=PATH_TO_DF, help="source parquet file")
+    parser.add_argument("--by", nargs="*", help="dimensions of a roll-up to print")
+    parser.add_argument(
+        "--rebuild", action="store_true", help="rebuild even if up to date"
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    cube = load_cube(args.path, rebuild=args.rebuild)
+    print(
+        f"Cube: {len(cube.cells)} cells, "
+        f"{os.path.getsize(cube_path(args.path)) / 1e3:.0f} kB, "
+        f"loaded in {time.perf_counter() - start:.2f} s"
+    )
+    if args.by is not None:
+        print(cube.rollup(args.by)[["rows", "entries", "structures", "failed"]])
+    else:
+        queries = {
+            "families per assay": (["family", "assay"], None),
+            "potency per source": (["source"], None),
+            "failures, cell": (None, [("assay", "==", "cell")]),
+            "per family, high confidence": (
+                ["family"],
+                [("confidence_bucket", ">=", 0.8)],
+            ),
+        }
+        for name, (by, filters) in queries.items():
+            start = time.perf_counter()
+            cube.rollup(by, filters)
+            print(f"{name}: {(time.perf_counter() - start) * 1e3:.1f} ms")
@@ -0,0 +1,161 @@
+"""
+Data access for the SAIR parquet files.
+
+Figures declare the columns and row filters they need, and those are pushed
+down to pyarrow so unneeded columns are never decoded and row groups whose
+statistics cannot match the filters are skipped. Filters use the pyarrow
+tuple format, e.g. [("source", "==", "ChEMBL"), ("confidence_score", ">", 0.8)],
+and are always combined with AND. Reads filtered on source, assay or family
+are served from the hive-partitioned copy of the file when partition.py has
+written one, so only the matching partitions are opened.
+
+    python data.py   # bytes read and load time per figure, before and after
+"""
+
+import io
+import operator
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from instrument import stage
+from partition import partitioned_source
+from schema import compact_table, dictionary_columns, to_pandas
+
+OPERATORS = {
+    "==": operator.eq,
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def read_sair(path, columns=None, filters=None):
+    # Filtered reads use the partitioned copy of the file, if there is one
+    source, partitioning = partitioned_source(path, filters)
+    with stage("load") as s:
+        table = pq.read_table(
+            source,
+            columns=columns,
+            filters=filters or None,
+            partitioning=partitioning,
+            read_dictionary=dictionary_columns(columns),
+        )
+        s.rows = table.num_rows
+        return to_pandas(compact_table(table))
+
+
+def filter_mask(df, filters):
+    """
+    Evaluates pyarrow-style filters on an already loaded frame.
+    """
+    mask = np.ones(len(df), dtype=bool)
+    if not filters:
+        return mask
+    with stage("filter", rows=len(df)):
+        for column, op, value in filters:
+            if op == "in":
+                mask &= df[column].isin(value).values
+            elif op == "not in":
+                mask &= ~df[column].isin(value).values
+            else:
+                # Missing values never match, as in pyarrow, even where
+                # pandas compares them unequal to everything
+                matches = OPERATORS[op](df[column], value).fillna(False).values
+                mask &= matches & df[column].notna().values
+    return mask
+
+
+def same_filters(a, b):
+    return sorted(map(repr, a or [])) == sorted(map(repr, b or []))
+
+
+def merge_requests(requests):
+    """
+    Combines several (columns, filters) requests on the same file into one
+    read. Columns are unioned, and filters are only kept if every request
+    agrees on them, since the loaded frame has to serve all of them.
+    """
+    columns = []
+    for request_columns, _ in requests:
+        if request_columns is None:
+            columns = None
+            break
+        columns += [c for c in request_columns if c not in columns]
+    filters = requests[0][1]
+    if any(not same_filters(f, filters) for _, f in requests):
+        filters = None
+    if columns is not None:
+        # Filter columns are needed to re-apply filters on the shared frame
+        for _, request_filters in requests:
+            for column, _, _ in request_filters or []:
+                if column not in columns:
+                    columns.append(column)
+    return columns, filters
+
+
+class CountingFile(io.RawIOBase):
+    """
+    Read-only file wrapper that counts the bytes pyarrow pulls from disk.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def readinto(self, buffer):
+        n = self._file.readinto(buffer)
+        self.bytes_read += n
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def measure_read(path, columns=None, filters=None):
+    with CountingFile(path) as f:
+        start = time.perf_counter()
+        df = read_sair(f, columns=columns, filters=filters)
+        elapsed = time.perf_counter() - start
+        return f.bytes_read, elapsed, len(df)
+
+
+if __name__ == "__main__":
+    from make_plots import load_figures
+
+    rows = []
+    for figure in load_figures().values():
+        if figure.path is None:
+            continue
+        full_bytes, full_time, _ = measure_read(figure.path)
+        bytes_read, load_time, n_rows = measure_read(
+            figure.path, figure.columns, figure.filters
+        )
+        rows.append(
+            {
+                "Figure": figure.name,
+                "Full MB": full_bytes / 1e6,
+                "Full s": full_time,
+                "Pushdown MB": bytes_read / 1e6,
+                "Pushdown s": load_time,
+                "Rows": n_rows,
+            }
+        )
+    print(pd.DataFrame(rows).to_string(index=False, float_format="%.2f"))
@@ -0,0 +1,527 @@
+"""
+Out-of-core exact correlation metrics for parquet files larger than memory.
+
+external_metrics() streams record batches from the parquet file and, for every
+(subset, method) pair, spills sorted runs of the scores and of the potency to
+a scratch directory. An external merge sort reads the runs back in blocks and
+assigns exact tie-aware average ranks: AUC is accumulated while the scores are
+merged, and both rank streams are partitioned into bucket files by row number,
+so the score and potency ranks of each row meet again in memory one bucket at
+a time for Spearman. Pearson uses streaming co-moments. Peak memory follows
+memory_budget, not the size of the file.
+
+For Kendall the joined rank pairs are sorted once more, on the score rank.
+Streamed in that order, the discordant pairs are the inversions of the
+potency ranks: those inside a chunk are counted in memory, and those with
+earlier chunks come from counts of the rows seen so far per distinct
+potency. Those counts take one integer per distinct potency, so Kendall is
+left NaN (with a warning) when they do not fit in a quarter of the budget.
+
+    python external.py   # compares with the in-memory engine and times both
+"""
+
+import math
+import os
+import shutil
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from data import filter_mask
+from instrument import peak_rss_mb, stage
+from metrics import ACTIVE_THRESHOLD, METRICS, count_inversions, tied_pairs_per_row
+
+MEMORY_BUDGET = 2**28  # bytes, shared by all buffers of a run
+BATCH_ROWS = 2**16  # rows per streamed record batch
+
+SCORE_RECORD = np.dtype([("value", "f8"), ("row", "i8"), ("label", "u1")])
+POTENCY_RECORD = np.dtype([("value", "f8"), ("row", "i8")])
+RANK_RECORD = np.dtype([("row", "i8"), ("rank", "f8")])
+PAIR_RECORD = np.dtype([("x", "f8"), ("y", "f8")])
+KEY_RECORD = np.dtype(
+    [("hash", "u8"), ("check", "u8"), ("priority", "i8"), ("row", "i8")]
+)
+ROW_RECORD = np.dtype([("row", "i8")])
+
+
+class ExternalSorter:
+    """
+    Sorts record arrays on their first field with bounded memory.
+
+    Records are buffered until the buffer reaches memory_budget bytes, then
+    sorted and written to disk as a run. chunks() merges the runs in blocks
+    and yields sorted record arrays in which equal keys never straddle two
+    chunks, so ties can be ranked one chunk at a time.
+    """
+
+    def __init__(self, dtype, directory, memory_budget):
+        self.dtype = np.dtype(dtype)
+        self.key = self.dtype.names[0]
+        self.directory = directory
+        self.capacity = max(1, memory_budget // self.dtype.itemsize)
+        self.buffer = []
+        self.buffered = 0
+        self.runs = []
+        self.size = 0
+
+    def add(self, records):
+        self.buffer.append(records)
+        self.buffered += len(records)
+        self.size += len(records)
+        if self.buffered >= self.capacity:
+            self.spill()
+
+    def _sorted_buffer(self):
+        records = np.concatenate(self.buffer or [np.empty(0, self.dtype)])
+        self.buffer = []
+        self.buffered = 0
+        return records[np.argsort(records[self.key], kind="stable")]
+
+    def spill(self):
+        if not self.buffered:
+            return
+        fd, path = tempfile.mkstemp(suffix=".run", dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            self._sorted_buffer().tofile(f)
+        self.runs.append(path)
+
+    def chunks(self, memory_budget):
+        if not self.runs:
+            # Everything fit in the buffer
+            records = self._sorted_buffer()
+            if len(records):
+                yield records
+            return
+        self.spill()
+        block = max(1, memory_budget // (2 * len(self.runs) * self.dtype.itemsize))
+        files = [open(path, "rb") for path in self.runs]
+        try:
+            pending = [np.fromfile(f, self.dtype, count=block) for f in files]
+            done = [len(p) < block for p in pending]
+            while True:
+                for i, f in enumerate(files):
+                    if not len(pending[i]) and not done[i]:
+                        pending[i] = np.fromfile(f, self.dtype, count=block)
+                        done[i] = len(pending[i]) < block
+                open_runs = [i for i in range(len(files)) if not done[i]]
+                if not open_runs:
+                    records = np.concatenate(pending)
+                    if len(records):
+                        yield records[np.argsort(records[self.key], kind="stable")]
+                    return
+                # Every record still on disk is at least the smallest of the
+                # last loaded keys of the open runs, so all smaller keys are final
+                cutoff = min(pending[i][self.key][-1] for i in open_runs)
+                cuts = [np.searchsorted(p[self.key], cutoff, "left") for p in pending]
+                if not any(cuts):
+                    # Only keys equal to the cutoff are loaded: read further
+                    # into the runs that stop there so the tie is complete
+                    for i in open_runs:
+                        if pending[i][self.key][-1] == cutoff:
+                            more = np.fromfile(files[i], self.dtype, count=block)
+                            done[i] = len(more) < block
+                            pending[i] = np.concatenate([pending[i], more])
+                    continue
+                records = np.concatenate([p[:c] for p, c in zip(pending, cuts)])
+                pending = [p[c:] for p, c in zip(pending, cuts)]
+                yield records[np.argsort(records[self.key], kind="stable")]
+        finally:
+            for f in files:
+                f.close()
+            for path in self.runs:
+                os.remove(path)
+            self.runs = []
+
+
+class Buckets:
+    """
+    Appends records to one file per bucket, to be read back a bucket at a time.
+    """
+
+    def __init__(self, dtype, n_buckets, directory):
+        self.dtype = np.dtype(dtype)
+        self.paths = [
+            os.path.join(directory, f"{id(self)}_{b}.bucket") for b in range(n_buckets)
+        ]
+
+    def add(self, buckets, records):
+        order = np.argsort(buckets, kind="stable")
+        buckets = buckets[order]
+        records = records[order]
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        for start, stop in zip(starts, np.append(starts[1:], len(buckets))):
+            with open(self.paths[buckets[start]], "ab") as f:
+                records[start:stop].tofile(f)
+
+    def read(self, bucket):
+        path = self.paths[bucket]
+        if not os.path.exists(path):
+            return np.empty(0, self.dtype)
+        records = np.fromfile(path, self.dtype)
+        os.remove(path)
+        return records
+
+
+class Moments:
+    """
+    Streaming means and co-moments of two variables, merged batch by batch
+    (Chan et al.) so no large sums of squares are subtracted.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean_x = self.mean_y = 0.0
+        self.cxx = self.cyy = self.cxy = 0.0
+
+    def update(self, x, y):
+        n = len(x)
+        if not n:
+            return
+        mean_x, mean_y = x.mean(), y.mean()
+        dx, dy = x - mean_x, y - mean_y
+        total = self.n + n
+        delta_x, delta_y = mean_x - self.mean_x, mean_y - self.mean_y
+        weight = self.n * n / total
+        self.cxx += dx @ dx + delta_x * delta_x * weight
+        self.cyy += dy @ dy + delta_y * delta_y * weight
+        self.cxy += dx @ dy + delta_x * delta_y * weight
+        self.mean_x += delta_x * n / total
+        self.mean_y += delta_y * n / total
+        self.n = total
+
+    def pearson(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.clip(self.cxy / np.sqrt(self.cxx * self.cyy), -1.0, 1.0)
+
+
+def scan(path, columns, filters=None, batch_rows=BATCH_ROWS):
+    """
+    Streams a parquet file as pandas batches, in file order, with the filters
+    pushed down to pyarrow.
+    """
+    dataset = ds.dataset(path, format="parquet")
+    expression = pq.filters_to_expression(filters) if filters else None
+    for batch in dataset.to_batches(
+        columns=columns, filter=expression, batch_size=batch_rows
+    ):
+        yield batch.to_pandas()
+
+
+def ranked_chunks(sorter, memory_budget):
+    """
+    Sorted chunks of an ExternalSorter with the average (1-based) rank of
+    every record.
+    """
+    before = 0
+    for records in sorter.chunks(memory_budget):
+        keys = records[sorter.key]
+        new_value = np.ones(len(keys), dtype=bool)
+        new_value[1:] = keys[1:] != keys[:-1]
+        starts = np.flatnonzero(new_value)
+        counts = np.diff(np.append(starts, len(keys)))
+        ranks = (before + starts + (counts + 1) / 2)[np.cumsum(new_value) - 1]
+        before += len(records)
+        yield records, ranks
+
+
+def new_values(sorted_values):
+    new_value = np.ones(len(sorted_values), dtype=bool)
+    new_value[1:] = sorted_values[1:] != sorted_values[:-1]
+    return new_value
+
+
+def tied_pairs(new_group):
+    return int(tied_pairs_per_row(new_group[None])[0])
+
+
+def external_kendall(pairs, y_levels, y_ties, memory_budget):
+    """
+    Kendall tau-b from an ExternalSorter of (score rank, potency rank)
+    records, given the sorted distinct potency ranks and their tied pairs.
+    Same algorithm as metrics.kendall_tau_b.
+    """
+    n = pairs.size
+    seen = np.zeros(len(y_levels), dtype=np.int64)
+    discordant = x_ties = joint_ties = 0
+    for records in pairs.chunks(memory_budget):
+        # Ties in the score rank never straddle two chunks
+        records = records[np.lexsort((records["y"], records["x"]))]
+        levels = np.searchsorted(y_levels, records["y"])
+        new_x = new_values(records["x"])
+        x_ties += tied_pairs(new_x)
+        joint_ties += tied_pairs(new_x | new_values(levels))
+        # Every earlier row has a lower score rank, so those with a higher
+        # potency rank are discordant
+        before = np.cumsum(seen)
+        discordant += int(before[-1] * len(levels) - before[levels].sum())
+        dense = np.unique(levels, return_inverse=True)[1]
+        discordant += int(count_inversions(dense)[0])
+        seen += np.bincount(levels, minlength=len(seen))
+    total = n * (n - 1) // 2
+    con_minus_dis = total - x_ties - y_ties + joint_ties - 2 * discordant
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tau = con_minus_dis / np.sqrt(total - x_ties) / np.sqrt(total - y_ties)
+    return np.clip(tau, -1.0, 1.0)
+
+
+class KeptRows:
+    """
+    Membership test for consecutive row ranges against a stream of sorted
+    row numbers.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.rows = np.empty(0, dtype=np.int64)
+
+    def mask(self, start, stop):
+        mask = np.zeros(stop - start, dtype=bool)
+        while True:
+            inside = self.rows[self.rows < stop]
+            mask[inside - start] = True
+            self.rows = self.rows[len(inside) :]
+            if len(self.rows):
+                return mask
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return mask
+            self.rows = chunk["row"]
+
+
+def first_rows(
+    path, key_columns, column, priority, filters, batch_rows, directory, budget
+):
+    """
+    Row numbers kept by plot_folder-style deduplication: for every key, the
+    row whose column comes first in priority, then the earliest row (only the
+    earliest row without a column). Keys
+    are hashed to 128 bits and partitioned by hash, so each partition is
+    deduplicated in memory. Returns the kept rows as sorted chunks.
+    """
+    n_rows = pq.ParquetFile(path).metadata.num_rows
+    n_buckets = max(1, math.ceil(4 * n_rows * KEY_RECORD.itemsize / budget))
+    buckets = Buckets(KEY_RECORD, n_buckets, directory)
+    start = 0
+    columns = key_columns + ([column] if column else [])
+    for batch in scan(path, columns, filters, batch_rows):
+        keys = batch[key_columns]
+        records = np.empty(len(batch), KEY_RECORD)
+        records["hash"] = pd.util.hash_pandas_object(keys, index=False).values
+        records["check"] = pd.util.hash_pandas_object(
+            keys, index=False, hash_key="sair-dedup-check"
+        ).values
+        records["priority"] = (
+            batch[column].map(priority).fillna(len(priority)).values if column else 0
+        )
+        records["row"] = np.arange(start, start + len(batch))
+        buckets.add(records["hash"] % n_buckets, records)
+        start += len(batch)
+
+    kept = ExternalSorter(ROW_RECORD, directory, budget // 2)
+    for b in range(n_buckets):
+        records = buckets.read(b)
+        order = np.lexsort(
+            (records["row"], records["priority"], records["check"], records["hash"])
+        )
+        records = records[order]
+        first = np.ones(len(records), dtype=bool)
+        first[1:] = (records["hash"][1:] != records["hash"][:-1]) | (
+            records["check"][1:] != records["check"][:-1]
+        )
+        kept.add(records["row"][first].astype(np.int64).view(ROW_RECORD))
+    return kept.chunks(budget // 2)
+
+
+@stage("metrics")
+def external_metrics(
+    path,
+    score_columns,
+    subsets,
+    filters=None,
+    negate=None,
+    potency_column="potency",
+    threshold=ACTIVE_THRESHOLD,
+    drop_duplicates=None,
+    memory_budget=MEMORY_BUDGET,
+    batch_rows=BATCH_ROWS,
+    directory=None,
+    nan_single_class=True,
+):
+    """
+    Spearman, Pearson, Kendall and AUC of every score column against potency
+    within every subset, reading the parquet file with bounded memory.
+
+    subsets: list of filter lists, each selecting a subset of the rows that
+        pass filters ([] for all of them)
+    negate: optional list of booleans, True where lower scores are better
+    drop_duplicates: optional (key_columns, column, priority) keeping one row
+        per key, the one whose column comes first in the priority dict
+
+    Returns a (n_subsets, n_methods, 4) array ordered as METRICS, equal to
+    batched_metrics() on the same rows up to floating point rounding. Rows
+    with a NaN score or potency are dropped per method, and pairs with fewer
+    than two rows or a single activity class are NaN. Without
+    nan_single_class, a single activity class only leaves AUC NaN, as
+    scipy's correlations do.
+    """
+    negate = negate or [False] * len(score_columns)
+    directory = tempfile.mkdtemp(prefix="sair_", dir=directory)
+    try:
+        kept = None
+        if drop_duplicates is not None:
+            key_columns, column, priority = drop_duplicates
+            kept = KeptRows(
+                first_rows(
+                    path,
+                    key_columns,
+                    column,
+                    priority,
+                    filters,
+                    batch_rows,
+                    directory,
+                    memory_budget,
+                )
+            )
+
+        pairs = [(s, m) for s in range(len(subsets)) for m in range(len(score_columns))]
+        share = memory_budget // (2 * len(pairs) + 1)
+        x_sorters = {p: ExternalSorter(SCORE_RECORD, directory, share) for p in pairs}
+        y_sorters = {p: ExternalSorter(POTENCY_RECORD, directory, share) for p in pairs}
+        moments = {p: Moments() for p in pairs}
+
+        subset_columns = [c for subset in subsets for c, _, _ in subset]
+        columns = list(dict.fromkeys(score_columns + [potency_column] + subset_columns))
+        start = 0
+        for batch in scan(path, columns, filters, batch_rows):
+            rows = np.arange(start, start + len(batch))
+            keep = np.ones(len(batch), dtype=bool)
+            if kept is not None:
+                keep = kept.mask(start, start + len(batch))
+            start += len(batch)
+            potency = batch[potency_column].values.astype(np.float64)
+            keep &= ~np.isnan(potency)
+            for s, subset in enumerate(subsets):
+                in_subset = keep & filter_mask(batch, subset)
+                for m, column in enumerate(score_columns):
+                    x = batch[column].values.astype(np.float64)
+                    x = -x if negate[m] else x
+                    valid = in_subset & ~np.isnan(x)
+                    x_records = np.empty(valid.sum(), SCORE_RECORD)
+                    x_records["value"] = x[valid]
+                    x_records["row"] = rows[valid]
+                    x_records["label"] = potency[valid] > threshold
+                    y_records = np.empty(valid.sum(), POTENCY_RECORD)
+                    y_records["value"] = potency[valid]
+                    y_records["row"] = rows[valid]
+                    x_sorters[s, m].add(x_records)
+                    y_sorters[s, m].add(y_records)
+                    moments[s, m].update(x[valid], potency[valid])
+
+        results = np.full((len(subsets), len(score_columns), len(METRICS)), np.nan)
+        # A bucket holds the score and potency ranks of its rows during the join
+        rows_per_bucket = max(1, memory_budget // (4 * RANK_RECORD.itemsize))
+        for pair in pairs:
+            n = x_sorters[pair].size
+            n_buckets = max(1, math.ceil(start / rows_per_bucket))
+            x_ranks = Buckets(RANK_RECORD, n_buckets, directory)
+            y_ranks = Buckets(RANK_RECORD, n_buckets, directory)
+
+            n_pos = rank_sum = 0
+            y_levels, y_ties = [], 0
+            level_budget = memory_budget // (4 * np.dtype("f8").itemsize)
+            for records, ranks in ranked_chunks(x_sorters[pair], memory_budget):
+                labels = records["label"].astype(bool)
+                n_pos += labels.sum()
+                rank_sum += ranks[labels].sum()
+                out = np.empty(len(records), RANK_RECORD)
+                out["row"] = records["row"]
+                out["rank"] = ranks
+                x_ranks.add(out["row"] // rows_per_bucket, out)
+            for records, ranks in ranked_chunks(y_sorters[pair], memory_budget):
+                # Ties never straddle two chunks, so each chunk adds new levels
+                new_rank = new_values(ranks)
+                y_ties += tied_pairs(new_rank)
+                if y_levels is not None:
+                    y_levels.append(ranks[new_rank])
+                    if sum(map(len, y_levels)) > level_budget:
+                        y_levels = None
+                out = np.empty(len(records), RANK_RECORD)
+                out["row"] = records["row"]
+                out["rank"] = ranks
+                y_ranks.add(out["row"] // rows_per_bucket, out)
+
+            # Average ranks of n rows always have mean (n + 1) / 2
+            center = (n + 1) / 2
+            sxy = sxx = syy = 0.0
+            rank_pairs = ExternalSorter(PAIR_RECORD, directory, memory_budget // 2)
+            for b in range(n_buckets):
+                x = x_ranks.read(b)
+                y = y_ranks.read(b)
+                x = x[np.argsort(x["row"])]["rank"]
+                y = y[np.argsort(y["row"])]["rank"]
+                if y_levels is not None:
+                    records = np.empty(len(x), PAIR_RECORD)
+                    records["x"] = x
+                    records["y"] = y
+                    rank_pairs.add(records)
+                x = x - center
+                y = y - center
+                sxy += x @ y
+                sxx += x @ x
+                syy += y @ y
+
+            n_neg = n - n_pos
+            single_class = n_pos == 0 or n_neg == 0
+            if n < 2 or (nan_single_class and single_class):
+                continue
+            with np.errstate(divide="ignore", invalid="ignore"):
+                results[pair][0] = np.clip(sxy / np.sqrt(sxx * syy), -1.0, 1.0)
+            results[pair][1] = moments[pair].pearson()
+            if y_levels is None:
+                warnings.warn(
+                    f"Kendall of subset {pair[0]}, method {pair[1]} left NaN: "
+                    "its distinct potencies do not fit in the memory budget"
+                )
+            else:
+                results[pair][2] = external_kendall(
+                    rank_pairs, np.concatenate(y_levels), y_ties, memory_budget // 2
+                )
+            if not single_class:
+                results[pair][3] = (rank_sum - n_pos * (n_pos + 1) / 2) / (
+                    n_pos * n_neg
+                )
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    from common import Session
+    from metrics import batched_metrics
+    from plot_affinity import COLUMNS, FILTERS, PATH_TO_DF, methods_info, score_matrix
+
+    subsets = [[], [("assay", "==", "biochem")], [("assay", "==", "cell")]]
+    score_columns = [info["score_col"] for info in methods_info.values()]
+    negate = [info["negate"] for info in methods_info.values()]
+
+    start = time.perf_counter()
+    external = external_metrics(
+        PATH_TO_DF, score_columns, subsets, filters=FILTERS, negate=negate
+    )
+    external_time = time.perf_counter() - start
+    external_rss = peak_rss_mb()
+
+    start = time.perf_counter()
+    df = Session().load(PATH_TO_DF, columns=COLUMNS, filters=FILTERS)
+    masks = np.array([filter_mask(df, subset) for subset in subsets])
+    in_memory = batched_metrics(score_matrix(df), df["potency"].values, masks)
+    in_memory_time = time.perf_counter() - start
+
+    max_diff = np.nanmax(np.abs(external - in_memory))
+    print(f"Out of core: {external_time:.2f} s, peak RSS {external_rss:.0f} MB")
+    print(f"In memory:   {in_memory_time:.2f} s")
+    print(f"Max abs difference: {max_diff:.2e}")
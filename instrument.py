@@ -0,0 +1,183 @@
+"""
+Per-stage timing and memory instrumentation of the figure pipelines.
+
+stage() marks a stage (load, filter, view, dedup, metrics, draw, save...)
+as a context manager or a decorator:
+
+    with stage("load") as s:
+        df = read_sair(path)
+        s.rows = len(df)
+
+    @stage("metrics")
+    def batched_metrics(...): ...
+
+When enabled, every stage records its wall time, CPU time, the growth of
+the process's peak RSS while it ran (0 when it stays below an earlier
+peak), its row count if set, the figure it ran for (see figure()) and the
+stages enclosing it. Self times exclude nested stages, so they add up
+without double counting. Records are appended as JSON lines to the report
+file, tagged with a run id, and summary() tabulates one run.
+
+Instrumentation is enabled by enable() or by setting SAIR_INSTRUMENT to the
+report path, which also reaches worker processes (make_plots.py and
+schedule.py take --instrument). When disabled a stage costs one check.
+
+    python instrument.py report.jsonl           # summary of the last run
+    python instrument.py report.jsonl --by-figure
+"""
+
+import argparse
+import functools
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+REPORT = os.environ.get("SAIR_INSTRUMENT")  # JSONL report, None when disabled
+RUN_ID = os.environ.get("SAIR_RUN_ID")
+
+_active = []  # enclosing stages, innermost last
+_figure = None
+
+
+def enable(path, run_id=None):
+    """
+    Records stages to the JSONL file at path, in this process and its
+    children, under run_id (default: a new one). Returns the run id.
+    """
+    global REPORT, RUN_ID
+    REPORT = os.path.abspath(path)
+    RUN_ID = run_id or f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+    os.environ["SAIR_INSTRUMENT"] = REPORT
+    os.environ["SAIR_RUN_ID"] = RUN_ID
+    return RUN_ID
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+@contextmanager
+def figure(name):
+    """
+    Attributes the stages run inside to the figure.
+    """
+    global _figure
+    previous, _figure = _figure, name
+    try:
+        yield
+    finally:
+        _figure = previous
+
+
+class stage:
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+        self.active = False
+
+    def __enter__(self):
+        if REPORT is None:
+            return self
+        self.active = True
+        self.children_wall = 0.0
+        self.children_cpu = 0.0
+        self.rss = peak_rss_mb()
+        _active.append(self)
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if not self.active:
+            return False
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        _active.pop()
+        if _active:
+            _active[-1].children_wall += wall
+            _active[-1].children_cpu += cpu
+        record = {
+            "run": RUN_ID,
+            "pid": os.getpid(),
+            "figure": _figure or os.path.splitext(os.path.basename(sys.argv[0]))[0],
+            "stage": self.name,
+            "path": "/".join([s.name for s in _active] + [self.name]),
+            "wall_s": wall,
+            "self_s": wall - self.children_wall,
+            "cpu_s": cpu,
+            "self_cpu_s": cpu - self.children_cpu,
+            "peak_rss_delta_mb": peak_rss_mb() - self.rss,
+            "rows": self.rows,
+            "failed": exc[0] is not None,
+        }
+        with open(REPORT, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.active = False
+        return False
+
+    def __call__(self, function):
+        name = self.name
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if REPORT is None:
+                return function(*args, **kwargs)
+            with stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+
+def read_report(path, run_id=None):
+    """
+    The records of one run (default: the last) of the report, as a
+    DataFrame.
+    """
+    import pandas as pd
+
+    records = pd.read_json(path, lines=True)
+    if records.empty:
+        return records
+    run_id = run_id or records["run"].iloc[-1]
+    return records[records["run"] == run_id]
+
+
+def summary(records, by_figure=False):
+    """
+    Calls, self and inclusive wall time, self CPU time, largest peak RSS
+    growth and rows of every stage, slowest first.
+    """
+    keys = ["figure", "stage"] if by_figure else ["stage"]
+    table = records.groupby(keys).agg(
+        calls=("stage", "size"),
+        self_s=("self_s", "sum"),
+        wall_s=("wall_s", "sum"),
+        self_cpu_s=("self_cpu_s", "sum"),
+        peak_rss_delta_mb=("peak_rss_delta_mb", "max"),
+        rows=("rows", lambda rows: rows.sum(min_count=1)),
+    )
+    return table.sort_values("self_s", ascending=False)
+
+
+def print_summary(path=None, run_id=None, by_figure=False):
+    records = read_report(path or REPORT, run_id or RUN_ID)
+    if records.empty:
+        print("No stages recorded")
+        return
+    print(f"Stages of run {records['run'].iloc[0]} (report: {path or REPORT})")
+    print(summary(records, by_figure).to_string(float_format="%.2f"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("report", help="JSONL report")
+    parser.add_argument("--run", help="run id (default: the last run)")
+    parser.add_argument(
+        "--by-figure", action="store_true", help="one row per figure and stage"
+    )
+    args = parser.parse_args()
+    print_summary(args.report, args.run, args.by_figure)
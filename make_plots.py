@@ -0,0 +1,167 @@
+"""
+Regenerates every figure in a single process, loading each dataset once.
+
+    python make_plots.py                  # all figures
+    python make_plots.py affinity folder  # a subset
+    python make_plots.py --baseline       # also time the scripts run one by one
+    python make_plots.py --memory-budget 512 affinity  # out of core, in MB
+    python make_plots.py --approximate    # from sketches and samples, see sketches.py
+    python make_plots.py --resample       # with bootstrap intervals and tests
+    python make_plots.py --no-cache       # recompute everything
+    python make_plots.py --profile draft  # fast previews, see rendering.py
+    python make_plots.py --instrument stages.jsonl  # per-stage report
+"""
+
+import argparse
+import importlib
+import resource
+import subprocess
+import sys
+import time
+
+from cache import MAX_BYTES, FigureCache
+from common import FIGURES, Session
+from instrument import enable, figure, peak_rss_mb, print_summary, stage
+from rendering import DEFAULT_PROFILE, PROFILES, set_profile
+
+FIGURE_MODULES = [
+    "plot_affinity",
+    "plot_folder",
+    "plot_posebusters",
+    "plot_cofailures",
+    "plot_potencies",
+    "plot_pocket_clusters",
+    "pocket_confidence",
+    "protein_seq_len_analysis",
+    "plot_families",
+    "plot_targets",
+    "plot_best_pose",
+    "plot_release_diff",
+    "plot_thresholds",
+]
+
+
+def load_figures():
+    for module in FIGURE_MODULES:
+        importlib.import_module(module)
+    return FIGURES
+
+
+def run_figures(names=None, session=None, cache=None):
+    figures = load_figures()
+    names = names or list(figures)
+    session = session or Session()
+    for name in names:
+        for path, columns, filters in figures[name].reads():
+            session.plan(path, columns, filters)
+    for name in names:
+        start = time.perf_counter()
+        with figure(name):
+            with stage("compute"):
+                if cache is None:
+                    data, hit = figures[name].compute(session), None
+                else:
+                    data, hit = cache.compute(figures[name], session)
+            with stage("render"):
+                figures[name].render(data)
+        if hit is None:
+            print(f"{name}: {time.perf_counter() - start:.1f} s")
+        else:
+            status = "cache hit" if hit else "cache miss"
+            print(f"{name}: {time.perf_counter() - start:.1f} s ({status})")
+    if cache is not None:
+        print(
+            f"Cache: {cache.hits} hits, {cache.misses} misses, "
+            f"{cache.size() / 1e6:.1f} MB"
+        )
+    return session
+
+
+def run_baseline():
+    start = time.perf_counter()
+    for module in FIGURE_MODULES:
+        subprocess.run([sys.executable, f"{module}.py"], check=True)
+    # For children this is the peak of the largest single script
+    return time.perf_counter() - start, peak_rss_mb(resource.RUSAGE_CHILDREN)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("figures", nargs="*", help="figure names (default: all)")
+    parser.add_argument(
+        "--baseline",
+        action="store_true",
+        help="also run every script on its own and report the wall time and peak RSS",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        help="stream the parquet files out of core within this many MB, "
+        "for the figures that support it",
+    )
+    parser.add_argument(
+        "--approximate",
+        action="store_true",
+        help="compute from fixed-size sketches and samples, with error "
+        "bounds, for the figures that support it",
+    )
+    parser.add_argument(
+        "--resample",
+        action="store_true",
+        help="add bootstrap intervals and permutation tests, for the figures "
+        "that support them (slow)",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="recompute every figure's data"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=MAX_BYTES / 2**20,
+        help="evict least recently used cache entries beyond this many MB",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(PROFILES),
+        default=DEFAULT_PROFILE,
+        help="rendering profile (see rendering.py)",
+    )
+    parser.add_argument(
+        "--formats",
+        nargs="+",
+        help="extra output formats next to each PNG, e.g. pdf svg",
+    )
+    parser.add_argument(
+        "--instrument",
+        metavar="REPORT",
+        help="append per-stage timings and memory to this JSONL file "
+        "and print a summary (see instrument.py)",
+    )
+    args = parser.parse_args()
+    set_profile(args.profile, args.formats)
+    if args.instrument:
+        enable(args.instrument)
+
+    memory_budget = None
+    if args.memory_budget is not None:
+        memory_budget = int(args.memory_budget * 2**20)
+    session = Session(
+        memory_budget=memory_budget,
+        approximate=args.approximate,
+        resample=args.resample,
+    )
+    start = time.perf_counter()
+    cache = None
+    if not args.no_cache:
+        cache = FigureCache(max_bytes=int(args.cache_size * 2**20))
+    run_figures(args.figures, session, cache)
+    wall_time = time.perf_counter() - start
+    rss = peak_rss_mb()
+
+    print(f"{'Runner':<16}{'Wall time (s)':>16}{'Peak RSS (MB)':>16}")
+    print(f"{'make_plots.py':<16}{wall_time:>16.1f}{rss:>16.0f}")
+    if args.baseline:
+        baseline_time, baseline_rss = run_baseline()
+        print(f"{'one by one':<16}{baseline_time:>16.1f}{baseline_rss:>16.0f}")
+    if args.instrument:
+        print_summary()
@@ -1,8 +1,2 @@
-python plot_affinity.py
-python plot_folder.py
-python plot_posebusters.py
-python plot_potencies.py
-python plot_pocket_clusters.py
-python pocket_confidence.py
-python protein_seq_len_analysis.py
-python plot_families.py
\ No newline at end of file
+# Regenerates the out-of-date figures in parallel, see schedule.py
+python schedule.py "$@"
@@ -0,0 +1,173 @@
+"""
+Parallel map-reduce over the row groups of a parquet file.
+
+map_reduce() splits the row groups of a file into contiguous tasks and runs
+them on a process pool. Each worker opens the file itself and reads only the
+row groups of its task, batch by batch, so only partial aggregates pass
+between processes:
+
+    kernel(batch, start, **state)   the partial aggregate of one pandas
+                                    batch, whose first row is row start of
+                                    the file
+    combine(partials)               one partial aggregate from several
+
+A worker combines the partials of its batches, and the parent combines those
+of the tasks in file order. Counts, sums, minima and maxima, histograms and
+moments all combine this way. state holds read-only inputs shared by every
+batch, such as the row numbers of a view, and is sent once to each worker.
+
+    python mapreduce.py                 # scaling of the cube and assembly
+    python mapreduce.py --jobs 1 2 4    # passes on 1 to N cores
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow.parquet as pq
+import common
+from external import BATCH_ROWS
+from instrument import peak_rss_mb
+
+TASKS_PER_JOB = 4  # smaller tasks even out the load across workers
+
+_state = {}
+
+
+def _init_worker(state):
+    _state.clear()
+    _state.update(state)
+
+
+def row_group_tasks(path, n_tasks):
+    """
+    Up to n_tasks runs of consecutive row groups with similar row counts, as
+    (row group indices, file row number of the first row).
+    """
+    metadata = pq.ParquetFile(path).metadata
+    rows = np.array(
+        [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    )
+    starts = np.cumsum(rows) - rows
+    # Each row group goes to the task its first row falls in
+    task = starts * n_tasks // max(1, rows.sum())
+    tasks = []
+    for t in np.unique(task[rows > 0]):
+        groups = np.flatnonzero((task == t) & (rows > 0))
+        tasks.append((groups.tolist(), int(starts[groups[0]])))
+    return tasks
+
+
+def _map_task(path, kernel, combine, columns, row_groups, start, batch_rows):
+    parquet = pq.ParquetFile(path)
+    partials = []
+    for batch in parquet.iter_batches(
+        batch_size=batch_rows, row_groups=row_groups, columns=columns
+    ):
+        batch = batch.to_pandas()
+        partials.append(kernel(batch, start, **_state))
+        start += len(batch)
+    return combine(partials), os.getpid(), peak_rss_mb()
+
+
+def map_row_groups(
+    path, kernel, combine, columns, state=None, n_jobs=None, batch_rows=BATCH_ROWS
+):
+    """
+    The partial aggregate of every task, in file order, with the pid and
+    the peak RSS (MB) of the process that computed it. n_jobs defaults to
+    common.N_JOBS, read at call time.
+    """
+    n_jobs = n_jobs or common.N_JOBS
+    tasks = row_group_tasks(path, n_jobs * TASKS_PER_JOB)
+    arguments = [
+        (path, kernel, combine, columns, row_groups, start, batch_rows)
+        for row_groups, start in tasks
+    ]
+    if n_jobs == 1 or len(tasks) < 2:
+        _init_worker(state or {})
+        return [_map_task(*task) for task in arguments]
+    with ProcessPoolExecutor(
+        min(n_jobs, len(tasks)), initializer=_init_worker, initargs=(state or {},)
+    ) as pool:
+        return list(pool.map(_map_task, *zip(*arguments)))
+
+
+def map_reduce(
+    path, kernel, combine, columns, state=None, n_jobs=None, batch_rows=BATCH_ROWS
+):
+    """
+    combine() of kernel() over every batch of the parquet file, computed
+    on n_jobs processes (default common.N_JOBS).
+    """
+    partials = map_row_groups(path, kernel, combine, columns, state, n_jobs, batch_rows)
+    return combine([partial for partial, _, _ in partials])
+
+
+if __name__ == "__main__":
+    import pandas as pd
+    from common import PATH_TO_DF
+    from cube import aggregate_batch, cube_columns, combine_cells
+    from plot_posebusters import ASSEMBLY_COLUMNS, assembly_partial, combine_assemblies
+    from views import view_rows
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--path", default=PATH_TO_DF, help="source parquet file")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        nargs="+",
+        default=sorted(
+            {1, *[2**i for i in range(8) if 2**i < common.N_JOBS], common.N_JOBS}
+        ),
+        help="numbers of processes to time",
+    )
+    args = parser.parse_args()
+
+    entry_rows = view_rows("unique_entries", args.path)
+    structure_rows = view_rows("deduplicated", args.path)
+    passes = {
+        "cube": (
+            aggregate_batch,
+            combine_cells,
+            cube_columns(),
+            {"entry_rows": entry_rows, "structure_rows": structure_rows},
+        ),
+        "assemblies": (
+            assembly_partial,
+            combine_assemblies,
+            ASSEMBLY_COLUMNS,
+            {"structure_rows": structure_rows},
+        ),
+    }
+    metadata = pq.ParquetFile(args.path).metadata
+    print(
+        f"{args.path}: {metadata.num_rows} rows in {metadata.num_row_groups} "
+        f"row groups, {os.cpu_count()} cores"
+    )
+    print(
+        f"{'Pass':<12}{'Jobs':>6}{'Tasks':>7}{'Wall (s)':>10}{'Speed-up':>10}"
+        f"{'Peak RSS per worker (MB)':>27}"
+    )
+    for name, (kernel, combine, columns, state) in passes.items():
+        expected = None
+        for n_jobs in args.jobs:
+            start = time.perf_counter()
+            partials = map_row_groups(
+                args.path, kernel, combine, columns, state, n_jobs
+            )
+            result = combine([partial for partial, _, _ in partials])
+            wall = time.perf_counter() - start
+            if expected is None:
+                expected, single = result, wall
+            pd.testing.assert_frame_equal(result, expected)
+            # Peak of each process over its tasks, the parent's on one job
+            peaks = {}
+            for _, pid, peak in partials:
+                peaks[pid] = max(peak, peaks.get(pid, 0))
+            print(
+                f"{name:<12}{n_jobs:>6}{len(partials):>7}{wall:>10.2f}"
+                f"{single / wall:>10.2f}{max(peaks.values()):>27.0f}"
+            )
@@ -0,0 +1,211 @@
+"""
+Hive-partitioned copies of the SAIR parquet files.
+
+Most analyses slice on source, assay and family. write_partitioned()
+rewrites a file as <name>_partitioned/source=.../assay=.../family=.../,
+each partition sorted on SORT_COLUMNS and written in row groups of
+ROW_GROUP_ROWS, so a read filtered on those columns only opens the
+partitions it needs. The copy records the fingerprint of the file it was
+made from, and is only used while that file is unchanged.
+
+data.read_sair() goes through partitioned_source(): reads whose filters use
+a partition column are served from a fresh copy, everything else (and any
+file without a copy) from the file itself. Unfiltered reads keep the file's
+row order, which row-numbered views rely on.
+
+    python partition.py                      # partition the default file
+    python partition.py --by source assay    # coarser layout
+    python partition.py --benchmark          # typical subsets, file vs copy
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from cache import file_fingerprint
+
+PARTITION_COLUMNS = ["source", "assay", "family"]
+SORT_COLUMNS = ["entry_id", "index"]
+ROW_GROUP_ROWS = 2**17
+MANIFEST = "_source.json"
+
+
+def partitioned_path(path):
+    return os.path.splitext(path)[0] + "_partitioned"
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def value_type(type_):
+    # Dictionary columns (e.g. of schema.rewrite) partition and sort on their values
+    return type_.value_type if pa.types.is_dictionary(type_) else type_
+
+
+def hive_partitioning(schema, columns):
+    """
+    Hive partitioning on columns, typed as in the schema of the source file.
+    """
+    fields = [(name, value_type(schema.field(name).type)) for name in columns]
+    return ds.partitioning(pa.schema(fields), flavor="hive")
+
+
+def partitioned_source(path, filters=None):
+    """
+    Where to read path with filters from: (directory, partitioning) of its
+    partitioned copy when it is fresh and the filters prune partitions,
+    otherwise (path, "hive"), pyarrow's default.
+    """
+    if not isinstance(path, str) or not filters:
+        return path, "hive"
+    directory = partitioned_path(path)
+    manifest = read_manifest(directory)
+    if manifest is None or manifest["source"] != list(file_fingerprint(path)):
+        return path, "hive"
+    partition_columns = [name for name, _ in manifest["partitions"]]
+    if not any(column in partition_columns for column, _, _ in filters):
+        return path, "hive"
+    return directory, hive_partitioning(pq.read_schema(path), partition_columns)
+
+
+def write_partitioned(
+    path,
+    by=PARTITION_COLUMNS,
+    sort_columns=SORT_COLUMNS,
+    row_group_rows=ROW_GROUP_ROWS,
+):
+    """
+    Writes the partitioned copy of path and returns its directory. Memory
+    is bounded by the largest partition, which is sorted in memory.
+    """
+    schema = pq.read_schema(path)
+    sort_columns = [c for c in sort_columns if c in schema.names]
+    target = partitioned_path(path)
+    parent = os.path.dirname(os.path.abspath(target))
+    unsorted = tempfile.mkdtemp(prefix="sair_unsorted_", dir=parent)
+    staging = tempfile.mkdtemp(prefix="sair_partitioned_", dir=parent)
+    try:
+        # Streams the file into one directory per partition
+        ds.write_dataset(
+            ds.dataset(path, format="parquet"),
+            unsorted,
+            format="parquet",
+            partitioning=by,
+            partitioning_flavor="hive",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+        for directory, _, files in os.walk(unsorted):
+            files = [os.path.join(directory, f) for f in files]
+            if not files:
+                continue
+            table = pq.read_table(files, partitioning=None)
+            if sort_columns:
+                keys = pa.table(
+                    {c: table[c].cast(value_type(table[c].type)) for c in sort_columns}
+                )
+                order = pc.sort_indices(keys, [(c, "ascending") for c in sort_columns])
+                table = table.take(order)
+            out = os.path.join(staging, os.path.relpath(directory, unsorted))
+            os.makedirs(out, exist_ok=True)
+            pq.write_table(
+                table,
+                os.path.join(out, "part-0.parquet"),
+                row_group_size=row_group_rows,
+            )
+        manifest = {
+            "source": list(file_fingerprint(path)),
+            "partitions": [
+                (name, str(value_type(schema.field(name).type))) for name in by
+            ],
+            "sort_columns": sort_columns,
+            "row_group_rows": row_group_rows,
+        }
+        with open(os.path.join(staging, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=1)
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(staging, target)
+    finally:
+        shutil.rmtree(unsorted, ignore_errors=True)
+        shutil.rmtree(staging, ignore_errors=True)
+    return target
+
+
+if __name__ == "__main__":
+    import time
+
+    import pandas as pd
+    import plot_affinity
+    import plot_folder
+    from common import PATH_TO_DF
+    from data import measure_read
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--path", default=PATH_TO_DF, help="source parquet file")
+    parser.add_argument(
+        "--by", nargs="+", default=PARTITION_COLUMNS, help="partition columns"
+    )
+    parser.add_argument(
+        "--row-group-rows", type=int, default=ROW_GROUP_ROWS, help="rows per group"
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="only time typical subsets on the existing copy",
+    )
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        start = time.perf_counter()
+        directory = write_partitioned(
+            args.path, args.by, row_group_rows=args.row_group_rows
+        )
+        print(f"Wrote {directory} in {time.perf_counter() - start:.1f} s")
+
+    chembl = [("source", "==", "ChEMBL")]
+    subsets = {
+        "affinity, all ChEMBL": (plot_affinity.COLUMNS, chembl),
+        "affinity, ChEMBL cell": (
+            plot_affinity.COLUMNS,
+            chembl + [("assay", "==", "cell")],
+        ),
+        "affinity, ChEMBL biochem": (
+            plot_affinity.COLUMNS,
+            chembl + [("assay", "==", "biochem")],
+        ),
+        "folder, biochem": (plot_folder.COLUMNS, [("assay", "==", "biochem")]),
+        "folder, BindingDB": (plot_folder.COLUMNS, [("source", "==", "BindingDB")]),
+        "families, kinase": (["family", "assay"], [("family", "==", "kinase")]),
+    }
+    rows = []
+    for name, (columns, filters) in subsets.items():
+        file_bytes, file_time, file_rows = measure_read(args.path, columns, filters)
+        directory, partitioning = partitioned_source(args.path, filters)
+        assert directory != args.path, "No fresh partitioned copy to benchmark"
+        start = time.perf_counter()
+        table = pq.read_table(
+            directory, columns=columns, filters=filters, partitioning=partitioning
+        )
+        copy_time = time.perf_counter() - start
+        assert table.num_rows == file_rows
+        rows.append(
+            {
+                "Subset": name,
+                "Rows": file_rows,
+                "File MB": file_bytes / 1e6,
+                "File s": file_time,
+                "Partitioned s": copy_time,
+                "Speedup": file_time / copy_time,
+            }
+        )
+    print(pd.DataFrame(rows).to_string(index=False, float_format="%.2f"))
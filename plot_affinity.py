@@ -1,15 +1,49 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+from common import Session, data_path, register_figure
+from data import filter_mask
+from external import external_metrics
+from metrics import METRICS, batched_metrics
+from rendering import figure_style, save_figure, save_table
+from resampling import COMPARISON_COLUMNS, bootstrap_metrics, permutation_tests
 from scipy.stats import kendalltau, pearsonr, spearmanr
+from sketches import sample_metrics, sample_strata
 from sklearn.metrics import roc_auc_score
 
-plt.rcParams["font.family"] = "serif"
-plt.rcParams["text.usetex"] = True
-plt.rcParams["font.serif"] = ["Computer Modern Roman"]
-plt.rcParams.update({"font.size": 11})
+RC_PARAMS = {"font.size": 11}  # on top of the rendering profile
 
-PATH_TO_DF = "/scratch/buckets/sb-alg-dgx-2q25/pablo/final_dfs/sair_v0.parquet"
+PATH_TO_DF = data_path(
+    "/scratch/buckets/sb-alg-dgx-2q25/pablo/final_dfs/sair_v0.parquet"
+)
+
+COLUMNS = [
+    "vina_score",
+    "vina_score_min",
+    "vinardo_score",
+    "onionnet_score",
+    "aevplig_score",
+    "iptm",
+    "potency",
+    "confidence_score",
+    "assay",
+]
+FILTERS = [("source", "==", "ChEMBL")]  # Only ChEMBL has assay info
+# confidence_score above which a pose counts as high confidence, see
+# plot_thresholds.py for the metrics against the cut
+HIGH_CONFIDENCE = 0.8
+
+ERROR_KW = {"elinewidth": 0.6, "capsize": 1.0, "ecolor": "black"}
+
+# Define methods and their respective score columns and whether to negate them
+methods_info = {
+    "Vina": {"score_col": "vina_score", "negate": True},
+    "Vina minimized": {"score_col": "vina_score_min", "negate": True},
+    "Vinardo": {"score_col": "vinardo_score", "negate": True},
+    "OnionNet": {"score_col": "onionnet_score", "negate": False},
+    "AevPlig": {"score_col": "aevplig_score", "negate": False},
+    "iPTM": {"score_col": "iptm", "negate": False},
+}
 
 
 def analyse_df_and_return_scores(df_subset):
@@ -19,16 +53,6 @@ def analyse_df_and_return_scores(df_subset):
     # Initialize a dictionary to store scores for each method
     method_scores = {}
 
-    # Define methods and their respective score columns and whether to negate them
-    methods_info = {
-        "Vina": {"score_col": "vina_score", "negate": True},
-        "Vina minimized": {"score_col": "vina_score_min", "negate": True},
-        "Vinardo": {"score_col": "vinardo_score", "negate": True},
-        "OnionNet": {"score_col": "onionnet_score", "negate": False},
-        "AevPlig": {"score_col": "aevplig_score", "negate": False},
-        "iPTM": {"score_col": "iptm", "negate": False},
-    }
-
     for method_name, info in methods_info.items():
         scores_raw = df_subset[info["score_col"]].values
         nan_mask = np.isnan(scores_raw)
@@ -63,169 +87,308 @@ def analyse_df_and_return_scores(df_subset):
     return method_scores
 
 
-if __name__ == "__main__":
-    df = pd.read_parquet(PATH_TO_DF)
-    df = df[df["source"] == "ChEMBL"]  # Filter for ChEMBL data
-    df_highconf = df[df["confidence_score"] > 0.8]  # Filter for high confidence scores
-    # Prepare data for plotting
-    all_dfs = []
-    all_dfs_highconf = []
+def score_matrix(df):
+    """
+    Stacks the method scores into a methods x rows array, negated where a
+    lower score means a stronger binder.
+    """
+    return np.stack(
+        [
+            (
+                -df[info["score_col"]].values
+                if info["negate"]
+                else df[info["score_col"]].values
+            )
+            for info in methods_info.values()
+        ]
+    )
 
-    # Overall Scores
-    overall_scores_dict = analyse_df_and_return_scores(df)
-    for method, scores in overall_scores_dict.items():
-        all_dfs.append({"Assay Type": "All Sources", "Method": method, **scores})
 
-    # High Confidence Scores
-    overall_highconf_scores_dict = analyse_df_and_return_scores(df_highconf)
-    for method, scores in overall_highconf_scores_dict.items():
-        all_dfs_highconf.append(
-            {"Assay Type": "All Sources", "Method": method, **scores}
+def compute_out_of_core(session, subsets):
+    """
+    Point estimates only, streamed within the session's memory budget. The
+    intervals and the method comparisons need every row in memory, so they
+    are left empty.
+    """
+    highconf = [("confidence_score", ">", HIGH_CONFIDENCE)]
+    results = external_metrics(
+        PATH_TO_DF,
+        [info["score_col"] for info in methods_info.values()],
+        subsets + [subset + highconf for subset in subsets],
+        filters=FILTERS,
+        negate=[info["negate"] for info in methods_info.values()],
+        memory_budget=session.memory_budget,
+    )
+    lower = upper = np.full_like(results, np.nan)
+    return results, lower, upper, pd.DataFrame(columns=COMPARISON_COLUMNS)
+
+
+def compute_approximate(subsets):
+    """
+    Every bar from a uniform sample of its own subset, all drawn in one
+    streaming pass, with intervals for the value on every row. The method
+    comparisons are left empty.
+    """
+    highconf = [("confidence_score", ">", HIGH_CONFIDENCE)]
+    reservoirs = sample_strata(
+        PATH_TO_DF,
+        COLUMNS,
+        subsets + [subset + highconf for subset in subsets],
+        filters=FILTERS,
+    )
+    results, lower, upper = [], [], []
+    for reservoir in reservoirs:
+        sample = reservoir.sample()
+        values, low, high = sample_metrics(
+            score_matrix(sample),
+            sample["potency"].values,
+            np.ones(len(sample), dtype=bool),
+            reservoir.fraction,
         )
+        results.append(values[0])
+        lower.append(low[0])
+        upper.append(high[0])
+    comparisons = pd.DataFrame(columns=COMPARISON_COLUMNS)
+    return np.array(results), np.array(lower), np.array(upper), comparisons
+
 
-    # Biochemical Assay Scores
-    df_biochem = df[df["assay"] == "biochem"]
-    biochem_scores_dict = analyse_df_and_return_scores(df_biochem)
-    for method, scores in biochem_scores_dict.items():
-        all_dfs.append({"Assay Type": "Biochemical", "Method": method, **scores})
-
-    # High Confidence Biochemical Assay Scores
-    df_biochem_highconf = df_highconf[df_highconf["assay"] == "biochem"]
-    biochem_highconf_scores_dict = analyse_df_and_return_scores(df_biochem_highconf)
-    for method, scores in biochem_highconf_scores_dict.items():
-        all_dfs_highconf.append(
-            {"Assay Type": "Biochemical", "Method": method, **scores}
+def compute_figure_data(session):
+    subsets = {
+        "All Sources": [],
+        "Biochemical": [("assay", "==", "biochem")],
+        "Cell": [("assay", "==", "cell")],
+    }
+    if session.memory_budget is not None:
+        results, lower, upper, comparisons = compute_out_of_core(
+            session, list(subsets.values())
         )
-    # High Confidence Cell Assay Scores
+    elif session.approximate:
+        results, lower, upper, comparisons = compute_approximate(list(subsets.values()))
+    else:
+        df = session.load(PATH_TO_DF, columns=COLUMNS, filters=FILTERS)
+        highconf = (df["confidence_score"] > HIGH_CONFIDENCE).values
+        masks = [filter_mask(df, subset) for subset in subsets.values()]
+        masks = np.array(masks + [mask & highconf for mask in masks])
 
-    # Cell Assay Scores
-    df_cell = df[df["assay"] == "cell"]
-    cell_scores_dict = analyse_df_and_return_scores(df_cell)
-    for method, scores in cell_scores_dict.items():
-        all_dfs.append({"Assay Type": "Cell", "Method": method, **scores})
+        # Every method on every subset in one pass
+        scores = score_matrix(df)
+        potency = df["potency"].values
+        results = batched_metrics(scores, potency, masks)
+        lower = upper = np.full_like(results, np.nan)
+        comparisons = pd.DataFrame(columns=COMPARISON_COLUMNS)
+        if session.resample:
+            lower, upper = bootstrap_metrics(
+                scores, potency, masks, n_jobs=session.n_jobs
+            )
+            comparisons = permutation_tests(
+                scores, potency, masks[0], list(methods_info), n_jobs=session.n_jobs
+            )
 
-    # High Confidence Cell Assay Scores
-    df_cell_highconf = df_highconf[df_highconf["assay"] == "cell"]
-    cell_highconf_scores_dict = analyse_df_and_return_scores(df_cell_highconf)
-    for method, scores in cell_highconf_scores_dict.items():
-        all_dfs_highconf.append({"Assay Type": "Cell", "Method": method, **scores})
+    # Prepare data for plotting
+    all_dfs = []
+    all_dfs_highconf = []
+    for i, assay_type in enumerate(subsets):
+        for j, method in enumerate(methods_info):
+            all_dfs.append(
+                {
+                    "Assay Type": assay_type,
+                    "Method": method,
+                    **dict(zip(METRICS, results[i, j])),
+                    **{f"{m} low": v for m, v in zip(METRICS, lower[i, j])},
+                    **{f"{m} high": v for m, v in zip(METRICS, upper[i, j])},
+                }
+            )
+            all_dfs_highconf.append(
+                {
+                    "Assay Type": assay_type,
+                    "Method": method,
+                    **dict(zip(METRICS, results[len(subsets) + i, j])),
+                    **{
+                        f"{m} low": v
+                        for m, v in zip(METRICS, lower[len(subsets) + i, j])
+                    },
+                    **{
+                        f"{m} high": v
+                        for m, v in zip(METRICS, upper[len(subsets) + i, j])
+                    },
+                }
+            )
 
     # Create the final DataFrame for plotting
     df_plot = pd.DataFrame(all_dfs)
     df_plot_highconf = pd.DataFrame(all_dfs_highconf)
+    return {
+        "df_plot": df_plot,
+        "df_plot_highconf": df_plot_highconf,
+        "comparisons": comparisons,
+    }
 
-    # Set up the plots
-    metrics = ["Spearman", "Pearson", "Kendall", "AUC"]
-    methods = df_plot["Method"].unique()
-    assay_types = df_plot["Assay Type"].unique()
-
-    n_metrics = len(metrics)
-    n_methods = len(methods)
-    n_assay_types = len(assay_types)
-
-    fig, axes = plt.subplots(nrows=2, ncols=2, figsize=(6, 6), sharey=False)
-    plot_titles = [
-        "Spearman Correlation",
-        "Pearson Correlation",
-        "Kendall Correlation",
-        "AUC",
-    ]
-    axes = axes.flatten()  # Flatten axes array for easy iteration
-
-    bar_width = 0.15  # Adjust bar width for better spacing
-    group_spacing = 0.8  # Space between groups of methods
-
-    for i, metric in enumerate(metrics):
-        ax = axes[i]  # Get the current subplot axis
-        metric_df = df_plot[["Assay Type", "Method", metric]]
-        metric_df_highconf = df_plot_highconf[["Assay Type", "Method", metric]]
-
-        # Calculate x-positions for each group of bars (per method)
-        indices = np.arange(n_methods) * (n_assay_types * bar_width + group_spacing)
-        colors = ["tab:blue", "tab:orange", "tab:green"]
-
-        for j, assay_type in enumerate(assay_types):
-            # Extract scores for the current metric and assay type for all methods
-            # Use .loc to ensure correct indexing and avoid SettingWithCopyWarning
-            scores_for_plot = [
-                metric_df.loc[
-                    (metric_df["Method"] == method)
-                    & (metric_df["Assay Type"] == assay_type),
-                    metric,
-                ].values[0]
-                for method in methods
-            ]
-            ax.bar(
-                indices + j * bar_width,
-                scores_for_plot,
-                bar_width,
-                label=assay_type,
-                color=colors[j],
-                # alpha=0.5,
-            )
 
-            # Add high confidence scores as with alpha blending
-            scores_for_plot_highconf = [
-                metric_df_highconf.loc[
-                    (metric_df_highconf["Method"] == method)
-                    & (metric_df_highconf["Assay Type"] == assay_type),
-                    metric,
-                ].values[0]
-                for method in methods
+def bar_errors(metric_df, metric, assay_type, methods):
+    """
+    Asymmetric error bars from the bootstrap interval of each method's bar.
+    """
+    rows = metric_df[metric_df["Assay Type"] == assay_type].set_index("Method")
+    rows = rows.loc[list(methods)]
+    return np.array(
+        [
+            rows[metric] - rows[f"{metric} low"],
+            rows[f"{metric} high"] - rows[metric],
+        ]
+    )
+
+
+def render_figure(data):
+    df_plot = data["df_plot"]
+    df_plot_highconf = data["df_plot_highconf"]
+    # Only resampled runs compare the methods
+    if len(data["comparisons"]):
+        save_table(
+            data["comparisons"], "data/affinity_method_comparisons.csv", index=False
+        )
+
+    with figure_style(RC_PARAMS):
+        # Set up the plots
+        metrics = ["Spearman", "Pearson", "Kendall", "AUC"]
+        methods = df_plot["Method"].unique()
+        assay_types = df_plot["Assay Type"].unique()
+
+        n_metrics = len(metrics)
+        n_methods = len(methods)
+        n_assay_types = len(assay_types)
+
+        fig, axes = plt.subplots(nrows=2, ncols=2, figsize=(6, 6), sharey=False)
+        plot_titles = [
+            "Spearman Correlation",
+            "Pearson Correlation",
+            "Kendall Correlation",
+            "AUC",
+        ]
+        axes = axes.flatten()  # Flatten axes array for easy iteration
+
+        bar_width = 0.15  # Adjust bar width for better spacing
+        group_spacing = 0.8  # Space between groups of methods
+
+        for i, metric in enumerate(metrics):
+            ax = axes[i]  # Get the current subplot axis
+            ci_columns = [f"{metric} low", f"{metric} high"]
+            metric_df = df_plot[["Assay Type", "Method", metric] + ci_columns]
+            metric_df_highconf = df_plot_highconf[
+                ["Assay Type", "Method", metric] + ci_columns
             ]
-            if assay_type == "All Sources":
-                ax.bar(
-                    indices + j * bar_width,
-                    scores_for_plot_highconf,
-                    bar_width,
-                    alpha=0.5,
-                    color=colors[j],
-                    label="High Conf",
-                )
-            else:
+
+            # Calculate x-positions for each group of bars (per method)
+            indices = np.arange(n_methods) * (n_assay_types * bar_width + group_spacing)
+            colors = ["tab:blue", "tab:orange", "tab:green"]
+
+            for j, assay_type in enumerate(assay_types):
+                # Extract scores for the current metric and assay type for all methods
+                # Use .loc to ensure correct indexing and avoid SettingWithCopyWarning
+                scores_for_plot = [
+                    metric_df.loc[
+                        (metric_df["Method"] == method)
+                        & (metric_df["Assay Type"] == assay_type),
+                        metric,
+                    ].values[0]
+                    for method in methods
+                ]
                 ax.bar(
                     indices + j * bar_width,
-                    scores_for_plot_highconf,
+                    scores_for_plot,
                     bar_width,
-                    alpha=0.5,
+                    label=assay_type,
                     color=colors[j],
+                    yerr=bar_errors(metric_df, metric, assay_type, methods),
+                    error_kw=ERROR_KW,
+                    # alpha=0.5,
                 )
 
-        # ax.set_xlabel("Method")
-        ax.set_ylabel(plot_titles[i])
-        # ax.set_title(f'Scores for {metric} Metric')
-        # Center x-ticks under the method groups
-        ax.set_xticks(
-            indices + (n_assay_types - 1) * bar_width / 2,
-            labels=methods,
-            rotation=45,
-            ha="right",
-            fontsize=8,
-        )
-        # ax.set_xticklabels(methods, fontsize=9)
-        # ax.legend(title='Assay Type')
-        ax.grid(axis="y", linestyle="--", alpha=0.7)
-        ax.axhline(
-            0, color="grey", linewidth=0.8
-        )  # Add a horizontal line at 0 for reference
-
-    # axes[0].axhline(
-    #     0, color="black", linewidth=0.8, ls="--"
-    # )  # Add a horizontal line at 0 for reference
-    # axes[1].axhline(
-    #     0, color="black", linewidth=0.8, ls="--"
-    # )  # Add a horizontal line at 0 for reference
-    # axes[2].axhline(
-    #     0, color="black", linewidth=0.8, ls="--"
-    # )  # Add a horizontal line at 0 for reference
-    # axes[3].axhline(
-    #     0.5, color="black", linewidth=0.8, ls="--"
-    # )  # Add a horizontal line at 0 for reference
-    axes[3].set_ylim(0.5, 0.75)
-
-    axes[3].legend(fontsize=8, loc="upper left")
-
-    plt.tight_layout()  # Adjust layout to prevent labels from overlapping
-    plt.savefig(
-        "./figs/scores_by_method_and_assay_type.png", dpi=600, bbox_inches="tight"
-    )
+                # Add high confidence scores as with alpha blending
+                scores_for_plot_highconf = [
+                    metric_df_highconf.loc[
+                        (metric_df_highconf["Method"] == method)
+                        & (metric_df_highconf["Assay Type"] == assay_type),
+                        metric,
+                    ].values[0]
+                    for method in methods
+                ]
+                if assay_type == "All Sources":
+                    ax.bar(
+                        indices + j * bar_width,
+                        scores_for_plot_highconf,
+                        bar_width,
+                        alpha=0.5,
+                        color=colors[j],
+                        label="High Conf",
+                        yerr=bar_errors(
+                            metric_df_highconf, metric, assay_type, methods
+                        ),
+                        error_kw=ERROR_KW,
+                    )
+                else:
+                    ax.bar(
+                        indices + j * bar_width,
+                        scores_for_plot_highconf,
+                        bar_width,
+                        alpha=0.5,
+                        color=colors[j],
+                        yerr=bar_errors(
+                            metric_df_highconf, metric, assay_type, methods
+                        ),
+                        error_kw=ERROR_KW,
+                    )
+
+            # ax.set_xlabel("Method")
+            ax.set_ylabel(plot_titles[i])
+            # ax.set_title(f'Scores for {metric} Metric')
+            # Center x-ticks under the method groups
+            ax.set_xticks(
+                indices + (n_assay_types - 1) * bar_width / 2,
+                labels=methods,
+                rotation=45,
+                ha="right",
+                fontsize=8,
+            )
+            # ax.set_xticklabels(methods, fontsize=9)
+            # ax.legend(title='Assay Type')
+            ax.grid(axis="y", linestyle="--", alpha=0.7)
+            ax.axhline(
+                0, color="grey", linewidth=0.8
+            )  # Add a horizontal line at 0 for reference
+
+        # axes[0].axhline(
+        #     0, color="black", linewidth=0.8, ls="--"
+        # )  # Add a horizontal line at 0 for reference
+        # axes[1].axhline(
+        #     0, color="black", linewidth=0.8, ls="--"
+        # )  # Add a horizontal line at 0 for reference
+        # axes[2].axhline(
+        #     0, color="black", linewidth=0.8, ls="--"
+        # )  # Add a horizontal line at 0 for reference
+        # axes[3].axhline(
+        #     0.5, color="black", linewidth=0.8, ls="--"
+        # )  # Add a horizontal line at 0 for reference
+        axes[3].set_ylim(0.5, 0.75)
+
+        axes[3].legend(fontsize=8, loc="upper left")
+
+        plt.tight_layout()  # Adjust layout to prevent labels from overlapping
+        save_figure("./figs/scores_by_method_and_assay_type.png")
+    plt.close(fig)
+
+
+register_figure(
+    "affinity",
+    compute_figure_data,
+    render_figure,
+    path=PATH_TO_DF,
+    columns=COLUMNS,
+    filters=FILTERS,
+    outputs=[
+        "figs/scores_by_method_and_assay_type.png",
+        "data/affinity_method_comparisons.csv",
+    ],
+)
+
+if __name__ == "__main__":
+    render_figure(compute_figure_data(Session()))
@@ -0,0 +1,125 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import plot_affinity
+import plot_folder
+from assemblies import AssemblyIndex
+from common import Session, register_figure
+from data import filter_mask
+from metrics import METRICS, batched_metrics
+from rendering import figure_style, save_figure, save_table
+
+RC_PARAMS = {"font.size": 8}  # on top of the rendering profile
+
+AFFINITY_COLUMNS = plot_affinity.COLUMNS + ["entry_id"]
+FOLDER_COLUMNS = plot_folder.COLUMNS
+
+SUBSETS = {
+    "All Sources": [],
+    "Biochemical": [("assay", "==", "biochem")],
+    "Cell": [("assay", "==", "cell")],
+}
+POSES = ["All poses", "Best pose"]
+
+
+def best_pose_frame(df, scores, names, label):
+    """
+    Metrics of every score row on all poses and on the top-confidence pose
+    of every assembly, within every subset, as a long DataFrame.
+    """
+    best = AssemblyIndex(df["entry_id"].values).best_mask(df["confidence_score"].values)
+    subsets = [filter_mask(df, subset) for subset in SUBSETS.values()]
+    masks = np.array([mask & poses for mask in subsets for poses in [True, best]])
+    results = batched_metrics(scores, df["potency"].values, masks)
+
+    rows = []
+    for i, (subset, poses) in enumerate(
+        [(subset, poses) for subset in SUBSETS for poses in POSES]
+    ):
+        for j, name in enumerate(names):
+            rows.append(
+                {
+                    "Assay Type": subset,
+                    "Poses": poses,
+                    label: name,
+                    **dict(zip(METRICS, results[i, j])),
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def compute_figure_data(session):
+    df = session.load(
+        plot_affinity.PATH_TO_DF,
+        columns=AFFINITY_COLUMNS,
+        filters=plot_affinity.FILTERS,
+    )
+    affinity = best_pose_frame(
+        df, plot_affinity.score_matrix(df), list(plot_affinity.methods_info), "Method"
+    )
+
+    df = session.load(
+        plot_folder.PATH_TO_DF, columns=FOLDER_COLUMNS, view="deduplicated"
+    )
+    confidence = best_pose_frame(
+        df, df[plot_folder.metrics].values.T, plot_folder.metrics, "Metric"
+    )
+    return {"affinity": affinity, "confidence": confidence}
+
+
+def draw_bars(ax, df, label, names, metric):
+    rows = df[df["Assay Type"] == "All Sources"]
+    positions = np.arange(len(names))
+    width = 0.35
+    for k, poses in enumerate(POSES):
+        values = rows[rows["Poses"] == poses].set_index(label).loc[names, metric]
+        ax.bar(positions + (k - 0.5) * width, values.values, width, label=poses)
+    ax.set_xticks(
+        positions,
+        labels=[name.replace("_", " ") for name in names],
+        rotation=45,
+        ha="right",
+    )
+    ax.axhline(0, color="black", linewidth=0.5, linestyle="--")
+    ax.grid(axis="y", linestyle="--", alpha=0.7)
+
+
+def render_figure(data):
+    affinity = data["affinity"]
+    confidence = data["confidence"]
+    save_table(affinity, "data/best_pose_affinity_metrics.csv", index=False)
+    save_table(confidence, "data/best_pose_confidence_metrics.csv", index=False)
+
+    with figure_style(RC_PARAMS):
+        fig, axes = plt.subplots(nrows=2, figsize=(6, 6))
+        draw_bars(
+            axes[0], affinity, "Method", list(plot_affinity.methods_info), "Spearman"
+        )
+        axes[0].set_ylabel("Spearman Correlation (ChEMBL)")
+        axes[0].legend()
+        draw_bars(axes[1], confidence, "Metric", plot_folder.metrics, "Spearman")
+        axes[1].set_ylabel("Spearman Correlation (IC 50)")
+
+        plt.tight_layout()
+        save_figure("./figs/best_pose_correlations.png")
+    plt.close(fig)
+
+
+register_figure(
+    "best_pose",
+    compute_figure_data,
+    render_figure,
+    path=plot_folder.PATH_TO_DF,
+    columns=FOLDER_COLUMNS,
+    extra_reads=[
+        (plot_affinity.PATH_TO_DF, AFFINITY_COLUMNS, plot_affinity.FILTERS),
+    ],
+    outputs=[
+        "figs/best_pose_correlations.png",
+        "data/best_pose_affinity_metrics.csv",
+        "data/best_pose_confidence_metrics.csv",
+    ],
+)
+
+if __name__ == "__main__":
+    render_figure(compute_figure_data(Session()))
@@ -0,0 +1,53 @@
+import matplotlib.pyplot as plt
+import numpy as np
+from bitsets import load_bits
+from common import PATH_TO_DF, Session, register_figure
+from plot_posebusters import NO_RATE_CHECKS, pb_columns
+from rendering import figure_style, save_figure, save_table
+
+RC_PARAMS = {"font.size": 8}  # on top of the rendering profile
+
+# The checks with a failure rate in the PoseBusters figure
+checks = [pb for pb in pb_columns if pb not in NO_RATE_CHECKS]
+
+
+def compute_figure_data(session):
+    # Failing structures with every check set that fail both checks
+    counts = load_bits(PATH_TO_DF).cofailures(checks)
+    return {"counts": counts}
+
+
+def render_figure(data):
+    counts = data["counts"]
+    save_table(counts, "data/posebusters_cofailures.csv")
+    # Row i, column j: fraction of the structures failing check i that also
+    # fail check j
+    with np.errstate(divide="ignore", invalid="ignore"):
+        conditional = counts.values / np.diag(counts.values)[:, None]
+    labels = [check.replace("_", " ") for check in checks]
+
+    with figure_style(RC_PARAMS):
+        fig, ax = plt.subplots(figsize=(6, 5))
+        image = ax.imshow(conditional, vmin=0, vmax=1, cmap="viridis")
+        ax.set_xticks(np.arange(len(checks)), labels=labels, rotation=45, ha="right")
+        ax.set_yticks(np.arange(len(checks)), labels=labels)
+        ax.set_xlabel("Also failing")
+        ax.set_ylabel("Failing")
+        ax.set_title("PoseBusters Co-Failures")
+        fig.colorbar(image, ax=ax, label="Fraction of failing structures")
+
+        plt.tight_layout()
+        save_figure("./figs/posebusters_cofailures.png")
+    plt.close(fig)
+
+
+register_figure(
+    "cofailures",
+    compute_figure_data,
+    render_figure,
+    inputs=[PATH_TO_DF],
+    outputs=["figs/posebusters_cofailures.png", "data/posebusters_cofailures.csv"],
+)
+
+if __name__ == "__main__":
+    render_figure(compute_figure_data(Session()))
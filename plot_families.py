@@ -1,55 +1,70 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from common import PATH_TO_DF
+from common import PATH_TO_DF, Session, register_figure
+from cube import count_rows, load_cube
 from matplotlib.ticker import PercentFormatter
+from rendering import figure_style, save_figure
 
-plt.rcParams["font.family"] = "serif"
-plt.rcParams["text.usetex"] = True
-plt.rcParams["font.serif"] = ["Computer Modern Roman"]
-plt.rcParams.update({"font.size": 11})
-
-
-def prepare_plot_data(df):
-    df_biochemical = df[df["assay"] == "biochem"]
-    df_cell = df[df["assay"] == "cell"]
-    # Create a dictionary to hold the data for the DataFrame
-    plot_data = {"Family": df["family"].unique()}
-    plot_data["All Sources"] = [
-        df[df["family"] == family].shape[0] / len(df) for family in plot_data["Family"]
-    ]
-    plot_data["Biochemical"] = [
-        df_biochemical[df_biochemical["family"] == family].shape[0]
-        / len(df_biochemical)
-        for family in plot_data["Family"]
-    ]
-    plot_data["Cell"] = [
-        df_cell[df_cell["family"] == family].shape[0] / len(df_cell)
-        for family in plot_data["Family"]
-    ]
+RC_PARAMS = {"font.size": 11}  # on top of the rendering profile
+
+
+def prepare_plot_data(cube):
+    # Families in order of first appearance, as in the rows
+    families = cube.rollup(["family"]).sort_values("first_row")
+    plot_data = {"Family": families.index.values}
+    plot_data["All Sources"] = families["rows"].values / families["rows"].sum()
+    for name, assay in [("Biochemical", "biochem"), ("Cell", "cell")]:
+        rows = cube.rollup(["family"], [("assay", "==", assay)])["rows"]
+        rows = rows.reindex(families.index, fill_value=0)
+        plot_data[name] = rows.values / rows.sum()
     return pd.DataFrame(plot_data)
 
 
-if __name__ == "__main__":
-    df = pd.read_parquet(PATH_TO_DF)
-    df_plot = prepare_plot_data(df)
+def compute_figure_data(session):
+    if session.approximate:
+        # Rows are counted exactly, by counters that need no views
+        cube = count_rows(PATH_TO_DF, ["family", "assay"], n_jobs=session.n_jobs)
+    else:
+        cube = load_cube(PATH_TO_DF, n_jobs=session.n_jobs)
+    df_plot = prepare_plot_data(cube)
     df_plot = df_plot.set_index("Family")
-    # --- Plotting ---
-    fig, ax = plt.subplots(figsize=(6, 4))  # Keeping your desired figsize
-    df_plot.plot(kind="bar", ax=ax, width=0.8)
+    return {"df_plot": df_plot}
+
+
+def render_figure(data):
+    df_plot = data["df_plot"]
 
-    # Add labels and title
-    ax.set_title("Distribution of Protein Families in SAIR Dataset", fontsize=10)
-    ax.set_xlabel("Protein Family")
-    ax.set_ylabel("Frequency")
+    with figure_style(RC_PARAMS):
+        # --- Plotting ---
+        fig, ax = plt.subplots(figsize=(6, 4))  # Keeping your desired figsize
+        df_plot.plot(kind="bar", ax=ax, width=0.8)
 
-    ax.yaxis.set_major_formatter(PercentFormatter(1, decimals=0))
+        # Add labels and title
+        ax.set_title("Distribution of Protein Families in SAIR Dataset", fontsize=10)
+        ax.set_xlabel("Protein Family")
+        ax.set_ylabel("Frequency")
 
-    # Adjust tick parameters for readability on a smaller plot
-    plt.xticks(rotation=45, ha="right", fontsize=8)
-    plt.yticks(fontsize=8)
+        ax.yaxis.set_major_formatter(PercentFormatter(1, decimals=0))
 
-    plt.legend(title="Analysis Type")
-    plt.tight_layout()
+        # Adjust tick parameters for readability on a smaller plot
+        plt.xticks(rotation=45, ha="right", fontsize=8)
+        plt.yticks(fontsize=8)
 
-    plt.savefig("./figs/protein_families.png", bbox_inches="tight", dpi=600)
+        plt.legend(title="Analysis Type")
+        plt.tight_layout()
+
+        save_figure("./figs/protein_families.png")
+    plt.close(fig)
+
+
+register_figure(
+    "families",
+    compute_figure_data,
+    render_figure,
+    inputs=[PATH_TO_DF],
+    outputs=["figs/protein_families.png"],
+)
+
+if __name__ == "__main__":
+    render_figure(compute_figure_data(Session()))
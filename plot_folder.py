@@ -1,13 +1,16 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from common import PATH_TO_DF
+from common import PATH_TO_DF, Session, register_figure
+from external import external_metrics
+from instrument import stage
+from rendering import figure_style, save_figure, save_table
+from resampling import COMPARISON_COLUMNS, bootstrap_metrics, permutation_tests
 from scipy.stats import spearmanr
+from sketches import KEY_COLUMN, sample_metrics, sample_view
+from views import VIEWS
 
-plt.rcParams["font.family"] = "serif"
-plt.rcParams["text.usetex"] = True
-plt.rcParams["font.serif"] = ["Computer Modern Roman"]
-plt.rcParams.update({"font.size": 8})
+RC_PARAMS = {"font.size": 8}  # on top of the rendering profile
 
 metrics = [
     "ptm",
@@ -20,8 +23,15 @@ metrics = [
     "chains_ptm",
     "interaction_ptm",
 ]
+# Metrics where lower means more confident, flipped before comparing methods
+negated_metrics = ["complex_ipde", "complex_pde"]
 
+COLUMNS = metrics + ["potency", "source", "assay", "entry_id", "index"]
 
+ERROR_KW = {"elinewidth": 0.6, "capsize": 1.5, "ecolor": "black"}
+
+
+@stage("metrics")
 def get_spearman_results(dfs):
     spearman_results = []
     for metric in metrics:
@@ -43,61 +53,179 @@ def get_spearman_results(dfs):
     return spearman_results
 
 
-if __name__ == "__main__":
-    df = pd.read_parquet(PATH_TO_DF)
+def compute_out_of_core(session):
+    """
+    Spearman per metric and assay streamed within the session's memory
+    budget, without intervals or comparisons, which need the rows in memory.
+    """
+    results = external_metrics(
+        PATH_TO_DF,
+        metrics,
+        [[], [("assay", "==", "biochem")], [("assay", "==", "cell")]],
+        drop_duplicates=VIEWS["deduplicated"].drop_duplicates,
+        memory_budget=session.memory_budget,
+        # spearmanr, as in memory, does not need both activity classes
+        nan_single_class=False,
+    )
+    spearman_results = results[:, :, 0].T
+    return {
+        "spearman_results": spearman_results,
+        "spearman_lower": np.full_like(spearman_results, np.nan),
+        "spearman_upper": np.full_like(spearman_results, np.nan),
+        "comparisons": pd.DataFrame(columns=COMPARISON_COLUMNS),
+    }
+
+
+def compute_approximate(session):
+    """
+    Spearman per metric and assay on a sample of the poses, with intervals
+    for the value on every pose, without comparisons.
+    """
+    df, fraction = sample_view(PATH_TO_DF, "deduplicated", COLUMNS)
+    masks = np.array(
+        [
+            np.ones(len(df), dtype=bool),
+            (df["assay"] == "biochem").fillna(False).values,
+            (df["assay"] == "cell").fillna(False).values,
+        ]
+    )
+    results, lower, upper = sample_metrics(
+        df[metrics].values.T,
+        df["potency"].values,
+        masks,
+        fraction,
+        keys=df[KEY_COLUMN].values,
+    )
+    return {
+        "spearman_results": results[:, :, 0].T,
+        "spearman_lower": lower[:, :, 0].T,
+        "spearman_upper": upper[:, :, 0].T,
+        "comparisons": pd.DataFrame(columns=COMPARISON_COLUMNS),
+    }
+
+
+def compute_figure_data(session):
+    if session.memory_budget is not None:
+        return compute_out_of_core(session)
+    if session.approximate:
+        return compute_approximate(session)
+    df = session.load(PATH_TO_DF, columns=COLUMNS, view="deduplicated")
     assert df["source"].unique().tolist() == [
         "ChEMBL",
         "BindingDB",
     ], "Unexpected sources in the dataframe"
 
-    # Drop duplicates based on 'entry_id' keeping ChEMBL entries first, as they are the ones with assay info
-    priority = {"ChEMBL": 0, "BindingDB": 1}
-    df["source_priority"] = df["source"].map(priority)
-    df = (
-        df.sort_values("source_priority")
-        .drop_duplicates(["entry_id", "index"], keep="first")
-        .drop(columns="source_priority")
-    )
-
     df_biochem = df[df["assay"] == "biochem"]
     df_cell = df[df["assay"] == "cell"]
     # df_homogenate = df[df["assay"] == "homogenate"]
 
     spearman_results = get_spearman_results([df, df_biochem, df_cell])
-    assay_labels = ["All Sources", "Bioch", "Cell"]
-    title_labels = [
-        "PTM (+)",
-        "iPTM (+)",
-        "Complex iPDE (-)",
-        "Complex PDE (-)",
-        "Complex iPLDDT (+)",
-        "Complex pLDDT (+)",
-        "Confidence Score (+)",
-        "Chains PTM (+)",
-        "Interaction PTM (+)",
-    ]
-
-    fig, axes = plt.subplots(3, 3, figsize=(6, 5), sharey=True)
-    for i, (ax, metric, title) in enumerate(zip(axes.flat, metrics, title_labels)):
-        ax.bar(
-            assay_labels,
-            spearman_results[i],
-            color=["tab:blue", "tab:orange", "tab:green", "tab:red"],
+    if not session.resample:
+        return {
+            "spearman_results": spearman_results,
+            "spearman_lower": np.full_like(spearman_results, np.nan),
+            "spearman_upper": np.full_like(spearman_results, np.nan),
+            "comparisons": pd.DataFrame(columns=COMPARISON_COLUMNS),
+        }
+
+    # Bootstrap intervals for every bar, and each metric against the
+    # confidence score, all on Spearman only
+    scores = df[metrics].values.T
+    potency = df["potency"].values
+    masks = np.array(
+        [
+            np.ones(len(df), dtype=bool),
+            (df["assay"] == "biochem").fillna(False).values,
+            (df["assay"] == "cell").fillna(False).values,
+        ]
+    )
+    lower, upper = bootstrap_metrics(
+        scores, potency, masks, which=["Spearman"], n_jobs=session.n_jobs
+    )
+    oriented = np.where(np.isin(metrics, negated_metrics)[:, None], -scores, scores)
+    reference = metrics.index("confidence_score")
+    comparisons = permutation_tests(
+        oriented,
+        potency,
+        masks[0],
+        metrics,
+        pairs=[(i, reference) for i in range(len(metrics)) if i != reference],
+        which=["Spearman"],
+        n_jobs=session.n_jobs,
+    )
+    return {
+        "spearman_results": spearman_results,
+        "spearman_lower": lower[:, :, 0].T,
+        "spearman_upper": upper[:, :, 0].T,
+        "comparisons": comparisons,
+    }
+
+
+def render_figure(data):
+    spearman_results = data["spearman_results"]
+    # Only resampled runs compare the methods
+    if len(data["comparisons"]):
+        save_table(
+            data["comparisons"], "data/confidence_metric_comparisons.csv", index=False
         )
-        ax.set_title(title, fontsize=9)
-        ax.set_ylim(-0.4, 0.4)
-        if i % 3 == 0:
-            ax.set_ylabel("Spearman Correlation (IC 50)", fontsize=9)
-        ax.axhline(0, color="black", linewidth=0.5, linestyle="--")
-        for j, v in enumerate(spearman_results[i]):
-            ax.text(
-                j,
-                v,
-                f"{v:.2f}",
-                ha="center",
-                va="bottom" if v >= 0 else "top",
-                fontsize=7,
-                color="black",
+
+    with figure_style(RC_PARAMS):
+        assay_labels = ["All Sources", "Bioch", "Cell"]
+        title_labels = [
+            "PTM (+)",
+            "iPTM (+)",
+            "Complex iPDE (-)",
+            "Complex PDE (-)",
+            "Complex iPLDDT (+)",
+            "Complex pLDDT (+)",
+            "Confidence Score (+)",
+            "Chains PTM (+)",
+            "Interaction PTM (+)",
+        ]
+
+        fig, axes = plt.subplots(3, 3, figsize=(6, 5), sharey=True)
+        for i, (ax, metric, title) in enumerate(zip(axes.flat, metrics, title_labels)):
+            ax.bar(
+                assay_labels,
+                spearman_results[i],
+                color=["tab:blue", "tab:orange", "tab:green", "tab:red"],
+                yerr=[
+                    spearman_results[i] - data["spearman_lower"][i],
+                    data["spearman_upper"][i] - spearman_results[i],
+                ],
+                error_kw=ERROR_KW,
             )
-    plt.tight_layout()
-    plt.savefig("./figs/spearman_correlations.png", dpi=600, bbox_inches="tight")
+            ax.set_title(title, fontsize=9)
+            ax.set_ylim(-0.4, 0.4)
+            if i % 3 == 0:
+                ax.set_ylabel("Spearman Correlation (IC 50)", fontsize=9)
+            ax.axhline(0, color="black", linewidth=0.5, linestyle="--")
+            for j, v in enumerate(spearman_results[i]):
+                ax.text(
+                    j,
+                    v,
+                    f"{v:.2f}",
+                    ha="center",
+                    va="bottom" if v >= 0 else "top",
+                    fontsize=7,
+                    color="black",
+                )
+        plt.tight_layout()
+        save_figure("./figs/spearman_correlations.png")
+    plt.close(fig)
+
+
+register_figure(
+    "folder",
+    compute_figure_data,
+    render_figure,
+    path=PATH_TO_DF,
+    columns=COLUMNS,
+    outputs=[
+        "figs/spearman_correlations.png",
+        "data/confidence_metric_comparisons.csv",
+    ],
+)
+
+if __name__ == "__main__":
+    render_figure(compute_figure_data(Session()))
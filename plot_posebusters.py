@@ -1,146 +1,170 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from common import PATH_TO_DF
+from assemblies import AssemblyIndex
+from common import PATH_TO_DF, Session, register_figure
+from cube import SummaryCube, failure_columns, in_rows, load_cube, structure_measures
+from mapreduce import map_reduce
+from rendering import figure_style, save_figure
+from sketches import ratio_error, sample_view
+from views import view_rows
 
-plt.rcParams["font.family"] = "serif"
-plt.rcParams["text.usetex"] = True
-plt.rcParams["font.serif"] = ["Computer Modern Roman"]
-plt.rcParams.update({"font.size": 11})
+pb_columns = [
+    "mol_pred_loaded",
+    "sanitization",
+    "inchi_convertible",
+    "all_atoms_connected",
+    "bond_lengths",
+    "bond_angles",
+    "internal_steric_clash",
+    "aromatic_ring_flatness",
+    "double_bond_flatness",
+    "internal_energy",
+    "mol_cond_loaded",
+    "passes_valence_checks",
+    "passes_kekulization",
+    "number_clashes",
+    "number_short_outlier_bonds",
+    "number_long_outlier_bonds",
+    "number_valid_bonds",
+    "number_valid_angles",
+    "number_valid_noncov_pairs",
+    "number_aromatic_rings",
+    "number_double_bonds",
+]
+# Reduced per assembly on the row groups, the rest comes from the cube
+ASSEMBLY_COLUMNS = ["entry_id", "all_passed", "assay"]
 
+RC_PARAMS = {"font.size": 11}  # on top of the rendering profile
 
-def analyze(df):
 
-    failed_names_series = df.groupby("entry_id")["all_passed"].sum() == 0
+# Checks without a failure rate, left out of the figure
+NO_RATE_CHECKS = [
+    "mol_pred_loaded",
+    "sanitization",
+    "inchi_convertible",
+    "all_atoms_connected",
+    "mol_cond_loaded",
+    "passes_valence_checks",
+    "passes_kekulization",
+]
 
-    # Count the total number of fails
-    number_fails = failed_names_series.sum()
 
-    print(f"Total number of failed structures: {np.sum(df['all_passed'] == False)}")
-    print(f"Total number of structures: {len(df)}")
+def assembly_partial(batch, start, structure_rows):
+    # The deduplicated poses of the batch, reduced per entry
+    kept = in_rows(structure_rows, start, start + len(batch))
+    # A missing all_passed does not pass
+    passed = batch["all_passed"].eq(True).to_numpy(bool, na_value=False)
+    return combine_assemblies(
+        [
+            pd.DataFrame(
+                {
+                    "entry_id": batch["entry_id"].values[kept],
+                    "first_row": start + np.flatnonzero(kept),
+                    "assay": batch["assay"].values[kept],
+                    "passed": passed[kept],
+                }
+            )
+        ]
+    )
+
+
+def combine_assemblies(parts):
+    """
+    Per entry, the row and assay of its first pose and whether any of its
+    poses passes every check, in order of first appearance.
+    """
+    poses = pd.concat(parts)
+    poses = poses.iloc[np.argsort(poses["first_row"].values, kind="stable")]
+    index = AssemblyIndex(poses["entry_id"].values)
+    return pd.DataFrame(
+        {
+            "entry_id": index.keys,
+            "first_row": index.first(poses["first_row"].values),
+            "assay": index.first(poses["assay"].values),
+            "passed": index.any(poses["passed"].values),
+        }
+    )
+
+
+def assembly_failures(assemblies):
+    """
+    Assay of every assembly (entry) and whether it failed, i.e. none of its
+    poses passes every check.
+    """
+    return pd.DataFrame(
+        {
+            "assay": assemblies["assay"].values,
+            "failed": ~assemblies["passed"].values,
+        }
+    )
+
+
+def analyze(measures, assemblies):
+    # measures is a roll-up row of the summary cube (see cube.py)
+    print(f"Total number of failed structures: {measures['failed']}")
+    print(f"Total number of structures: {measures['structures']}")
     print(
-        f"Percentage of failed structures: {np.sum(df['all_passed'] == False) / len(df) * 100:.2f}%"
+        f"Percentage of failed structures: {measures['failed'] / measures['structures'] * 100:.2f}%"
     )
 
+    number_fails = assemblies["failed"].sum()
     print(f"Total number of failed assemblies: {number_fails}")
-    print(f"Total number of assemblies: {len(df) // 5}")
+    print(f"Total number of assemblies: {len(assemblies)}")
     print(
-        f"Percentage of failed assemblies: {number_fails / (len(df) // 5) * 100:.2f}%"
+        f"Percentage of failed assemblies: {number_fails / len(assemblies) * 100:.2f}%"
     )
 
 
-def analyze_failures(df, analysis_name):
+def analyze_failures(measures, analysis_name):
     print(f"{analysis_name} Failure Analysis:")
     print("=" * 30)
 
-    df_failed = df[df["all_passed"] == False]
-
-    pb_columns = [
-        "mol_pred_loaded",
-        "sanitization",
-        "inchi_convertible",
-        "all_atoms_connected",
-        "bond_lengths",
-        "bond_angles",
-        "internal_steric_clash",
-        "aromatic_ring_flatness",
-        "double_bond_flatness",
-        "internal_energy",
-        "mol_cond_loaded",
-        "passes_valence_checks",
-        "passes_kekulization",
-        "number_clashes",
-        "number_short_outlier_bonds",
-        "number_long_outlier_bonds",
-        "number_valid_bonds",
-        "number_valid_angles",
-        "number_valid_noncov_pairs",
-        "number_aromatic_rings",
-        "number_double_bonds",
-    ]
-
-    len_df_pre_nan = len(df_failed)
-    df_failed_cleaned = df_failed.dropna(
-        subset=pb_columns
-    )  # Only consider pb_columns for dropping NaNs
-    num_nan_rows_removed = len_df_pre_nan - len(df_failed_cleaned)
+    # Failed structures with every check set, the only ones counted per check
+    num_failed = measures["failed"]
+    denominator = measures["failed_complete"]
+    num_nan_rows_removed = num_failed - denominator
     nan_failure_rate = (
-        (num_nan_rows_removed / len_df_pre_nan * 100) if len_df_pre_nan > 0 else 0.0
+        (num_nan_rows_removed / num_failed * 100) if num_failed > 0 else 0.0
     )
 
     print(
         f"Number of NaN rows removed: {num_nan_rows_removed}. Failure rate: {nan_failure_rate:.2f}%"
     )
 
-    if len(df_failed_cleaned) == 0:
+    if denominator == 0:
         print("No failures after NaN removal for this analysis.")
         # Return a dictionary with 0.0 for all relevant failure types
-        return {
-            pb: 0.0
-            for pb in pb_columns
-            if pb
-            not in [
-                "mol_pred_loaded",
-                "sanitization",
-                "inchi_convertible",
-                "all_atoms_connected",
-                "mol_cond_loaded",
-                "passes_valence_checks",
-                "passes_kekulization",
-            ]
-        }
-
-    fail_counts = (df_failed_cleaned[pb_columns] == False).sum(axis=0)
-
-    denominator = len(df_failed_cleaned)
-    if denominator == 0:
-        failure_rates = {pb: 0.0 for pb in pb_columns}
-    else:
-        failure_rates = {
-            pb: (count / denominator) * 100 for pb, count in fail_counts.items()
-        }
+        return {pb: 0.0 for pb in pb_columns if pb not in NO_RATE_CHECKS}
 
-    # print("Failures per PoseBuster:")
-    # for pb, rate in failure_rates.items():
-    #     print(f"{pb}: {int(fail_counts[pb])} failures. Failure rate: {rate:.2f}%")
+    fail_counts = dict(zip(pb_columns, measures[failure_columns()]))
+    failure_rates = {
+        pb: (count / denominator) * 100 for pb, count in fail_counts.items()
+    }
 
     # For these, there is no failure rate, so we dont show them
-    filtered_rates = {
-        k: v
-        for k, v in failure_rates.items()
-        if k
-        not in [
-            "mol_pred_loaded",
-            "sanitization",
-            "inchi_convertible",
-            "all_atoms_connected",
-            "mol_cond_loaded",
-            "passes_valence_checks",
-            "passes_kekulization",
-        ]
-    }
-    return filtered_rates
+    return {k: v for k, v in failure_rates.items() if k not in NO_RATE_CHECKS}
 
 
-def prepare_plot_data(df):
-    df_biochemical = df[df["assay"] == "biochem"]
-    df_cell = df[df["assay"] == "cell"]
-    # df_homogenate = df[df["assay"] == "homogenate"]
+def prepare_plot_data(cube, assemblies):
+    overall = cube.total()
+    biochemical = cube.total([("assay", "==", "biochem")])
+    cell = cube.total([("assay", "==", "cell")])
 
     print("Overall Analysis:")
     print("====================================")
-    analyze(df)
+    analyze(overall, assemblies)
     print("Biochemical Assays:")
     print("====================================")
-    analyze(df_biochemical)
+    analyze(biochemical, assemblies[assemblies["assay"] == "biochem"])
     print("Cell Assays:")
     print("====================================")
-    analyze(df_cell)
+    analyze(cell, assemblies[assemblies["assay"] == "cell"])
 
     # Collect failure rates
-    overall_failures = analyze_failures(df, "All Sources")
-    biochemical_failures = analyze_failures(df_biochemical, "Biochemical Assays")
-    cell_failures = analyze_failures(df_cell, "Cell Assays")
+    overall_failures = analyze_failures(overall, "All Sources")
+    biochemical_failures = analyze_failures(biochemical, "Biochemical Assays")
+    cell_failures = analyze_failures(cell, "Cell Assays")
 
     all_failure_types = sorted(
         list(
@@ -164,31 +188,105 @@ def prepare_plot_data(df):
     return pd.DataFrame(plot_data)
 
 
-if __name__ == "__main__":
-    df = pd.read_parquet(PATH_TO_DF)
-    priority = {"ChEMBL": 0, "BindingDB": 1}
-    df["source_priority"] = df["source"].map(priority)
-    df = (
-        df.sort_values("source_priority")
-        .drop_duplicates(["entry_id", "index"], keep="first")
-        .drop(columns="source_priority")
+def compute_approximate():
+    """
+    The failure rates of the poses of a sample of the entries (see
+    sketches.sample_view), printing the error of those in the figure.
+    """
+    # Every pose of a sampled entry, so its assembly is complete
+    sample, fraction = sample_view(
+        PATH_TO_DF,
+        "deduplicated",
+        pb_columns + ASSEMBLY_COLUMNS,
+        key_columns=["entry_id"],
+    )
+    structures = pd.DataFrame(
+        structure_measures(sample, np.ones(len(sample), dtype=bool))
+    )
+    structures["entry_id"] = sample["entry_id"].values
+    structures["assay"] = sample["assay"].values
+    cube = SummaryCube(structures)
+    passed = sample["all_passed"].eq(True).to_numpy(bool, na_value=False)
+    assemblies = combine_assemblies(
+        [
+            pd.DataFrame(
+                {
+                    "entry_id": sample["entry_id"].values,
+                    "first_row": sample["row"].values,
+                    "assay": sample["assay"].values,
+                    "passed": passed,
+                }
+            )
+        ]
+    )
+
+    rates = [f"{pb}_failures" for pb in pb_columns if pb not in NO_RATE_CHECKS]
+    for name, filters in [
+        ("All Sources", []),
+        ("Biochemical Assays", [("assay", "==", "biochem")]),
+        ("Cell Assays", [("assay", "==", "cell")]),
+    ]:
+        entries = cube.rollup(["entry_id"], filters)
+        if entries["failed_complete"].sum() > 1:
+            error = ratio_error(
+                entries[rates].values, entries["failed_complete"].values, fraction
+            )
+            print(
+                f"{name}: failure rates of {len(entries)} sampled entries "
+                f"within {error.max() * 100:.2f} points"
+            )
+    return prepare_plot_data(cube, assembly_failures(assemblies))
+
+
+def compute_figure_data(session):
+    if session.approximate:
+        df_plot = compute_approximate().set_index("Failure Type")
+        return {"df_plot": df_plot}
+    assemblies = map_reduce(
+        PATH_TO_DF,
+        assembly_partial,
+        combine_assemblies,
+        ASSEMBLY_COLUMNS,
+        state={"structure_rows": view_rows("deduplicated", PATH_TO_DF)},
+        n_jobs=session.n_jobs,
+    )
+    df_plot = prepare_plot_data(
+        load_cube(PATH_TO_DF, n_jobs=session.n_jobs), assembly_failures(assemblies)
     )
-    df_plot = prepare_plot_data(df)
     df_plot = df_plot.set_index("Failure Type")
+    return {"df_plot": df_plot}
+
 
-    # --- Plotting ---
-    fig, ax = plt.subplots(figsize=(6, 4))  # Keeping your desired figsize
-    df_plot.plot(kind="bar", ax=ax, width=0.8)
+def render_figure(data):
+    df_plot = data["df_plot"]
 
-    # Add labels and title
-    ax.set_title("Failure Rates per PoseBuster Category")
-    ax.set_xlabel("PoseBuster Failure Type")
-    ax.set_ylabel("Failure Rate (\%)")
+    with figure_style(RC_PARAMS):
+        # --- Plotting ---
+        fig, ax = plt.subplots(figsize=(6, 4))  # Keeping your desired figsize
+        df_plot.plot(kind="bar", ax=ax, width=0.8)
 
-    # Adjust tick parameters for readability on a smaller plot
-    plt.xticks(rotation=45, ha="right", fontsize=8)
-    plt.yticks(fontsize=8)
+        # Add labels and title
+        ax.set_title("Failure Rates per PoseBuster Category")
+        ax.set_xlabel("PoseBuster Failure Type")
+        ax.set_ylabel("Failure Rate (\%)")
 
-    plt.legend(title="Analysis Type")
-    plt.tight_layout()
-    plt.savefig("./figs/posebusters_failure_rates.png", bbox_inches="tight", dpi=600)
+        # Adjust tick parameters for readability on a smaller plot
+        plt.xticks(rotation=45, ha="right", fontsize=8)
+        plt.yticks(fontsize=8)
+
+        plt.legend(title="Analysis Type")
+        plt.tight_layout()
+        save_figure("./figs/posebusters_failure_rates.png")
+    plt.close(fig)
+
+
+register_figure(
+    "posebusters",
+    compute_figure_data,
+    render_figure,
+    inputs=[PATH_TO_DF],
+    outputs=["figs/posebusters_failure_rates.png"],
+)
+
+if __name__ == "__main__":
+    render_figure(compute_figure_data(Session()))
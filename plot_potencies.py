@@ -1,154 +1,207 @@
 import matplotlib.pyplot as plt
-import pandas as pd
-from common import PATH_TO_DF
+import numpy as np
+from common import PATH_TO_DF, Session, register_figure
+from cube import load_cube, potency_histogram
+from data import filter_mask
+from rendering import figure_style, save_figure
+from sketches import ratio_error, sample_view
 
-plt.rcParams["font.family"] = "serif"
-plt.rcParams["text.usetex"] = True
-plt.rcParams["font.serif"] = ["Computer Modern Roman"]
-plt.rcParams.update({"font.size": 11})
+RC_PARAMS = {"font.size": 11}  # on top of the rendering profile
+BINS = 20
+PANELS = {
+    "All": [],
+    "ChEMBL": [("source", "==", "ChEMBL")],
+    "BindingDB": [("source", "==", "BindingDB")],
+    "Cell": [("assay", "==", "cell")],
+    "Biochem": [("assay", "==", "biochem")],
+    "Homogenate": [("assay", "==", "homogenate")],
+}
 
-if __name__ == "__main__":
-    df = pd.read_parquet(PATH_TO_DF)
-    assert df["source"].unique().tolist() == [
+
+def compute_approximate():
+    """
+    The histograms of the unique entries of a sample of the entries (see
+    sketches.sample_view), printing the error of their bin frequencies.
+    """
+    sample, fraction = sample_view(
+        PATH_TO_DF, "unique_entries", ["pIC50", "source", "assay"]
+    )
+    sample = sample[sample["pIC50"].notna()]
+    data = {}
+    for name, filters in PANELS.items():
+        values = sample["pIC50"].values[filter_mask(sample, filters)]
+        values = values.astype(np.float64)
+        if len(values) > 1:
+            # One entry per row, so each row is a key of the sample
+            edges = np.histogram_bin_edges(values, BINS)
+            bins = np.clip(
+                np.searchsorted(edges, values, side="right") - 1, 0, BINS - 1
+            )
+            error = ratio_error(np.eye(BINS)[bins], np.ones(len(values)), fraction)
+            print(
+                f"{name}: pIC50 of {len(values)} sampled entries, bin "
+                f"frequencies within {error.max():.2%}"
+            )
+        data[name] = {"x": values, "weights": np.ones(len(values)), "bins": BINS}
+    return data
+
+
+def compute_figure_data(session):
+    if session.approximate:
+        return compute_approximate()
+    cube = load_cube(PATH_TO_DF, n_jobs=session.n_jobs)
+    sources = cube.rollup(["source"])
+    assert set(sources.index) == {
         "ChEMBL",
         "BindingDB",
-    ], "Unexpected sources in the dataframe"
-    df = df.drop_duplicates(
-        ["entry_id"], keep="first"
-    )  # Drop duplicates based on 'entry_id' and 'index'
+    }, "Unexpected sources in the dataframe"
+    # An assay without entries draws an empty panel
+    assays = cube.rollup(["assay"]).reindex(
+        ["cell", "biochem", "homogenate"], fill_value=0
+    )
+    # hist() arguments per panel, from the histograms of the unique entries
+    return {
+        "All": potency_histogram(cube.total()),
+        "ChEMBL": potency_histogram(sources.loc["ChEMBL"]),
+        "BindingDB": potency_histogram(sources.loc["BindingDB"]),
+        "Cell": potency_histogram(assays.loc["cell"]),
+        "Biochem": potency_histogram(assays.loc["biochem"]),
+        "Homogenate": potency_histogram(assays.loc["homogenate"]),
+    }
 
-    df_chembl = df[df["source"] == "ChEMBL"]
-    df_bindingdb = df[df["source"] == "BindingDB"]
 
-    df_cell = df[df["assay"] == "cell"]
-    df_biochem = df[df["assay"] == "biochem"]
-    df_homogenate = df[df["assay"] == "homogenate"]
+def render_figure(data):
+    with figure_style(RC_PARAMS):
+        fig, axis = plt.subplots(
+            ncols=3, nrows=2, figsize=(6, 4), sharex=True, sharey=True
+        )
+        axis[0, 0].hist(
+            **data["All"],
+            alpha=0.5,
+            label="All",
+            color="blue",
+            density=True,
+        )
+        axis[0, 1].hist(
+            **data["ChEMBL"],
+            alpha=0.5,
+            label="ChEMBL",
+            color="red",
+            density=True,
+        )
+        axis[0, 1].hist(
+            **data["All"],
+            alpha=0.5,
+            label="All",
+            color="grey",
+            fill=False,
+            histtype="step",
+            stacked=True,
+            density=True,
+        )
+        axis[0, 2].hist(
+            **data["BindingDB"],
+            alpha=0.5,
+            label="BindingDB",
+            color="grey",
+            density=True,
+        )
+        axis[0, 2].hist(
+            **data["All"],
+            alpha=0.5,
+            label="All",
+            color="grey",
+            fill=False,
+            histtype="step",
+            stacked=True,
+            density=True,
+        )
+        # axis[0, 0].set_xlabel(r'$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $')
+        axis[0, 0].set_ylabel("Frequency")
+        axis[0, 0].set_title("All Sources")
+        axis[0, 1].set_title("ChEMBL")
+        axis[0, 2].set_title("BindingDB")
+        # axis[0, 1].set_xlabel(r'$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $')
+        # axis[0, 2].set_xlabel(r'$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $')
+        # axis[0].legend()
+        axis[0, 0].set_xlim(3.5, 12)
+        axis[0, 1].set_xlim(3.5, 12)
+        axis[0, 2].set_xlim(3.5, 12)
 
-    fig, axis = plt.subplots(ncols=3, nrows=2, figsize=(6, 4), sharex=True, sharey=True)
-    axis[0, 0].hist(
-        df["pIC50"],
-        bins=20,
-        alpha=0.5,
-        label="All",
-        color="blue",
-        density=True,
-    )
-    axis[0, 1].hist(
-        df_chembl["pIC50"],
-        bins=20,
-        alpha=0.5,
-        label="ChEMBL",
-        color="red",
-        density=True,
-    )
-    axis[0, 1].hist(
-        df["pIC50"],
-        bins=20,
-        alpha=0.5,
-        label="All",
-        color="grey",
-        fill=False,
-        histtype="step",
-        stacked=True,
-        density=True,
-    )
-    axis[0, 2].hist(
-        df_bindingdb["pIC50"],
-        bins=20,
-        alpha=0.5,
-        label="BindingDB",
-        color="grey",
-        density=True,
-    )
-    axis[0, 2].hist(
-        df["pIC50"],
-        bins=20,
-        alpha=0.5,
-        label="All",
-        color="grey",
-        fill=False,
-        histtype="step",
-        stacked=True,
-        density=True,
-    )
-    # axis[0, 0].set_xlabel(r'$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $')
-    axis[0, 0].set_ylabel("Frequency")
-    axis[0, 0].set_title("All Sources")
-    axis[0, 1].set_title("ChEMBL")
-    axis[0, 2].set_title("BindingDB")
-    # axis[0, 1].set_xlabel(r'$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $')
-    # axis[0, 2].set_xlabel(r'$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $')
-    # axis[0].legend()
-    axis[0, 0].set_xlim(3.5, 12)
-    axis[0, 1].set_xlim(3.5, 12)
-    axis[0, 2].set_xlim(3.5, 12)
+        axis[1, 0].hist(
+            **data["Cell"],
+            alpha=0.5,
+            label="Cell",
+            color="green",
+            density=True,
+        )
+        axis[1, 0].hist(
+            **data["All"],
+            alpha=0.5,
+            label="All",
+            color="grey",
+            fill=False,
+            histtype="step",
+            stacked=True,
+            density=True,
+        )
+        axis[1, 1].hist(
+            **data["Biochem"],
+            alpha=0.5,
+            label="Biochem",
+            color="orange",
+            density=True,
+        )
+        axis[1, 1].hist(
+            **data["All"],
+            alpha=0.5,
+            label="All",
+            color="grey",
+            fill=False,
+            density=True,
+            histtype="step",
+            stacked=True,
+        )
+        axis[1, 2].hist(
+            **data["Homogenate"],
+            alpha=0.5,
+            label="Homogenate",
+            color="pink",
+            density=True,
+        )
+        axis[1, 2].hist(
+            **data["All"],
+            alpha=0.5,
+            label="All",
+            color="grey",
+            fill=False,
+            histtype="step",
+            stacked=True,
+            density=True,
+        )
+        axis[1, 0].set_xlabel(r"$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $")
+        axis[1, 0].set_ylabel("Frequency")
+        axis[1, 0].set_title("Cell")
+        axis[1, 1].set_title("Biochemical")
+        axis[1, 2].set_title("Homogenate")
+        axis[1, 1].set_xlabel(r"$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $")
+        axis[1, 2].set_xlabel(r"$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $")
+        axis[1, 0].set_xlim(3.5, 12)
+        axis[1, 1].set_xlim(3.5, 12)
+        axis[1, 2].set_xlim(3.5, 12)
 
-    axis[1, 0].hist(
-        df_cell["pIC50"], bins=20, alpha=0.5, label="Cell", color="green", density=True
-    )
-    axis[1, 0].hist(
-        df["pIC50"],
-        bins=20,
-        alpha=0.5,
-        label="All",
-        color="grey",
-        fill=False,
-        histtype="step",
-        stacked=True,
-        density=True,
-    )
-    axis[1, 1].hist(
-        df_biochem["pIC50"],
-        bins=20,
-        alpha=0.5,
-        label="Biochem",
-        color="orange",
-        density=True,
-    )
-    axis[1, 1].hist(
-        df["pIC50"],
-        bins=20,
-        alpha=0.5,
-        label="All",
-        color="grey",
-        fill=False,
-        density=True,
-        histtype="step",
-        stacked=True,
-    )
-    axis[1, 2].hist(
-        df_homogenate["pIC50"],
-        bins=20,
-        alpha=0.5,
-        label="Homogenate",
-        color="pink",
-        density=True,
-    )
-    axis[1, 2].hist(
-        df["pIC50"],
-        bins=20,
-        alpha=0.5,
-        label="All",
-        color="grey",
-        fill=False,
-        histtype="step",
-        stacked=True,
-        density=True,
-    )
-    axis[1, 0].set_xlabel(r"$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $")
-    axis[1, 0].set_ylabel("Frequency")
-    axis[1, 0].set_title("Cell")
-    axis[1, 1].set_title("Biochemical")
-    axis[1, 2].set_title("Homogenate")
-    axis[1, 1].set_xlabel(r"$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $")
-    axis[1, 2].set_xlabel(r"$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $")
-    axis[1, 0].set_xlim(3.5, 12)
-    axis[1, 1].set_xlim(3.5, 12)
-    axis[1, 2].set_xlim(3.5, 12)
+        plt.tight_layout()
+        save_figure("./figs/ic50_distribution_by_source_and_assay.png")
+    plt.close(fig)
 
-    plt.tight_layout()
-    plt.savefig(
-        "./figs/ic50_distribution_by_source_and_assay.png",
-        dpi=600,
-        bbox_inches="tight",
-    )
+
+register_figure(
+    "potencies",
+    compute_figure_data,
+    render_figure,
+    inputs=[PATH_TO_DF],
+    outputs=["figs/ic50_distribution_by_source_and_assay.png"],
+)
+
+if __name__ == "__main__":
+    render_figure(compute_figure_data(Session()))
@@ -0,0 +1,119 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import plot_affinity
+from common import PATH_TO_DF, Session, register_figure
+from cube import BIN_COLUMNS, POTENCY_EDGES
+from releases import SCORES, diff_releases, load_aggregates, metric_deltas
+from rendering import figure_style, save_figure, save_table
+
+RC_PARAMS = {"font.size": 8}  # on top of the rendering profile
+
+# The release the affinity figure still reads, and the current one
+OLD_PATH = plot_affinity.PATH_TO_DF
+NEW_PATH = PATH_TO_DF
+BINS_PER_BAR = 5  # of the cube's 0.05 wide potency bins
+
+
+def compute_figure_data(session):
+    old = load_aggregates(OLD_PATH)
+    # Derived from the old release and the rows that changed
+    new = load_aggregates(NEW_PATH, base=OLD_PATH)
+    deltas = pd.concat(
+        [metric_deltas(old, new), metric_deltas(old, new, ["assay"])],
+        ignore_index=True,
+    )
+    return {
+        "changes": diff_releases(OLD_PATH, NEW_PATH).counts(),
+        "sources": pd.DataFrame(
+            {
+                "old": old.groupby(level="source")["rows"].sum(),
+                "new": new.groupby(level="source")["rows"].sum(),
+            }
+        ).fillna(0),
+        "histograms": pd.DataFrame(
+            {"old": old[BIN_COLUMNS].sum(), "new": new[BIN_COLUMNS].sum()}
+        ),
+        "deltas": deltas,
+    }
+
+
+def render_figure(data):
+    changes = data["changes"]
+    deltas = data["deltas"]
+    save_table(changes.rename("rows"), "data/release_diff_rows.csv")
+    save_table(deltas, "data/release_diff_metrics.csv", index=False)
+
+    with figure_style(RC_PARAMS):
+        fig, axes = plt.subplots(ncols=3, figsize=(9, 3))
+
+        sources = data["sources"]
+        positions = np.arange(len(sources))
+        for k, release in enumerate(["old", "new"]):
+            axes[0].bar(
+                positions + (k - 0.5) * 0.35,
+                sources[release].values,
+                0.35,
+                label=release,
+            )
+        axes[0].set_xticks(positions, labels=sources.index)
+        axes[0].set_ylabel("Rows")
+        axes[0].set_title(
+            f"+{changes['added']} / -{changes['removed']} / "
+            f"~{changes['changed']} rows"
+        )
+        axes[0].legend()
+
+        centers = (POTENCY_EDGES[:-1] + POTENCY_EDGES[1:]) / 2
+        for release in ["old", "new"]:
+            axes[1].hist(
+                centers,
+                bins=POTENCY_EDGES[::BINS_PER_BAR],
+                weights=data["histograms"][release].values,
+                histtype="step",
+                density=True,
+                label=release,
+            )
+        axes[1].set_xlim(3.5, 12)
+        axes[1].set_xlabel(r"$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $")
+        axes[1].set_ylabel("Frequency")
+        axes[1].set_title("Potency")
+
+        pearson = deltas[
+            (deltas["Group"] == "All") & (deltas["Measure"] == "pearson")
+        ].set_index("Column")
+        pearson = pearson.loc[SCORES]
+        positions = np.arange(len(SCORES))
+        for k, release in enumerate(["old", "new"]):
+            axes[2].barh(
+                positions + (k - 0.5) * 0.35,
+                pearson[f"Value {release}"].values,
+                0.35,
+                label=release,
+            )
+        axes[2].set_yticks(
+            positions, labels=[score.replace("_", " ") for score in SCORES]
+        )
+        axes[2].axvline(0, color="black", linewidth=0.5)
+        axes[2].set_xlabel("Pearson r with potency")
+        axes[2].set_title("Scores")
+
+        plt.tight_layout()
+        save_figure("./figs/release_diff.png")
+    plt.close(fig)
+
+
+register_figure(
+    "release_diff",
+    compute_figure_data,
+    render_figure,
+    inputs=[OLD_PATH, NEW_PATH],
+    outputs=[
+        "figs/release_diff.png",
+        "data/release_diff_rows.csv",
+        "data/release_diff_metrics.csv",
+    ],
+)
+
+if __name__ == "__main__":
+    render_figure(compute_figure_data(Session()))
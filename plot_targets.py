@@ -0,0 +1,142 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import plot_affinity
+import plot_folder
+from common import TARGET_COLUMN, Session, register_figure
+from metrics import METRICS
+from rendering import figure_style, save_figure, save_table
+from segments import group_codes, segment_metrics
+
+RC_PARAMS = {"font.size": 8}  # on top of the rendering profile
+
+AFFINITY_COLUMNS = plot_affinity.COLUMNS + [TARGET_COLUMN]
+FOLDER_COLUMNS = plot_folder.COLUMNS + [TARGET_COLUMN]
+
+
+def per_target_frame(df, scores, names, label, n_jobs=1):
+    """
+    Per-target metrics of every score row as a long DataFrame with one row
+    per (target, method). df must not have missing targets.
+    """
+    groups, targets = group_codes(df[TARGET_COLUMN].values)
+    results, sizes = segment_metrics(
+        scores, df["potency"].values, groups, n_jobs=n_jobs
+    )
+    frames = []
+    for m, name in enumerate(names):
+        frame = pd.DataFrame(results[:, m], columns=METRICS)
+        frame.insert(0, "Target", targets)
+        frame.insert(1, label, name)
+        frame.insert(2, "Rows", sizes[:, m])
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def compute_figure_data(session):
+    df = session.load(
+        plot_affinity.PATH_TO_DF,
+        columns=AFFINITY_COLUMNS,
+        filters=plot_affinity.FILTERS,
+    )
+    df = df[df[TARGET_COLUMN].notna()]
+    affinity = per_target_frame(
+        df,
+        plot_affinity.score_matrix(df),
+        list(plot_affinity.methods_info),
+        "Method",
+        n_jobs=session.n_jobs,
+    )
+
+    df = session.load(
+        plot_folder.PATH_TO_DF, columns=FOLDER_COLUMNS, view="deduplicated"
+    )
+    df = df[df[TARGET_COLUMN].notna()]
+    confidence = per_target_frame(
+        df,
+        df[plot_folder.metrics].values.T,
+        plot_folder.metrics,
+        "Metric",
+        n_jobs=session.n_jobs,
+    )
+    return {"affinity": affinity, "confidence": confidence}
+
+
+def distributions(df, label, names, metric):
+    valid = df[df[metric].notna()]
+    return [valid.loc[valid[label] == name, metric].values for name in names]
+
+
+def render_figure(data):
+    affinity = data["affinity"]
+    confidence = data["confidence"]
+    save_table(affinity, "data/per_target_affinity_metrics.csv", index=False)
+    save_table(confidence, "data/per_target_confidence_metrics.csv", index=False)
+
+    with figure_style(RC_PARAMS):
+        fig, axes = plt.subplot_mosaic(
+            [["Spearman", "Pearson"], ["Kendall", "AUC"], ["conf", "conf"]],
+            figsize=(6, 8),
+        )
+        methods = list(plot_affinity.methods_info)
+        for metric in METRICS:
+            ax = axes[metric]
+            ax.boxplot(
+                distributions(affinity, "Method", methods, metric),
+                showfliers=False,
+                medianprops={"color": "tab:red"},
+            )
+            ax.set_xticks(
+                np.arange(1, len(methods) + 1),
+                labels=methods,
+                rotation=45,
+                ha="right",
+            )
+            ax.set_ylabel(f"Per-target {metric}")
+            ax.axhline(
+                0.5 if metric == "AUC" else 0,
+                color="grey",
+                linewidth=0.8,
+                linestyle="--",
+            )
+            ax.grid(axis="y", linestyle="--", alpha=0.7)
+
+        ax = axes["conf"]
+        ax.boxplot(
+            distributions(confidence, "Metric", plot_folder.metrics, "Spearman"),
+            showfliers=False,
+            medianprops={"color": "tab:red"},
+        )
+        ax.set_xticks(
+            np.arange(1, len(plot_folder.metrics) + 1),
+            labels=[m.replace("_", " ") for m in plot_folder.metrics],
+            rotation=45,
+            ha="right",
+        )
+        ax.set_ylabel("Per-target Spearman (IC 50)")
+        ax.axhline(0, color="grey", linewidth=0.8, linestyle="--")
+        ax.grid(axis="y", linestyle="--", alpha=0.7)
+
+        plt.tight_layout()
+        save_figure("./figs/per_target_correlations.png")
+    plt.close(fig)
+
+
+register_figure(
+    "targets",
+    compute_figure_data,
+    render_figure,
+    path=plot_folder.PATH_TO_DF,
+    columns=FOLDER_COLUMNS,
+    extra_reads=[
+        (plot_affinity.PATH_TO_DF, AFFINITY_COLUMNS, plot_affinity.FILTERS),
+    ],
+    outputs=[
+        "figs/per_target_correlations.png",
+        "data/per_target_affinity_metrics.csv",
+        "data/per_target_confidence_metrics.csv",
+    ],
+)
+
+if __name__ == "__main__":
+    render_figure(compute_figure_data(Session()))
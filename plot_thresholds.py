@@ -0,0 +1,112 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import plot_affinity
+from common import Session, register_figure
+from plot_folder import negated_metrics
+from rendering import figure_style, save_figure, save_table
+from sweeps import SWEEP_METRICS, sweep_metrics, sweep_rates
+
+RC_PARAMS = {"font.size": 8}  # on top of the rendering profile
+
+# Any of plot_folder.metrics works; those where lower means more confident
+# keep the rows below the threshold instead
+CONFIDENCE = "confidence_score"
+# Spearman costs one pass over the kept rows per threshold (see sweeps.py),
+# so the sweep grows with N_THRESHOLDS x rows
+N_THRESHOLDS = 200
+KEPT_AT_LAST = 0.01  # fraction of the rows the highest threshold keeps
+
+COLUMNS = list(dict.fromkeys(plot_affinity.COLUMNS + [CONFIDENCE, "all_passed"]))
+
+
+def compute_figure_data(session):
+    df = session.load(
+        plot_affinity.PATH_TO_DF, columns=COLUMNS, filters=plot_affinity.FILTERS
+    )
+    sign = -1 if CONFIDENCE in negated_metrics else 1
+    confidence = sign * df[CONFIDENCE].values
+    thresholds = np.linspace(
+        np.nanmin(confidence),
+        np.nanquantile(confidence, 1 - KEPT_AT_LAST),
+        N_THRESHOLDS,
+    )
+    results = sweep_metrics(
+        confidence,
+        plot_affinity.score_matrix(df),
+        df["potency"].values,
+        thresholds,
+    )
+    passes = df["all_passed"].to_numpy(dtype=np.float64, na_value=np.nan)
+    kept, pass_rate = sweep_rates(confidence, passes, thresholds)
+
+    rows = []
+    for i, threshold in enumerate(thresholds):
+        for j, method in enumerate(plot_affinity.methods_info):
+            rows.append(
+                {
+                    "Threshold": sign * threshold,
+                    "Method": method,
+                    **dict(zip(SWEEP_METRICS, results[i, j])),
+                    "Rows": kept[i],
+                    "Fraction kept": kept[i] / len(df),
+                    "PoseBusters pass rate": pass_rate[i],
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def render_figure(data):
+    save_table(data, "data/confidence_threshold_sweep.csv", index=False)
+
+    with figure_style(RC_PARAMS):
+        fig, axes = plt.subplots(nrows=2, ncols=2, figsize=(6, 5), sharex=True)
+        axes = axes.flatten()
+        for ax, metric in zip(axes, SWEEP_METRICS):
+            for method, curve in data.groupby("Method", sort=False):
+                ax.plot(curve["Threshold"], curve[metric], label=method)
+            ax.set_title(metric)
+        axes[0].legend(fontsize=6)
+
+        rates = data.drop_duplicates("Threshold")
+        axes[3].plot(rates["Threshold"], rates["Fraction kept"], label="Rows kept")
+        axes[3].plot(
+            rates["Threshold"],
+            rates["PoseBusters pass rate"],
+            label="PoseBusters pass rate",
+        )
+        axes[3].set_ylim(0, 1)
+        axes[3].set_title("Rows")
+        axes[3].legend(fontsize=6)
+
+        for ax in axes:
+            if CONFIDENCE == "confidence_score":
+                ax.axvline(
+                    plot_affinity.HIGH_CONFIDENCE,
+                    color="grey",
+                    linewidth=0.8,
+                    linestyle="--",
+                )
+        for ax in axes[2:]:
+            ax.set_xlabel(f"{CONFIDENCE.replace('_', ' ')} threshold")
+
+        plt.tight_layout()
+        save_figure("./figs/confidence_threshold_sweep.png")
+    plt.close(fig)
+
+
+register_figure(
+    "thresholds",
+    compute_figure_data,
+    render_figure,
+    path=plot_affinity.PATH_TO_DF,
+    columns=COLUMNS,
+    filters=plot_affinity.FILTERS,
+    outputs=[
+        "figs/confidence_threshold_sweep.png",
+        "data/confidence_threshold_sweep.csv",
+    ],
+)
+
+if __name__ == "__main__":
+    render_figure(compute_figure_data(Session()))
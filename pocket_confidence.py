@@ -1,37 +1,142 @@
-import os
-
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import plot_folder
+from common import PATH_TO_DF, Session, register_figure
+from matplotlib.ticker import PercentFormatter
+from metrics import METRICS
+from pockets import POCKET_LDDT_FILE, load_table, pocket_lddt, stream_text
+from rendering import figure_style, save_figure, save_table
 from scipy.stats import spearmanr
+from segments import group_codes, segment_metrics
+from sketches import QuantileSketch
 
-pocket_clusters_file = "/scratch/buckets/sandboxaq-sno-scratch-dev/maarten/combined_pocket_lddt_vs_iptm.csv"
+RC_PARAMS = {"font.size": 11}  # on top of the rendering profile
 
-plt.rcParams["font.family"] = "serif"
-plt.rcParams["text.usetex"] = True
-plt.rcParams["font.serif"] = ["Computer Modern Roman"]
-plt.rcParams.update({"font.size": 11})
+GROUP_COLUMNS = ["assay", "family"]
+JOINED_COLUMNS = GROUP_COLUMNS + plot_folder.metrics
+CORRELATIONS = METRICS[:3]  # LDDT has no activity classes for an AUC
 
 
-combined_df = pd.read_csv(pocket_clusters_file)
+def lddt_correlations(joined):
+    """
+    Correlations of pocket LDDT with every confidence metric, over all
+    poses and within every assay and every family, as a long DataFrame.
+    The poses are stacked once per grouping, with a group code per copy,
+    so a single segment_metrics() call covers every group.
+    """
+    n_rows = joined.num_rows
+    labels = [("All", "All")]
+    rows = [np.arange(n_rows)]
+    groups = [np.zeros(n_rows, dtype=np.int64)]
+    for column in GROUP_COLUMNS:
+        codes, values = group_codes(joined[column].to_numpy(zero_copy_only=False))
+        kept = np.flatnonzero(codes >= 0)
+        rows.append(kept)
+        groups.append(codes[kept] + len(labels))
+        labels += [(column, value) for value in values]
+    rows = np.concatenate(rows)
 
-spearman_corr = spearmanr(combined_df["lddt"], combined_df["iptm"])
-print(f"Spearman correlation between lddt and iptm: {spearman_corr}")
-fig, ax = plt.subplots(figsize=(6, 3))
-ax.hist(
-    combined_df["lddt"],
-    bins=50,
-    edgecolor="black",
-    weights=np.ones_like(combined_df["lddt"]) / len(combined_df["lddt"]),
-)
-ax.set_title("Distribution of pocket LDDT scores")
-ax.set_xlabel("Pocket LDDT score")
-ax.set_ylabel("Frequency")
-from matplotlib.ticker import PercentFormatter
+    scores = np.array(
+        [
+            joined[metric].to_numpy(zero_copy_only=False)
+            for metric in plot_folder.metrics
+        ],
+        dtype=np.float64,
+    )
+    lddt = joined["lddt"].to_numpy(zero_copy_only=False).astype(np.float64)
+    results, sizes = segment_metrics(
+        scores[:, rows], lddt[rows], np.concatenate(groups)
+    )
+
+    records = []
+    for g, (grouping, group) in enumerate(labels):
+        for m, metric in enumerate(plot_folder.metrics):
+            records.append(
+                {
+                    "Grouping": grouping,
+                    "Group": group,
+                    "Metric": metric,
+                    "Poses": sizes[g, m],
+                    **dict(zip(CORRELATIONS, results[g, m])),
+                }
+            )
+    return pd.DataFrame(records)
+
+
+def lddt_sketch():
+    sketch = QuantileSketch()
+    for batch in stream_text("pocket_lddt", POCKET_LDDT_FILE, ["lddt"]):
+        sketch.update(batch.column(0).to_numpy(zero_copy_only=False))
+    print(
+        f"Pocket LDDT sketch of {sketch.n} scores, ranks within "
+        f"{sketch.rank_error() / max(sketch.n, 1):.2%} of them"
+    )
+    return sketch
+
+
+def compute_figure_data(session):
+    if session.approximate:
+        # The distribution from a sketch, as the weighted values it holds.
+        # The correlations stay exact, few poses have an LDDT
+        sketch = lddt_sketch()
+        lddt, weights = sketch.items()
+        return {
+            "lddt": lddt,
+            "weights": weights / sketch.n,
+            "correlations": lddt_correlations(pocket_lddt(PATH_TO_DF, JOINED_COLUMNS)),
+        }
+
+    combined_df = load_table("pocket_lddt", POCKET_LDDT_FILE).to_pandas()
 
-plt.gca().yaxis.set_major_formatter(PercentFormatter(1, decimals=0))
-plt.savefig("figs/pocket_lddt_distribution.png", bbox_inches="tight", dpi=600)
-plt.close()
+    spearman_corr = spearmanr(combined_df["lddt"], combined_df["iptm"])
+    print(f"Spearman correlation between lddt and iptm: {spearman_corr}")
+
+    spearman_corr = spearmanr(combined_df["confidence_score"], combined_df["qtmscore"])
+    print(
+        f"Spearman correlation between confidence_score and qtmscore: {spearman_corr}"
+    )
+
+    correlations = lddt_correlations(pocket_lddt(PATH_TO_DF, JOINED_COLUMNS))
+    lddt = combined_df["lddt"].values
+    return {
+        "lddt": lddt,
+        "weights": np.ones_like(lddt) / len(lddt),
+        "correlations": correlations,
+    }
+
+
+def render_figure(data):
+    lddt = data["lddt"]
+    save_table(data["correlations"], "data/pocket_lddt_correlations.csv", index=False)
+
+    with figure_style(RC_PARAMS):
+        fig, ax = plt.subplots(figsize=(6, 3))
+        ax.hist(
+            lddt,
+            bins=50,
+            edgecolor="black",
+            weights=data["weights"],
+        )
+        ax.set_title("Distribution of pocket LDDT scores")
+        ax.set_xlabel("Pocket LDDT score")
+        ax.set_ylabel("Frequency")
+
+        plt.gca().yaxis.set_major_formatter(PercentFormatter(1, decimals=0))
+        save_figure("figs/pocket_lddt_distribution.png")
+    plt.close(fig)
+
+
+register_figure(
+    "pocket_confidence",
+    compute_figure_data,
+    render_figure,
+    inputs=[POCKET_LDDT_FILE, PATH_TO_DF],
+    outputs=[
+        "figs/pocket_lddt_distribution.png",
+        "data/pocket_lddt_correlations.csv",
+    ],
+)
 
-spearman_corr = spearmanr(combined_df["confidence_score"], combined_df["qtmscore"])
-print(f"Spearman correlation between confidence_score and qtmscore: {spearman_corr}")
+if __name__ == "__main__":
+    render_figure(compute_figure_data(Session()))
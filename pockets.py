@@ -0,0 +1,418 @@
+"""
+Pocket cluster files as typed columns, and their join onto the SAIR rows.
+
+pocket_clusters.txt lists the number of distinct pockets found for every
+protein (tab-separated protein and count, no header), subclust_pockets.csv
+the number of distinct pockets in every batch of predictions. Both are read
+with pyarrow's multithreaded CSV reader straight into typed Arrow columns,
+and cached as uncompressed Arrow IPC files next to the views of the source
+file (see views.py), named after its fingerprint and rebuilt when it
+changes.
+
+PocketIndex keeps the proteins sorted with their pocket counts. Joining it
+onto the SAIR rows factorizes the protein column, looks up each distinct
+protein once with a binary search and gathers the counts by code, instead
+of a pandas merge on string keys.
+
+combined_pocket_lddt_vs_iptm.csv holds the pocket LDDT of predicted poses,
+by entry_id and pose index. PoseIndex maps every (entry_id, index) to its
+row of the deduplicated view of a SAIR file with one binary search over
+sorted integer keys; it is built once per file and stored with its views.
+pocket_lddt() joins the LDDT table onto the SAIR columns through it and
+caches the joined table as an Arrow IPC file.
+
+    python pockets.py   # checks the join against a pandas merge, times both,
+                        # and prints pass rates and affinity metrics by pockets
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.feather as feather
+from cache import file_fingerprint
+from common import data_path
+from instrument import stage
+from segments import group_codes
+from views import read_rows, view_directory, view_rows
+
+POCKET_CLUSTERS_FILE = data_path(
+    "/scratch/buckets/sandboxaq-sno-scratch-dev/maarten/pocket_clusters.txt"
+)
+SUBCLUST_POCKETS_FILE = data_path(
+    "/scratch/buckets/sandboxaq-sno-scratch-dev/maarten/subclust_pockets.csv"
+)
+POCKET_LDDT_FILE = data_path(
+    "/scratch/buckets/sandboxaq-sno-scratch-dev/maarten/combined_pocket_lddt_vs_iptm.csv"
+)
+PROTEIN_COLUMN = "protein_id"  # the proteins of pocket_clusters.txt
+POSE_COLUMNS = ["entry_id", "index"]  # the poses of the LDDT table
+POSE_VIEW = "deduplicated"  # one row per pose
+
+# Columns and format of each file, by cache name
+LAYOUTS = {
+    "pocket_clusters": {
+        "schema": pa.schema([("protein", pa.string()), ("pockets", pa.int32())]),
+        "delimiter": "\t",
+        "header": False,
+    },
+    "subclust_pockets": {
+        "schema": pa.schema([("numpockets", pa.int32())]),
+        "delimiter": ",",
+        "header": True,
+    },
+    "pocket_lddt": {
+        "schema": pa.schema(
+            [
+                ("entry_id", pa.string()),
+                ("index", pa.int64()),
+                ("lddt", pa.float64()),
+                ("iptm", pa.float64()),
+                ("confidence_score", pa.float64()),
+                ("qtmscore", pa.float64()),
+            ]
+        ),
+        "delimiter": ",",
+        "header": True,
+    },
+}
+
+MAX_POCKETS = 10  # larger counts share the last bucket
+NO_POCKETS = -1  # pocket count of proteins missing from the file
+
+LOADED = {}  # tables read in this process, by cache file
+
+
+def text_options(layout, columns=None):
+    schema = layout["schema"]
+    return {
+        "read_options": csv.ReadOptions(
+            use_threads=True,
+            column_names=None if layout["header"] else schema.names,
+        ),
+        "parse_options": csv.ParseOptions(delimiter=layout["delimiter"]),
+        "convert_options": csv.ConvertOptions(
+            column_types=schema, include_columns=columns or schema.names
+        ),
+    }
+
+
+@stage("load")
+def read_text(path, layout):
+    """
+    The delimited text file as an Arrow table with the layout's types.
+    """
+    return csv.read_csv(path, **text_options(layout))
+
+
+def stream_text(name, path, columns=None):
+    """
+    The delimited text file of a layout as Arrow record batches, read in
+    bounded memory.
+    """
+    yield from csv.open_csv(path, **text_options(LAYOUTS[name], columns))
+
+
+def table_path(name, path):
+    key = repr([file_fingerprint(path), str(LAYOUTS[name]["schema"])])
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(view_directory(path), f"{name}-{digest}.arrow")
+
+
+def replace_file(target, name, write):
+    """
+    Writes target atomically with write(temporary path), then removes the
+    other files of the same name in its directory.
+    """
+    directory = os.path.dirname(target)
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(fd)
+    write(temporary)
+    os.replace(temporary, target)
+    for entry in os.listdir(directory):
+        stale = os.path.join(directory, entry)
+        if entry.startswith(f"{name}-") and stale != target:
+            os.remove(stale)
+
+
+def write_arrow(table, target, name):
+    replace_file(
+        target,
+        name,
+        lambda temporary: feather.write_feather(
+            table, temporary, compression="uncompressed"
+        ),
+    )
+
+
+def load_table(name, path, rebuild=False):
+    """
+    The file as an Arrow table, parsed and cached if missing or stale.
+    """
+    target = table_path(name, path)
+    if target in LOADED and not rebuild:
+        return LOADED[target]
+    if os.path.exists(target) and not rebuild:
+        LOADED[target] = feather.read_table(target, memory_map=True)
+        return LOADED[target]
+
+    table = read_text(path, LAYOUTS[name])
+    write_arrow(table, target, name)
+    LOADED[target] = table
+    return table
+
+
+def pocket_clusters(path=POCKET_CLUSTERS_FILE):
+    """
+    Table of protein and number of distinct pockets.
+    """
+    return load_table("pocket_clusters", path)
+
+
+def subclust_pockets(path=SUBCLUST_POCKETS_FILE):
+    """
+    Table of the number of distinct pockets (numpockets) per batch.
+    """
+    return load_table("subclust_pockets", path)
+
+
+class PocketIndex:
+    def __init__(self, table):
+        """
+        table: protein and pocket count columns, as pocket_clusters().
+        A protein listed more than once keeps its first count.
+        """
+        proteins = table["protein"].to_numpy(zero_copy_only=False).astype(str)
+        pockets = table["pockets"].to_numpy()
+        proteins, first = np.unique(proteins, return_index=True)
+        self.proteins = proteins
+        self.pockets = pockets[first]
+
+    @classmethod
+    def load(cls, path=POCKET_CLUSTERS_FILE):
+        return cls(pocket_clusters(path))
+
+    def lookup(self, keys):
+        """
+        Pocket count of every key, NO_POCKETS for missing keys and proteins
+        not in the index.
+        """
+        codes, uniques = group_codes(keys)
+        uniques = uniques.astype(str)
+        positions = np.searchsorted(self.proteins, uniques)
+        positions = np.minimum(positions, len(self.proteins) - 1)
+        found = self.proteins[positions] == uniques
+        counts = np.where(found, self.pockets[positions], NO_POCKETS)
+        # A trailing NO_POCKETS for the rows with a missing key (code -1)
+        return np.append(counts, NO_POCKETS)[codes]
+
+    def join(self, df, column=PROTEIN_COLUMN):
+        """
+        Pocket count of every row of df, by its protein.
+        """
+        return self.lookup(df[column].values)
+
+
+class PoseIndex:
+    def __init__(self, entries, keys, rows, stride):
+        self.entries = entries  # sorted entry_ids
+        self.keys = keys  # sorted entry rank * stride + pose index
+        self.rows = rows  # row number of each key
+        self.stride = stride  # more than the largest pose index
+
+    @classmethod
+    def build(cls, path):
+        rows = view_rows(POSE_VIEW, path)
+        df = read_rows(path, rows, POSE_COLUMNS)
+        entries, ranks = np.unique(
+            df["entry_id"].to_numpy(dtype=str), return_inverse=True
+        )
+        indices = df["index"].values.astype(np.int64)
+        stride = int(indices.max()) + 1 if len(indices) else 1
+        keys = ranks * stride + indices
+        order = np.argsort(keys, kind="stable")
+        return cls(entries, keys[order], rows[order], stride)
+
+    @classmethod
+    def load(cls, path, rebuild=False):
+        """
+        The pose index of the SAIR file, built if missing or stale.
+        """
+        key = repr([file_fingerprint(path), POSE_VIEW, POSE_COLUMNS])
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        target = os.path.join(view_directory(path), f"poses-{digest}.npz")
+        if target in LOADED and not rebuild:
+            return LOADED[target]
+        if os.path.exists(target) and not rebuild:
+            with np.load(target) as f:
+                index = cls(f["entries"], f["keys"], f["rows"], int(f["stride"]))
+        else:
+            index = cls.build(path)
+            replace_file(target, "poses", index.save)
+        LOADED[target] = index
+        return index
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                entries=self.entries,
+                keys=self.keys,
+                rows=self.rows,
+                stride=self.stride,
+            )
+
+    def lookup(self, entry_ids, indices):
+        """
+        Row number of every pose, -1 for poses not in the index.
+        """
+        entry_ids = np.asarray(entry_ids).astype(str)
+        indices = np.asarray(indices, dtype=np.int64)
+        if not len(self.keys):
+            return np.full(len(indices), -1)
+        ranks = np.minimum(
+            np.searchsorted(self.entries, entry_ids), len(self.entries) - 1
+        )
+        keys = ranks * self.stride + indices
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = (
+            (self.entries[ranks] == entry_ids)
+            & (indices >= 0)
+            & (indices < self.stride)
+            & (self.keys[positions] == keys)
+        )
+        return np.where(found, self.rows[positions], -1)
+
+
+def pocket_lddt(path, columns, lddt_path=POCKET_LDDT_FILE, rebuild=False):
+    """
+    The poses of the LDDT table found in the SAIR file, with their entry_id,
+    index, lddt and qtmscore, their SAIR row number (row) and the SAIR
+    columns, as an Arrow table cached next to the LDDT file.
+    """
+    key = repr([file_fingerprint(lddt_path), file_fingerprint(path), columns])
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    target = os.path.join(
+        view_directory(lddt_path), f"pocket_lddt_joined-{digest}.arrow"
+    )
+    if target in LOADED and not rebuild:
+        return LOADED[target]
+    if os.path.exists(target) and not rebuild:
+        LOADED[target] = feather.read_table(target, memory_map=True)
+        return LOADED[target]
+
+    lddt = load_table("pocket_lddt", lddt_path)
+    rows = PoseIndex.load(path).lookup(
+        lddt["entry_id"].to_numpy(zero_copy_only=False), lddt["index"].to_numpy()
+    )
+    found = rows >= 0
+    lddt = lddt.select(["entry_id", "index", "lddt", "qtmscore"]).filter(found)
+    rows = rows[found]
+    # The LDDT table's own iptm and confidence_score give way to the SAIR ones
+    sair = read_rows(path, rows, columns)
+    table = lddt.append_column("row", pa.array(rows))
+    for column in columns:
+        array = pa.Array.from_pandas(sair[column])
+        if pa.types.is_dictionary(array.type):
+            # Stored as plain strings, categoricals load dictionary-encoded
+            array = array.dictionary_decode()
+        table = table.append_column(column, array)
+    write_arrow(table, target, "pocket_lddt_joined")
+    LOADED[target] = table
+    return table
+
+
+def pocket_buckets(counts, max_pockets=MAX_POCKETS):
+    """
+    Pocket counts clipped to max_pockets + 1, the ">max_pockets" bucket,
+    and the label of each bucket. Unknown counts stay NO_POCKETS.
+    """
+    counts = np.asarray(counts)
+    buckets = np.where(counts > max_pockets, max_pockets + 1, counts)
+    labels = {i: str(i) for i in range(1, max_pockets + 1)}
+    labels[max_pockets + 1] = f">{max_pockets}"
+    return buckets, labels
+
+
+if __name__ == "__main__":
+    import time
+
+    import plot_affinity
+    from common import PATH_TO_DF
+    from data import read_sair
+    from metrics import batched_metrics
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--path", default=PATH_TO_DF, help="source parquet file")
+    parser.add_argument(
+        "--pockets", default=POCKET_CLUSTERS_FILE, help="pocket clusters file"
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with open(args.pockets) as f:
+        lines = [line.strip().split("\t") for line in f.readlines()]
+    expected_table = pd.DataFrame(
+        {"protein": [l[0] for l in lines], "pockets": [int(l[1]) for l in lines]}
+    )
+    lines_time = time.perf_counter() - start
+    start = time.perf_counter()
+    table = read_text(args.pockets, LAYOUTS["pocket_clusters"])
+    arrow_time = time.perf_counter() - start
+    assert table["protein"].to_pylist() == expected_table["protein"].tolist()
+    assert (table["pockets"].to_numpy() == expected_table["pockets"].values).all()
+    print(
+        f"{len(table)} proteins: readlines {lines_time * 1e3:.1f} ms, "
+        f"arrow {arrow_time * 1e3:.1f} ms"
+    )
+
+    df = read_sair(
+        args.path, [PROTEIN_COLUMN, "source", "all_passed"] + plot_affinity.COLUMNS
+    )
+    start = time.perf_counter()
+    merged = df[[PROTEIN_COLUMN]].merge(
+        expected_table.drop_duplicates("protein"),
+        how="left",
+        left_on=PROTEIN_COLUMN,
+        right_on="protein",
+    )
+    expected = merged["pockets"].fillna(NO_POCKETS).astype(int).values
+    merge_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = PocketIndex.load(args.pockets)
+    counts = index.join(df)
+    index_time = time.perf_counter() - start
+    assert (counts == expected).all()
+    print(
+        f"Join onto {len(df)} rows: pandas merge {merge_time * 1e3:.0f} ms, "
+        f"pocket index {index_time * 1e3:.0f} ms"
+    )
+
+    buckets, labels = pocket_buckets(counts)
+    protein_buckets, _ = pocket_buckets(index.pockets)
+    chembl = (df["source"] == "ChEMBL").values
+    masks = np.array([(buckets == bucket) & chembl for bucket in labels])
+    spearman = batched_metrics(
+        plot_affinity.score_matrix(df), df["potency"].values, masks
+    )[:, :, 0]
+    rows = []
+    for i, (bucket, label) in enumerate(labels.items()):
+        in_bucket = buckets == bucket
+        rows.append(
+            {
+                "Pockets": label,
+                "Proteins": int((protein_buckets == bucket).sum()),
+                "Rows": int(in_bucket.sum()),
+                "Passed %": df["all_passed"][in_bucket].eq(True).mean() * 100,
+                **dict(zip(plot_affinity.methods_info, spearman[i])),
+            }
+        )
+    print("By distinct pockets of the protein: pass rate, Spearman on ChEMBL")
+    print(pd.DataFrame(rows).to_string(index=False, float_format="%.3f"))
@@ -1,52 +1,73 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+from common import PATH_TO_DF, Session, register_figure
 from matplotlib.ticker import PercentFormatter
+from rendering import figure_style, save_figure, save_table
+from sequences import sequence_stats
 
-plt.rcParams["font.family"] = "serif"
-plt.rcParams["text.usetex"] = True
-plt.rcParams["font.serif"] = ["Computer Modern Roman"]
-plt.rcParams.update({"font.size": 11})
-
-# Read the data
-df = pd.read_csv("data/correct_unique_sequences.csv")
-df["seq_len"] = df["input_receptor"].str.len()
-df.to_csv("data/with_count_unique_seqs.csv", index=False)
-
-# Frequency of sequence lengths
-freq = df["seq_len"].value_counts().sort_index()
-freq_df = freq.reset_index()
-freq_df.columns = ["seq_len", "frequency"]
-freq_df.to_csv("data/seq_len_frequency.csv", index=False)
-
-bins = 50
-hist, bin_edges = np.histogram(df["seq_len"], bins=bins)
-# Convert frequency to percentage
-hist_percentage = hist / hist.sum()  # * 100
-
-dark_blue = "#4882b4"
-
-plt.figure(figsize=(6, 4))
-for i in range(len(hist)):
-    plt.bar(
-        (bin_edges[i] + bin_edges[i + 1]) / 2,
-        hist_percentage[i],
-        width=bin_edges[i + 1] - bin_edges[i],
-        color=dark_blue,
-        align="center",
-        edgecolor="black",  # Add black outline
-        linewidth=1,  # Set outline thickness
-    )
-
-plt.gca().yaxis.set_major_formatter(PercentFormatter(1, decimals=0))
-
-plt.xlabel(r"Sequence Length")
-plt.ylabel(r"Frequency")
-
-# Set serif font for all tick labels and axes labels
-plt.xticks(fontsize=11, fontfamily="serif")
-plt.yticks(fontsize=11, fontfamily="serif")
-
-plt.tight_layout()
-plt.savefig("figs/seq_len_histogram_percentage.png", dpi=600, bbox_inches="tight")
-plt.close()
+RC_PARAMS = {"font.size": 11}  # on top of the rendering profile
+
+
+def compute_figure_data(session):
+    # Lengths of the distinct receptor sequences of the dataset
+    seq_len = sequence_stats(PATH_TO_DF).sequences["length"].to_numpy()
+
+    # Frequency of sequence lengths
+    lengths, frequency = np.unique(seq_len, return_counts=True)
+    freq_df = pd.DataFrame({"seq_len": lengths, "frequency": frequency})
+    return {"seq_len": seq_len, "freq_df": freq_df}
+
+
+def render_figure(data):
+    # Written here so it is refreshed when the data comes from the cache
+    save_table(data["freq_df"], "data/seq_len_frequency.csv", index=False)
+
+    seq_len = data["seq_len"]
+    bins = 50
+    hist, bin_edges = np.histogram(seq_len, bins=bins)
+    # Convert frequency to percentage
+    hist_percentage = hist / hist.sum()  # * 100
+
+    dark_blue = "#4882b4"
+
+    with figure_style(RC_PARAMS):
+        plt.figure(figsize=(6, 4))
+        for i in range(len(hist)):
+            plt.bar(
+                (bin_edges[i] + bin_edges[i + 1]) / 2,
+                hist_percentage[i],
+                width=bin_edges[i + 1] - bin_edges[i],
+                color=dark_blue,
+                align="center",
+                edgecolor="black",  # Add black outline
+                linewidth=1,  # Set outline thickness
+            )
+
+        plt.gca().yaxis.set_major_formatter(PercentFormatter(1, decimals=0))
+
+        plt.xlabel(r"Sequence Length")
+        plt.ylabel(r"Frequency")
+
+        # Set serif font for all tick labels and axes labels
+        plt.xticks(fontsize=11, fontfamily="serif")
+        plt.yticks(fontsize=11, fontfamily="serif")
+
+        plt.tight_layout()
+        save_figure("figs/seq_len_histogram_percentage.png")
+        plt.close()
+
+
+register_figure(
+    "seq_len",
+    compute_figure_data,
+    render_figure,
+    inputs=[PATH_TO_DF],
+    outputs=[
+        "figs/seq_len_histogram_percentage.png",
+        "data/seq_len_frequency.csv",
+    ],
+)
+
+if __name__ == "__main__":
+    render_figure(compute_figure_data(Session()))
@@ -0,0 +1,409 @@
+"""
+Incremental comparison of SAIR releases.
+
+fingerprints() hashes every row of a release in one streaming pass: a
+64-bit hash of its key (KEY_COLUMNS, as a pose is listed once per source)
+and one of the rest of its content. diff_releases() matches the sorted keys
+of two releases and classifies every row as added, removed, changed (same
+key, different content) or unchanged.
+
+The release aggregates hold, for every (source, assay, family) cell, the
+rows, the rows failing PoseBusters, a histogram of pIC50 on the cube's
+POTENCY_EDGES and the moments n, sum x, sum x^2, sum y, sum y^2 and sum xy
+of every score x against potency y, from which means, standard deviations
+and Pearson correlations follow. They are all sums, so
+load_aggregates(new, base=old) derives the aggregates of a new release from
+those of the old one by subtracting the removed and changed rows as they
+were and adding the added and changed rows as they are: only those rows are
+read, so the work after the fingerprint pass grows with the change, not
+with the release. Fingerprints and aggregates are stored with the views of
+each file (see views.py).
+
+    python releases.py                                 # v0 -> v1
+    python releases.py --old a.parquet --new b.parquet --check
+"""
+
+import argparse
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cache import file_fingerprint
+from cube import BIN_COLUMNS, POTENCY_EDGES
+from external import BATCH_ROWS, scan
+from instrument import stage
+from pockets import replace_file
+from schema import FLOAT32
+from sequences import HASH_BASE, mix64, sequence_hashes
+from views import read_rows, view_directory
+
+KEY_COLUMNS = ["entry_id", "index", "source"]
+GROUP_COLUMNS = ["source", "assay", "family"]
+SCORES = [column for column in FLOAT32 if column not in ("pIC50", "potency")]
+MOMENTS = ["n", "x", "xx", "y", "yy", "xy"]
+READ_COLUMNS = GROUP_COLUMNS + ["all_passed", "pIC50", "potency"] + SCORES
+NULL_WORD = np.uint64(0x5BD1E995A1B2C3D4)
+
+LOADED = {}  # fingerprints and aggregates read in this process, by file
+
+
+def column_words(array):
+    """
+    A 64-bit word for every value of an Arrow array, equal for equal values:
+    the bits of numbers, a hash of strings, NULL_WORD for nulls.
+    """
+    if pa.types.is_dictionary(array.type):
+        words = np.append(column_words(array.dictionary), NULL_WORD)
+        indices = array.indices.fill_null(len(array.dictionary))
+        words = words[indices.to_numpy(zero_copy_only=False)]
+    elif pa.types.is_string(array.type) or pa.types.is_large_string(array.type):
+        words = sequence_hashes(array)
+    elif pa.types.is_floating(array.type):
+        values = array.cast(pa.float64()).to_numpy(zero_copy_only=False).copy()
+        values[np.isnan(values)] = np.nan  # one NaN bit pattern
+        words = values.view(np.uint64)
+    else:
+        values = array.cast(pa.int64()).fill_null(0).to_numpy(zero_copy_only=False)
+        words = values.astype(np.uint64)
+    words[~array.is_valid().to_numpy(zero_copy_only=False)] = NULL_WORD
+    return words
+
+
+def row_hashes(batch, columns):
+    """
+    64-bit hash of the values of every row in columns. Each step of the
+    FNV-1a style combination is a bijection, so rows whose words differ in
+    a single column never collide.
+    """
+    hashes = np.zeros(batch.num_rows, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for column in columns:
+            hashes ^= column_words(batch.column(column))
+            hashes *= HASH_BASE
+    return mix64(hashes)
+
+
+class Fingerprints:
+    def __init__(self, keys, contents, rows):
+        self.keys = keys  # sorted key hashes
+        self.contents = contents  # content hash of each key's row
+        self.rows = rows  # row number of each key
+
+    @classmethod
+    @stage("aggregate")
+    def build(cls, path, batch_rows=BATCH_ROWS):
+        schema = pq.read_schema(path)
+        strings = [
+            field.name
+            for field in schema
+            if pa.types.is_string(field.type) or pa.types.is_large_string(field.type)
+        ]
+        # Read dictionary-encoded, so every distinct string is hashed once
+        parquet = pq.ParquetFile(path, read_dictionary=strings)
+        content_columns = [c for c in schema.names if c not in KEY_COLUMNS]
+        keys, contents = [], []
+        for batch in parquet.iter_batches(batch_size=batch_rows):
+            keys.append(row_hashes(batch, KEY_COLUMNS))
+            contents.append(row_hashes(batch, content_columns))
+        keys = np.concatenate(keys + [np.empty(0, np.uint64)])
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        if np.any(keys[1:] == keys[:-1]):
+            raise ValueError(f"Duplicate or colliding row keys in {path}")
+        contents = np.concatenate(contents + [np.empty(0, np.uint64)])[order]
+        return cls(keys, contents, order.astype(np.int64))
+
+    @classmethod
+    def load(cls, path, rebuild=False):
+        """
+        The row fingerprints of the release, built if missing or stale.
+        """
+        key = repr([file_fingerprint(path), KEY_COLUMNS])
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        target = os.path.join(view_directory(path), f"fingerprints-{digest}.npz")
+        if target in LOADED and not rebuild:
+            return LOADED[target]
+        if os.path.exists(target) and not rebuild:
+            with np.load(target) as f:
+                fingerprints = cls(f["keys"], f["contents"], f["rows"])
+        else:
+            fingerprints = cls.build(path)
+            replace_file(target, "fingerprints", fingerprints.save)
+        LOADED[target] = fingerprints
+        return fingerprints
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, keys=self.keys, contents=self.contents, rows=self.rows)
+
+
+class ReleaseDiff:
+    def __init__(self, removed, added, changed_old, changed_new, unchanged):
+        self.removed = removed  # rows of the old release without a match
+        self.added = added  # rows of the new release without a match
+        self.changed_old = changed_old  # changed rows, in the old release
+        self.changed_new = changed_new  # the same rows in the new release
+        self.unchanged = unchanged  # number of identical rows
+
+    def counts(self):
+        return pd.Series(
+            {
+                "added": len(self.added),
+                "removed": len(self.removed),
+                "changed": len(self.changed_new),
+                "unchanged": self.unchanged,
+            }
+        )
+
+
+def diff_releases(old, new):
+    """
+    The ReleaseDiff between two release files.
+    """
+    old, new = Fingerprints.load(old), Fingerprints.load(new)
+    positions = np.minimum(np.searchsorted(old.keys, new.keys), len(old.keys) - 1)
+    if len(old.keys):
+        found = old.keys[positions] == new.keys
+    else:
+        found = np.zeros(len(new.keys), dtype=bool)
+    matched = np.zeros(len(old.keys), dtype=bool)
+    matched[positions[found]] = True
+    changed = found.copy()
+    changed[found] = old.contents[positions[found]] != new.contents[found]
+    return ReleaseDiff(
+        removed=np.sort(old.rows[~matched]),
+        added=np.sort(new.rows[~found]),
+        changed_old=np.sort(old.rows[positions[changed]]),
+        changed_new=np.sort(new.rows[changed]),
+        unchanged=int(found.sum() - changed.sum()),
+    )
+
+
+def aggregate_columns():
+    moments = [f"{score}_{moment}" for score in SCORES for moment in MOMENTS]
+    return ["rows", "failed"] + BIN_COLUMNS + moments
+
+
+def aggregate_frame(df):
+    """
+    The aggregates of the rows of df, one row per cell.
+    """
+    df = df.reset_index(drop=True)
+    grouped = df.groupby(GROUP_COLUMNS, dropna=False, observed=True)
+    codes = grouped.ngroup().values
+    n_cells = grouped.ngroups
+
+    def total(weights):
+        return np.bincount(codes, weights=weights, minlength=n_cells)
+
+    measures = {
+        "rows": np.bincount(codes, minlength=n_cells),
+        "failed": np.bincount(
+            codes[df["all_passed"].eq(False).to_numpy(bool, na_value=False)],
+            minlength=n_cells,
+        ),
+    }
+    potency = df["pIC50"].to_numpy(np.float64, na_value=np.nan)
+    measured = ~np.isnan(potency)
+    n_bins = len(BIN_COLUMNS)
+    bins = np.clip(
+        np.searchsorted(POTENCY_EDGES, potency, side="right") - 1, 0, n_bins - 1
+    )
+    histogram = np.bincount(
+        codes[measured] * n_bins + bins[measured], minlength=n_cells * n_bins
+    ).reshape(n_cells, n_bins)
+    measures.update(zip(BIN_COLUMNS, histogram.T))
+
+    y = df["potency"].to_numpy(np.float64, na_value=np.nan)
+    for score in SCORES:
+        x = df[score].to_numpy(np.float64, na_value=np.nan)
+        pair = ~np.isnan(x) & ~np.isnan(y)
+        xp, yp = np.where(pair, x, 0), np.where(pair, y, 0)
+        measures[f"{score}_n"] = np.bincount(codes[pair], minlength=n_cells)
+        for moment, weights in zip(MOMENTS[1:], [xp, xp * xp, yp, yp * yp, xp * yp]):
+            measures[f"{score}_{moment}"] = total(weights)
+
+    cells = grouped.size().index
+    return pd.DataFrame(measures, index=cells)[aggregate_columns()]
+
+
+def combine(parts, signs=None):
+    """
+    Adds up aggregates (subtracting those with sign -1), dropping empty
+    cells.
+    """
+    signs = signs or [1] * len(parts)
+    frames = [part * sign for part, sign in zip(parts, signs) if len(part)]
+    if not frames:
+        index = pd.MultiIndex.from_tuples([], names=GROUP_COLUMNS)
+        return pd.DataFrame(columns=aggregate_columns(), index=index)
+    frame = pd.concat(frames)
+    # Categorical and string cells of different reads group together
+    frame.index = pd.MultiIndex.from_frame(frame.index.to_frame().astype(object))
+    totals = frame.groupby(level=GROUP_COLUMNS, dropna=False).sum()
+    return totals[totals["rows"] > 0]
+
+
+@stage("aggregate")
+def build_aggregates(path, batch_rows=BATCH_ROWS):
+    parts = [
+        aggregate_frame(batch)
+        for batch in scan(path, READ_COLUMNS, batch_rows=batch_rows)
+    ]
+    return combine(parts)
+
+
+@stage("aggregate")
+def aggregate_rows(path, rows):
+    """
+    The aggregates of the given rows of the file, reading one row group at
+    a time and only the row groups that hold them.
+    """
+    metadata = pq.ParquetFile(path).metadata
+    sizes = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    offsets = np.cumsum(sizes)
+    # Rows are sorted, so every row group's rows are contiguous
+    bounds = np.searchsorted(rows, offsets)
+    parts = []
+    for start, stop in zip(np.concatenate([[0], bounds[:-1]]), bounds):
+        if stop > start:
+            batch = read_rows(path, rows[start:stop], READ_COLUMNS)
+            parts.append(aggregate_frame(batch))
+    return combine(parts)
+
+
+def aggregates_path(path):
+    key = repr(
+        [
+            file_fingerprint(path),
+            GROUP_COLUMNS,
+            SCORES,
+            POTENCY_EDGES.tolist(),
+        ]
+    )
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(view_directory(path), f"release_aggregates-{digest}.parquet")
+
+
+def load_aggregates(path, base=None, rebuild=False):
+    """
+    The release aggregates of the file, built if missing or stale. With
+    base (the path of an earlier release), a missing file is derived from
+    the aggregates of base and the rows that differ.
+    """
+    target = aggregates_path(path)
+    if target in LOADED and not rebuild:
+        return LOADED[target]
+    if os.path.exists(target) and not rebuild:
+        aggregates = pd.read_parquet(target).set_index(GROUP_COLUMNS)
+        LOADED[target] = aggregates
+        return aggregates
+
+    if base is None:
+        aggregates = build_aggregates(path)
+    else:
+        diff = diff_releases(base, path)
+        aggregates = combine(
+            [
+                load_aggregates(base),
+                aggregate_rows(base, np.union1d(diff.removed, diff.changed_old)),
+                aggregate_rows(path, np.union1d(diff.added, diff.changed_new)),
+            ],
+            signs=[1, -1, 1],
+        )
+    replace_file(
+        target,
+        "release_aggregates",
+        lambda temporary: aggregates.reset_index().to_parquet(temporary, index=False),
+    )
+    LOADED[target] = aggregates
+    return aggregates
+
+
+def release_metrics(aggregates, by=None):
+    """
+    Rows, failure rate and, for every score, the mean, standard deviation
+    and Pearson correlation with potency, over all cells or per by
+    dimensions, as a long DataFrame.
+    """
+    if by:
+        grouped = aggregates.groupby(level=by, dropna=False).sum()
+    else:
+        # Summed in the same order as per group, whatever the frame's layout
+        grouped = aggregates.groupby(lambda cell: "All").sum()
+    records = []
+    for group, cell in grouped.iterrows():
+        records.append((group, "rows", "count", cell["rows"]))
+        records.append(
+            (group, "all_passed", "failure rate", cell["failed"] / cell["rows"])
+        )
+        for score in SCORES:
+            n, x, xx, y, yy, xy = (cell[f"{score}_{m}"] for m in MOMENTS)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                mean = x / n
+                var_x = xx / n - mean**2
+                var_y = yy / n - (y / n) ** 2
+                r = (xy / n - mean * y / n) / np.sqrt(var_x * var_y)
+            records.append((group, score, "mean", mean))
+            records.append((group, score, "std", np.sqrt(max(var_x, 0))))
+            records.append((group, score, "pearson", r))
+    return pd.DataFrame(records, columns=["Group", "Column", "Measure", "Value"])
+
+
+def metric_deltas(old, new, by=None):
+    """
+    release_metrics() of two releases side by side, with their difference.
+    """
+    keys = ["Group", "Column", "Measure"]
+    table = release_metrics(old, by).merge(
+        release_metrics(new, by), on=keys, how="outer", suffixes=(" old", " new")
+    )
+    table["Delta"] = table["Value new"] - table["Value old"]
+    return table
+
+
+if __name__ == "__main__":
+    import time
+
+    from common import PATH_TO_DF
+    from plot_affinity import PATH_TO_DF as PATH_TO_OLD_DF
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--old", default=PATH_TO_OLD_DF, help="earlier release")
+    parser.add_argument("--new", default=PATH_TO_DF, help="later release")
+    parser.add_argument("--by", nargs="*", help="dimensions of the delta table")
+    parser.add_argument(
+        "--check", action="store_true", help="compare with a full rebuild"
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    diff = diff_releases(args.old, args.new)
+    print(f"Diff in {time.perf_counter() - start:.2f} s")
+    print(diff.counts().to_string())
+
+    old = load_aggregates(args.old)
+    start = time.perf_counter()
+    new = load_aggregates(args.new, base=args.old, rebuild=True)
+    print(f"Incremental aggregates in {time.perf_counter() - start:.2f} s")
+    if args.check:
+        start = time.perf_counter()
+        full = build_aggregates(args.new)
+        print(f"Full aggregates in {time.perf_counter() - start:.2f} s")
+        full, new_sorted = full.sort_index(), new.sort_index()
+        assert full.index.equals(new_sorted.index)
+        assert np.allclose(full.values, new_sorted.values, rtol=1e-9, atol=1e-9)
+        counts = ["rows", "failed"] + BIN_COLUMNS
+        assert (full[counts].values == new_sorted[counts].values).all()
+        print("Incremental aggregates match the full rebuild")
+
+    table = metric_deltas(old, new, args.by)
+    changed = table[table["Delta"].abs() > 1e-12]
+    print(
+        changed.to_string(index=False, float_format="%.4f")
+        if len(changed)
+        else "No metric changed"
+    )
@@ -0,0 +1,165 @@
+"""
+Shared rendering settings for every figure.
+
+Figures draw inside figure_style(), which applies the active profile's
+rcParams plus the figure's own overrides (its font size), and save through
+save_figure(), which applies the profile's dpi and extra output formats.
+Profiles keep the figure size, fonts and font sizes, so each profile lays
+out the same figure; only the text engine and the raster resolution change:
+
+    draft        mathtext with Computer Modern, 100 dpi PNG
+    publication  LaTeX (usetex), 600 dpi PNG, optionally PDF/SVG as well
+
+The active profile is read from SAIR_PROFILE (default: publication), so it
+reaches worker processes too. LaTeX output is cached in TEX_CACHE_DIR, which
+persists across runs and is shared by all processes.
+
+    python rendering.py                    # time every profile on every figure
+    python rendering.py -p draft affinity  # one profile, one figure
+"""
+
+import argparse
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import matplotlib.pyplot as plt
+from instrument import stage
+from matplotlib.texmanager import TexManager
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+TEX_CACHE_DIR = os.environ.get(
+    "SAIR_TEX_CACHE", os.path.join(REPO_DIR, ".cache", "tex")
+)
+
+COMMON_RC = {
+    "font.family": "serif",
+    "font.serif": ["Computer Modern Roman"],
+}
+
+PROFILES = {
+    "draft": {
+        "rc": {
+            "text.usetex": False,
+            # Matplotlib's own Computer Modern, metrically close to TeX's
+            "font.serif": ["cmr10"],
+            "mathtext.fontset": "cm",
+            "axes.formatter.use_mathtext": True,
+            "axes.unicode_minus": False,
+        },
+        "dpi": 100,
+        "formats": [],
+    },
+    "publication": {
+        "rc": {"text.usetex": True},
+        "dpi": 600,
+        "formats": [],  # e.g. ["pdf", "svg"], written next to the PNG
+    },
+}
+
+DEFAULT_PROFILE = "publication"
+
+# TexManager keeps its cache under the per-user matplotlib cache by default,
+# which is missing or wiped on some nodes
+if hasattr(TexManager, "_cache_dir"):
+    TexManager._cache_dir = Path(TEX_CACHE_DIR)
+
+
+def active_profile():
+    name = os.environ.get("SAIR_PROFILE", DEFAULT_PROFILE)
+    if name not in PROFILES:
+        raise ValueError(f"Unknown profile {name!r}, expected one of {list(PROFILES)}")
+    return PROFILES[name]
+
+
+def set_profile(name, formats=None):
+    """
+    Makes name the active profile in this process and its children, with
+    formats (e.g. ["pdf"]) replacing the profile's extra output formats.
+    """
+    if name not in PROFILES:
+        raise ValueError(f"Unknown profile {name!r}, expected one of {list(PROFILES)}")
+    os.environ["SAIR_PROFILE"] = name
+    if formats is not None:
+        os.environ["SAIR_FORMATS"] = ",".join(formats)
+
+
+def output_formats(profile):
+    if "SAIR_FORMATS" in os.environ:
+        return [f for f in os.environ["SAIR_FORMATS"].split(",") if f]
+    return profile["formats"]
+
+
+@contextmanager
+def figure_style(rc=None):
+    """
+    Applies the active profile, then the figure's own rcParams overrides.
+    """
+    with plt.rc_context({**COMMON_RC, **active_profile()["rc"], **(rc or {})}):
+        with stage("draw"):
+            yield
+
+
+def save_figure(path, fig=None, **kwargs):
+    """
+    Saves the figure (default: the current one) as path at the profile's
+    dpi, plus one file per extra format with the same name.
+    """
+    profile = active_profile()
+    fig = fig or plt.gcf()
+    kwargs.setdefault("bbox_inches", "tight")
+    with stage("save"):
+        fig.savefig(path, dpi=profile["dpi"], **kwargs)
+        for extension in output_formats(profile):
+            fig.savefig(Path(path).with_suffix(f".{extension}"), **kwargs)
+
+
+def save_table(frame, path, **kwargs):
+    """
+    Writes a DataFrame as CSV to path, creating its directory, which a fresh
+    clone does not have for data/.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with stage("save"):
+        frame.to_csv(path, **kwargs)
+
+
+if __name__ == "__main__":
+    from common import Session
+    from make_plots import load_figures
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("figures", nargs="*", help="figure names (default: all)")
+    parser.add_argument(
+        "-p",
+        "--profile",
+        action="append",
+        choices=list(PROFILES),
+        help="profiles to time (default: all)",
+    )
+    args = parser.parse_args()
+
+    figures = load_figures()
+    names = args.figures or list(figures)
+    profiles = args.profile or list(PROFILES)
+
+    session = Session()
+    for name in names:
+        for path, columns, filters in figures[name].reads():
+            session.plan(path, columns, filters)
+    data = {name: figures[name].compute(session) for name in names}
+
+    timings = {}
+    for profile in profiles:
+        set_profile(profile)
+        for name in names:
+            start = time.perf_counter()
+            figures[name].render(data[name])
+            timings[name, profile] = time.perf_counter() - start
+
+    print(f"{'Figure':<20}" + "".join(f"{p + ' (s)':>18}" for p in profiles))
+    for name in names:
+        print(f"{name:<20}" + "".join(f"{timings[name, p]:>18.2f}" for p in profiles))
+    totals = [sum(timings[name, p] for name in names) for p in profiles]
+    print(f"{'Total':<20}" + "".join(f"{total:>18.2f}" for total in totals))
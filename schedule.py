@@ -0,0 +1,373 @@
+"""
+Parallel, dependency-aware figure runner.
+
+Every registered figure declares the files it reads and writes. A figure is
+out of date when one of its outputs is missing or older than its newest
+input, counting as inputs both its data files and the source of the modules
+it is built from, or when it last ran with another rendering profile, other
+extra formats or other options. A stamp file next to the outputs records
+those and the outputs the run wrote. Out-of-date figures run on a process
+pool: a figure waits for the figures that produce any of its inputs, and
+independent figures run concurrently, each worker with its own Session and
+the shared figure cache. Each worker loads its own copy of the data, so the
+pool is capped to the workers that fit in the available memory. A
+per-figure timeline and the critical path are printed at the end.
+
+    python schedule.py                  # out-of-date figures only
+    python schedule.py --force          # every figure
+    python schedule.py -j 4 affinity    # one figure on a pool of 4
+    python schedule.py --approximate    # from sketches, see sketches.py
+    python schedule.py --instrument stages.jsonl  # per-stage report
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import pyarrow.parquet as pq
+from cache import FigureCache, repo_dependencies
+from common import Session
+from instrument import enable, figure, print_summary, stage
+from make_plots import load_figures
+from rendering import (
+    DEFAULT_PROFILE,
+    PROFILES,
+    active_profile,
+    output_formats,
+    set_profile,
+)
+
+TIMELINE_WIDTH = 40
+WORKER_BYTES = 3 * 2**28  # a worker's interpreter, imports and working arrays
+LOAD_FACTOR = 2  # loaded frames over the uncompressed parquet columns
+
+
+def figure_inputs(figure):
+    modules = repo_dependencies(sys.modules[figure.compute.__module__])
+    paths = [path for path, _, _ in figure.reads()] + figure.inputs
+    return paths + [module.__file__ for module in modules]
+
+
+def run_key(memory_budget=None, approximate=False, resample=False):
+    """
+    What the outputs depend on besides the inputs.
+    """
+    return {
+        "profile": os.environ.get("SAIR_PROFILE", DEFAULT_PROFILE),
+        "formats": output_formats(active_profile()),
+        "memory_budget": memory_budget,
+        "approximate": approximate,
+        "resample": resample,
+    }
+
+
+def stamp_path(figure):
+    directory = os.path.dirname(figure.outputs[0])
+    return os.path.join(directory, f".{figure.name}.stamp")
+
+
+def write_stamp(figure, key, start):
+    """
+    Records the run key and the outputs written since start, the extra
+    formats included.
+    """
+    candidates = list(figure.outputs)
+    for path in figure.outputs:
+        if path.endswith(".png"):
+            candidates += [str(Path(path).with_suffix(f".{f}")) for f in key["formats"]]
+    # Whole seconds, for file systems with coarse timestamps
+    written = [
+        path
+        for path in candidates
+        if os.path.exists(path) and os.path.getmtime(path) >= int(start)
+    ]
+    with open(stamp_path(figure), "w") as f:
+        json.dump({"key": key, "outputs": written}, f)
+
+
+def is_up_to_date(figure, key):
+    if not figure.outputs:
+        return False
+    try:
+        with open(stamp_path(figure)) as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return False
+    outputs = stamp["outputs"]
+    if stamp["key"] != key or not outputs:
+        return False
+    if not all(os.path.exists(path) for path in outputs):
+        return False
+    # A missing input cannot be checked, so the figure reruns
+    inputs = figure_inputs(figure)
+    if not inputs or not all(os.path.exists(path) for path in inputs):
+        return False
+    newest_input = max(os.path.getmtime(path) for path in inputs)
+    return min(os.path.getmtime(path) for path in outputs) > newest_input
+
+
+def dependencies(figures):
+    """
+    For every figure, the figures writing one of the files it reads.
+    """
+    producers = {
+        os.path.normpath(path): name
+        for name, figure in figures.items()
+        for path in figure.outputs
+    }
+    return {
+        name: {
+            producers[os.path.normpath(path)]
+            for path in figure_inputs(figure)
+            if os.path.normpath(path) in producers
+        }
+        - {name}
+        for name, figure in figures.items()
+    }
+
+
+def _init_worker():
+    load_figures()
+
+
+def load_bytes(figure):
+    """
+    Estimated memory of the frames the figure loads, from the uncompressed
+    size of the parquet columns it reads.
+    """
+    total = 0
+    for path, columns, _ in figure.reads():
+        if not os.path.exists(path):
+            continue
+        metadata = pq.ParquetFile(path).metadata
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                if columns is None or column.path_in_schema in columns:
+                    total += column.total_uncompressed_size
+    return LOAD_FACTOR * total
+
+
+def available_memory():
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def memory_workers(figures):
+    # As many workers as fit if each loads the largest of the figures
+    largest = max((load_bytes(figure) for figure in figures), default=0)
+    return max(1, available_memory() // (WORKER_BYTES + largest))
+
+
+def _run_figure(name, use_cache, memory_budget, approximate, resample, n_jobs):
+    registered = load_figures()[name]
+    start = time.time()
+    session = Session(
+        memory_budget=memory_budget,
+        approximate=approximate,
+        resample=resample,
+        n_jobs=n_jobs,
+    )
+    for path, columns, filters in registered.reads():
+        session.plan(path, columns, filters)
+    with figure(name):
+        with stage("compute"):
+            if use_cache:
+                data, hit = FigureCache().compute(registered, session)
+            else:
+                data, hit = registered.compute(session), False
+        with stage("render"):
+            registered.render(data)
+    write_stamp(registered, run_key(memory_budget, approximate, resample), start)
+    return name, os.getpid(), start, time.time(), hit
+
+
+def schedule(
+    names=None,
+    force=False,
+    n_jobs=None,
+    use_cache=True,
+    memory_budget=None,
+    approximate=False,
+    resample=False,
+    figure_jobs=None,
+):
+    """
+    Runs the named (default: all) figures that are out of date, or all of
+    them with force, plus everything downstream of a figure that runs.
+    Figures that parallelise internally use figure_jobs processes each
+    (default: the cores left to each worker of the pool).
+    Returns {name: (worker pid, start, end, cache hit)} for the figures run.
+    """
+    figures = load_figures()
+    depends_on = dependencies(figures)
+    selected = names or list(figures)
+    key = run_key(memory_budget, approximate, resample)
+    pending = {
+        name for name in selected if force or not is_up_to_date(figures[name], key)
+    }
+    # Anything reading the output of a figure that reruns reruns too
+    changed = True
+    while changed:
+        changed = False
+        for name in figures:
+            if name not in pending and depends_on[name] & pending:
+                pending.add(name)
+                changed = True
+
+    n_jobs = n_jobs or os.cpu_count()
+    fit = memory_workers([figures[name] for name in pending])
+    if fit < n_jobs:
+        print(f"Running on {fit} workers, as many as fit in the available memory")
+    n_workers = min(n_jobs, fit)
+    figure_jobs = figure_jobs or max(1, os.cpu_count() // n_workers)
+    results = {}
+    with ProcessPoolExecutor(n_workers, initializer=_init_worker) as pool:
+        running = {}
+        while pending or running:
+            waiting = pending | set(running.values())
+            ready = [name for name in pending if not depends_on[name] & waiting]
+            if not ready and not running:
+                raise ValueError(f"Dependency cycle between {sorted(pending)}")
+            for name in sorted(ready):
+                pending.remove(name)
+                future = pool.submit(
+                    _run_figure,
+                    name,
+                    use_cache,
+                    memory_budget,
+                    approximate,
+                    resample,
+                    figure_jobs,
+                )
+                running[future] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                name, pid, start, end, hit = future.result()
+                results[name] = (pid, start, end, hit)
+    return results
+
+
+def critical_path(results, depends_on):
+    """
+    The chain of dependent figures with the longest total run time.
+    """
+    longest = {}
+
+    def chain(name):
+        if name not in longest:
+            _, start, end, _ = results[name]
+            before = [chain(d) for d in depends_on[name] if d in results]
+            best = max(before, key=lambda c: c[0], default=(0.0, []))
+            longest[name] = (best[0] + end - start, best[1] + [name])
+        return longest[name]
+
+    return max((chain(name) for name in results), key=lambda c: c[0])
+
+
+def print_timeline(results, depends_on, skipped):
+    if results:
+        t0 = min(start for _, start, _, _ in results.values())
+        total = max(end for _, _, end, _ in results.values()) - t0
+        scale = TIMELINE_WIDTH / max(total, 1e-9)
+        print(f"{'Figure':<20}{'Worker':>8}{'Start':>8}{'End':>8}  Timeline")
+        for name, (pid, start, end, hit) in sorted(
+            results.items(), key=lambda item: item[1][1]
+        ):
+            offset = int((start - t0) * scale)
+            width = max(1, int((end - t0) * scale) - offset)
+            bar = " " * offset + "#" * width
+            note = " (cache hit)" if hit else ""
+            print(
+                f"{name:<20}{pid:>8}{start - t0:>8.1f}{end - t0:>8.1f}"
+                f"  |{bar:<{TIMELINE_WIDTH}}|{note}"
+            )
+        length, path = critical_path(results, depends_on)
+        print(f"Critical path: {' -> '.join(path)} ({length:.1f} s of {total:.1f} s)")
+    for name in skipped:
+        print(f"{name}: up to date")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("figures", nargs="*", help="figure names (default: all)")
+    parser.add_argument(
+        "--force", action="store_true", help="rerun figures that are up to date"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="recompute every figure's data"
+    )
+    parser.add_argument(
+        "--approximate",
+        action="store_true",
+        help="compute from fixed-size sketches and samples, for the figures "
+        "that support them (see sketches.py)",
+    )
+    parser.add_argument(
+        "--resample",
+        action="store_true",
+        help="add bootstrap intervals and permutation tests, for the figures "
+        "that support them (slow)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        help="stream the parquet files out of core within this many MB, "
+        "for the figures that support it",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(PROFILES),
+        default=DEFAULT_PROFILE,
+        help="rendering profile (see rendering.py)",
+    )
+    parser.add_argument(
+        "--formats",
+        nargs="+",
+        help="extra output formats next to each PNG, e.g. pdf svg",
+    )
+    parser.add_argument(
+        "--instrument",
+        metavar="REPORT",
+        help="append per-stage timings and memory to this JSONL file "
+        "and print a summary (see instrument.py)",
+    )
+    args = parser.parse_args()
+    set_profile(args.profile, args.formats)
+    if args.instrument:
+        enable(args.instrument)
+
+    memory_budget = None
+    if args.memory_budget is not None:
+        memory_budget = int(args.memory_budget * 2**20)
+
+    # Figures that parallelise internally share the cores with the pool,
+    # unless SAIR_N_JOBS sets their processes
+    figure_jobs = os.environ.get("SAIR_N_JOBS")
+    depends_on = dependencies(load_figures())
+    results = schedule(
+        args.figures,
+        force=args.force,
+        n_jobs=args.jobs,
+        use_cache=not args.no_cache,
+        memory_budget=memory_budget,
+        approximate=args.approximate,
+        resample=args.resample,
+        figure_jobs=figure_jobs and int(figure_jobs),
+    )
+    skipped = [name for name in args.figures or load_figures() if name not in results]
+    print_timeline(results, depends_on, skipped)
+    if args.instrument:
+        print_summary()
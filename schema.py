@@ -0,0 +1,191 @@
+"""
+Compact in-memory schema of the SAIR columns.
+
+With the default conversions, strings load as one pandas string per row,
+scores as float64, and the PoseBusters checks with missing values as object
+columns of True, False and None. read_sair() and views.read_rows() load
+every column in its compact type instead:
+
+    CATEGORICAL  low-cardinality strings, read dictionary-encoded from the
+                 parquet file and loaded as categoricals whose categories
+                 are sorted, so sorting and grouping order is unchanged
+    FLOAT32      scores, narrowed to float32 only when every value survives
+                 the round trip, so results never change
+    INTEGERS     small integers, narrowed when every value fits
+    checks       booleans with missing values as nullable booleans (those
+                 without stay numpy booleans)
+
+Filters are applied by pyarrow before the conversion, so they see the
+values as stored. rewrite() writes a file in the compact types, whose
+dictionary columns then load without re-encoding.
+
+    python schema.py                               # footprint, default vs compact
+    python schema.py --rewrite sair_compact.parquet
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+CATEGORICAL = [
+    "entry_id",
+    "source",
+    "assay",
+    "family",
+    "protein_id",
+    "input_receptor",
+]
+FLOAT32 = [
+    "pIC50",
+    "potency",
+    "vina_score",
+    "vina_score_min",
+    "vinardo_score",
+    "onionnet_score",
+    "aevplig_score",
+    "ptm",
+    "iptm",
+    "complex_ipde",
+    "complex_pde",
+    "complex_iplddt",
+    "complex_plddt",
+    "confidence_score",
+    "chains_ptm",
+    "interaction_ptm",
+]
+INTEGERS = {"index": pa.int8()}
+
+
+def dictionary_columns(columns=None):
+    """
+    The categorical columns of a read of columns (None: every column), for
+    the read_dictionary option of pyarrow's parquet readers.
+    """
+    return [c for c in CATEGORICAL if columns is None or c in columns]
+
+
+def narrow_floats(column):
+    # float32 copy of the column, or None if a value would change
+    values = column.to_numpy()
+    narrowed = values.astype(np.float32)
+    if not np.array_equal(narrowed.astype(np.float64), values, equal_nan=True):
+        return None
+    return pa.array(narrowed, mask=column.is_null().to_numpy())
+
+
+def sort_dictionary(column):
+    # The dictionary column re-encoded on its sorted dictionary, so the
+    # categories of the loaded frame sort like the strings did
+    column = column.unify_dictionaries() if column.num_chunks > 1 else column
+    # Nothing to sort without chunks or values, e.g. all missing
+    if column.num_chunks == 0 or len(column.chunk(0).dictionary) == 0:
+        return column
+    dictionary = column.chunk(0).dictionary
+    order = pc.sort_indices(dictionary).to_numpy()
+    ranks = np.empty(len(order), dtype=np.int32)
+    ranks[order] = np.arange(len(order), dtype=np.int32)
+    dictionary = dictionary.take(order)
+    chunks = []
+    for chunk in column.chunks:
+        indices = chunk.indices.fill_null(0).to_numpy(zero_copy_only=False)
+        indices = pa.array(ranks[indices], mask=chunk.is_null().to_numpy(False))
+        chunks.append(pa.DictionaryArray.from_arrays(indices, dictionary))
+    return pa.chunked_array(chunks, type=chunks[0].type)
+
+
+def compact_table(table):
+    """
+    The Arrow table with every column cast to its compact type, where the
+    values allow it.
+    """
+    for i, name in enumerate(table.column_names):
+        column = table.column(i)
+        if name in CATEGORICAL:
+            if not pa.types.is_dictionary(column.type):
+                column = pc.dictionary_encode(column)
+            column = sort_dictionary(column)
+        elif name in FLOAT32 and pa.types.is_float64(column.type):
+            column = narrow_floats(column)
+            if column is None:
+                continue
+        elif name in INTEGERS and pa.types.is_integer(column.type):
+            try:
+                column = column.cast(INTEGERS[name])
+            except pa.ArrowInvalid:
+                continue  # out of range
+        else:
+            continue
+        table = table.set_column(i, name, column)
+    return table
+
+
+def to_pandas(table):
+    """
+    DataFrame of a compact table, see compact_table().
+    """
+    df = table.to_pandas(types_mapper={pa.bool_(): pd.BooleanDtype()}.get)
+    for name in df.columns:
+        if isinstance(df[name].dtype, pd.BooleanDtype) and not df[name].hasnans:
+            df[name] = df[name].to_numpy(dtype=bool)
+    return df
+
+
+def rewrite(path, target):
+    """
+    Writes the parquet file at path to target in the compact types.
+    """
+    table = pq.read_table(path, read_dictionary=dictionary_columns())
+    pq.write_table(compact_table(table), target)
+
+
+def footprint(df):
+    # Bytes per column, strings included
+    return df.memory_usage(deep=True, index=False)
+
+
+if __name__ == "__main__":
+    import time
+
+    from common import PATH_TO_DF
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--path", default=PATH_TO_DF, help="source parquet file")
+    parser.add_argument("--rewrite", help="write a compact copy of the file here")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    default = pq.read_table(args.path).to_pandas()
+    default_time = time.perf_counter() - start
+    start = time.perf_counter()
+    compact = to_pandas(
+        compact_table(pq.read_table(args.path, read_dictionary=dictionary_columns()))
+    )
+    compact_time = time.perf_counter() - start
+
+    report = pd.DataFrame(
+        {
+            "default": default.dtypes.astype(str),
+            "default MB": footprint(default) / 1e6,
+            "compact": compact.dtypes.astype(str),
+            "compact MB": footprint(compact) / 1e6,
+        }
+    )
+    report.loc["total"] = [
+        "",
+        report["default MB"].sum(),
+        "",
+        report["compact MB"].sum(),
+    ]
+    print(report.to_string(float_format="%.2f"))
+    print(
+        f"{len(default)} rows loaded in {default_time:.2f} s (default), "
+        f"{compact_time:.2f} s (compact)"
+    )
+
+    if args.rewrite:
+        rewrite(args.path, args.rewrite)
+        print(f"Compact copy written to {args.rewrite}")
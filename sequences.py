@@ -0,0 +1,301 @@
+"""
+Receptor sequence statistics with Arrow kernels.
+
+sequence_stats() streams a column of protein sequences in record batches,
+from the receptor column of a SAIR parquet file (read dictionary-encoded,
+so repeated sequences are never materialized) or from a CSV of sequences.
+Each batch is dictionary-encoded, and only its distinct sequences are
+hashed: a 64-bit polynomial hash over the string bytes, computed with numpy
+straight on the Arrow buffers. The hashes give every distinct sequence of
+the file one code, kept in first-appearance order, and the rows sharing a
+code are exact duplicates (matching hashes are checked against the stored
+sequence). Lengths and amino-acid counts come from Arrow kernels, once per
+distinct sequence.
+
+The results are stored with the views of the source file (see views.py):
+an Arrow IPC file of the distinct sequences with their hash, length, first
+row, number of rows and amino-acid counts, and a .npy of the code of every
+row, both named after a fingerprint of the source and of the column.
+
+    python sequences.py                      # the receptors of the default file
+    python sequences.py --csv sequences.csv  # a CSV of sequences
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as csv
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from cache import file_fingerprint
+from common import TARGET_COLUMN
+from external import BATCH_ROWS
+from instrument import stage
+from views import view_directory
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+HASH_BASE = np.uint64(0x100000001B3)  # FNV-1a prime, odd
+
+LOADED = {}  # stats read in this process, by file
+
+
+def sequence_hashes(array):
+    """
+    64-bit hash of every string of an Arrow string array, 0 for nulls.
+    """
+    array = array.cast(pa.large_string())
+    n = len(array)
+    offsets = np.frombuffer(array.buffers()[1], dtype=np.int64)
+    offsets = offsets[array.offset : array.offset + n + 1]
+    data = array.buffers()[2]
+    data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.empty(0)
+    data = data[offsets[0] : offsets[-1]].astype(np.uint64)
+    starts = offsets[:-1] - offsets[0]
+    lengths = np.diff(offsets)
+
+    # Byte j of a string of length L weighs HASH_BASE ** (L - 1 - j)
+    powers = np.cumprod(
+        np.full(int(lengths.max(initial=0)), HASH_BASE, dtype=np.uint64)
+    )
+    powers = np.concatenate([[np.uint64(1)], powers])
+    exponents = np.repeat(starts + lengths, lengths) - 1 - np.arange(len(data))
+    with np.errstate(over="ignore"):
+        terms = data * powers[exponents]
+        hashes = np.zeros(n, dtype=np.uint64)
+        filled = lengths > 0
+        hashes[filled] = np.add.reduceat(terms, starts[filled])
+        # Mixes in the length
+        hashes ^= lengths.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    hashes = mix64(hashes)
+    hashes[~array.is_valid().to_numpy(zero_copy_only=False)] = 0
+    return hashes
+
+
+def mix64(hashes):
+    """
+    The splitmix64 finalizer of an array of uint64, in place.
+    """
+    with np.errstate(over="ignore"):
+        hashes ^= hashes >> np.uint64(30)
+        hashes *= np.uint64(0xBF58476D1CE4E5B9)
+        hashes ^= hashes >> np.uint64(27)
+        hashes *= np.uint64(0x94D049BB133111EB)
+        hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+def read_batches(path, column, batch_rows=BATCH_ROWS):
+    """
+    The column as dictionary-encoded Arrow arrays, batch by batch.
+    """
+    if path.endswith(".parquet"):
+        batches = pq.ParquetFile(path, read_dictionary=[column]).iter_batches(
+            batch_size=batch_rows, columns=[column]
+        )
+    else:
+        batches = csv.open_csv(
+            path,
+            read_options=csv.ReadOptions(use_threads=True),
+            convert_options=csv.ConvertOptions(
+                column_types={column: pa.string()}, include_columns=[column]
+            ),
+        )
+    for batch in batches:
+        array = batch.column(column)
+        if not pa.types.is_dictionary(array.type):
+            array = pc.dictionary_encode(array)
+        yield array
+
+
+class SequenceStats:
+    def __init__(self, sequences, codes):
+        self.sequences = sequences  # Arrow table, one row per distinct sequence
+        self.codes = codes  # code of every row's sequence, -1 if missing
+
+    def lengths(self):
+        """
+        Length of every row's sequence, -1 if missing.
+        """
+        lengths = self.sequences["length"].to_numpy()
+        return np.append(lengths, -1)[self.codes]
+
+    def duplicate_mask(self):
+        """
+        Rows repeating the sequence of an earlier row.
+        """
+        first = self.sequences["first_row"].to_numpy()
+        return (self.codes >= 0) & (
+            np.append(first, -1)[self.codes] != np.arange(len(self.codes))
+        )
+
+    def composition(self):
+        """
+        Fraction of each amino acid in every distinct sequence, as a
+        (n_sequences, len(AMINO_ACIDS)) array.
+        """
+        counts = np.array([self.sequences[aa].to_numpy() for aa in AMINO_ACIDS]).T
+        lengths = self.sequences["length"].to_numpy()[:, None]
+        with np.errstate(invalid="ignore"):
+            return counts / lengths
+
+
+@stage("aggregate")
+def build_stats(path, column=TARGET_COLUMN, batch_rows=BATCH_ROWS):
+    """
+    The statistics of the column in one streaming pass.
+    """
+    known = np.empty(0, dtype=np.uint64)  # sorted hashes seen so far
+    known_codes = np.empty(0, dtype=np.int64)
+    distinct = []  # chunks of distinct sequences, in code order
+    first_rows = []
+    counts = np.empty(0, dtype=np.int64)
+    codes = []
+    n_rows = 0
+    for array in read_batches(path, column, batch_rows):
+        valid = array.is_valid().to_numpy(zero_copy_only=False)
+        indices = array.indices.fill_null(0).to_numpy(zero_copy_only=False)
+        used, first = np.unique(indices[valid], return_index=True)
+        first = np.flatnonzero(valid)[first]
+        dictionary = array.dictionary.take(pa.array(used))
+        hashes = sequence_hashes(dictionary)
+
+        positions = np.minimum(np.searchsorted(known, hashes), max(len(known) - 1, 0))
+        seen = (known[positions] == hashes) if len(known) else np.zeros(len(used), bool)
+        batch_codes = np.empty(len(used), dtype=np.int64)
+        batch_codes[seen] = known_codes[positions[seen]]
+        if seen.any():
+            stored = pa.chunked_array(distinct).take(pa.array(batch_codes[seen]))
+            if not pc.all(pc.equal(dictionary.filter(pa.array(seen)), stored)).as_py():
+                raise ValueError(f"Sequence hash collision in {path}")
+
+        new = ~seen
+        # Distinct sequences hash apart, so new hashes are unique in the batch
+        new_codes = len(counts) + np.arange(new.sum())
+        batch_codes[new] = new_codes
+        distinct.append(dictionary.filter(pa.array(new)).cast(pa.large_string()))
+        first_rows.append(n_rows + first[new])
+        order = np.argsort(np.concatenate([known, hashes[new]]), kind="stable")
+        known = np.concatenate([known, hashes[new]])[order]
+        known_codes = np.concatenate([known_codes, new_codes])[order]
+
+        lookup = np.full(len(array.dictionary), -1, dtype=np.int64)
+        lookup[used] = batch_codes
+        row_codes = np.where(valid, lookup[indices], -1)
+        counts = np.append(counts, np.zeros(new.sum(), dtype=np.int64))
+        counts += np.bincount(row_codes[valid], minlength=len(counts))
+        codes.append(row_codes.astype(np.int32))
+        n_rows += len(array)
+
+    sequences = pa.chunked_array(distinct, type=pa.large_string()).combine_chunks()
+    columns = {
+        "sequence": sequences,
+        "hash": pa.array(sequence_hashes(sequences)),
+        "length": pc.utf8_length(sequences).cast(pa.int32()),
+        "first_row": pa.array(np.concatenate(first_rows + [np.empty(0, np.int64)])),
+        "rows": pa.array(counts),
+    }
+    for aa in AMINO_ACIDS:
+        columns[aa] = pc.count_substring(sequences, aa).cast(pa.int32())
+    return SequenceStats(
+        pa.table(columns), np.concatenate(codes + [np.empty(0, np.int32)])
+    )
+
+
+def stats_paths(path, column):
+    key = repr([file_fingerprint(path), column, AMINO_ACIDS])
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    directory = view_directory(path)
+    return (
+        os.path.join(directory, f"sequences-{digest}.arrow"),
+        os.path.join(directory, f"sequence_codes-{digest}.npy"),
+    )
+
+
+def sequence_stats(path, column=TARGET_COLUMN, rebuild=False):
+    """
+    The sequence statistics of the column of path, built if missing or
+    stale.
+    """
+    targets = stats_paths(path, column)
+    if targets in LOADED and not rebuild:
+        return LOADED[targets]
+    if all(os.path.exists(target) for target in targets) and not rebuild:
+        LOADED[targets] = SequenceStats(
+            feather.read_table(targets[0], memory_map=True), np.load(targets[1])
+        )
+        return LOADED[targets]
+
+    stats = build_stats(path, column)
+    directory = os.path.dirname(targets[0])
+    os.makedirs(directory, exist_ok=True)
+    for target, write in zip(
+        targets,
+        [
+            lambda f: feather.write_feather(
+                stats.sequences, f, compression="uncompressed"
+            ),
+            lambda f: np.save(f, stats.codes),
+        ],
+    ):
+        fd, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(temporary, target)
+    for entry in os.listdir(directory):
+        stale = os.path.join(directory, entry)
+        if entry.startswith("sequence") and stale not in targets:
+            os.remove(stale)
+    LOADED[targets] = stats
+    return stats
+
+
+if __name__ == "__main__":
+    import time
+
+    import pandas as pd
+    from common import PATH_TO_DF
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--path", default=PATH_TO_DF, help="source parquet file")
+    parser.add_argument("--csv", help="CSV of sequences to use instead")
+    parser.add_argument("--column", default=TARGET_COLUMN, help="sequence column")
+    args = parser.parse_args()
+    path = args.csv or args.path
+
+    start = time.perf_counter()
+    if args.csv:
+        df = pd.read_csv(path, usecols=[args.column])
+    else:
+        df = pd.read_parquet(path, columns=[args.column])
+    sequences = df[args.column]
+    lengths = sequences.str.len()
+    duplicated = sequences.duplicated() & sequences.notna()
+    unique = sequences.dropna().unique()
+    composition = np.array([[s.count(aa) for aa in AMINO_ACIDS] for s in unique])
+    pandas_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stats = build_stats(path, args.column)
+    arrow_time = time.perf_counter() - start
+
+    assert (stats.lengths() == lengths.fillna(-1).values).all()
+    assert (stats.duplicate_mask() == duplicated.values).all()
+    assert stats.sequences["sequence"].to_pylist() == list(unique)
+    counts = np.array([stats.sequences[aa].to_numpy() for aa in AMINO_ACIDS]).T
+    assert (counts == composition.reshape(counts.shape)).all()
+    print(
+        f"{len(stats.codes)} rows, {stats.sequences.num_rows} distinct sequences, "
+        f"{stats.duplicate_mask().sum()} duplicate rows: pandas "
+        f"{pandas_time * 1e3:.0f} ms, arrow {arrow_time * 1e3:.0f} ms"
+    )
+    composition = stats.composition()
+    print(
+        pd.Series(
+            np.nanmean(composition, axis=0) * 100, index=list(AMINO_ACIDS)
+        ).to_string(float_format="%.1f")
+    )
@@ -0,0 +1,484 @@
+"""
+Local analysis server that keeps SAIR resident in memory.
+
+The server loads the columns the analyses read once, in the compact schema
+(see schema.py), and keeps the session, the cubes and the computed figure
+data for its lifetime, so a request pays neither the parquet load nor the
+imports. It listens on localhost only, on a TCP port or a Unix socket.
+Requests are computed on a pool of worker threads; rendering is serialized,
+as pyplot is not thread-safe. Responses are cached by query (LRU), and
+identical requests in flight share one computation.
+
+    GET /                               the analyses and figures served
+    GET /table/<analysis>?<slice>       format=json (default), csv, png or svg
+    GET /figure/<name>?format=png|svg   a registered figure, as rendered
+    GET /run/<name>                     every output file of a figure (JSON,
+                                        base64), as client.py run writes them
+
+A slice filters the rows: column=value (column=a,b for several values) and
+where=<column><op><value>, e.g. /table/affinity?assay=cell&where=
+confidence_score>0.8. The cube-based analyses (posebusters, families,
+potency) slice on the cube's dimensions only. The data is read at start-up;
+restart the server after the files change.
+
+    python server.py                             # http://127.0.0.1:8765
+    python server.py --socket /tmp/sair.sock --workers 4
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import Callable
+from urllib.parse import parse_qsl, urlsplit
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import plot_affinity
+import plot_folder
+from cache import FigureCache
+from client import DEFAULT_PORT
+from common import PATH_TO_DF, Session
+from cube import BIN_COLUMNS, DIMENSIONS, POTENCY_EDGES, failure_columns, load_cube
+from data import OPERATORS, filter_mask
+from make_plots import load_figures
+from metrics import METRICS, batched_metrics
+from plot_posebusters import NO_RATE_CHECKS, pb_columns
+from rendering import active_profile, figure_style
+
+SLICE_COLUMNS = ["source", "assay", "family", "protein_id", "confidence_score"]
+AFFINITY_COLUMNS = list(dict.fromkeys(plot_affinity.COLUMNS + SLICE_COLUMNS))
+FOLDER_COLUMNS = list(dict.fromkeys(plot_folder.COLUMNS + SLICE_COLUMNS))
+CACHE_ENTRIES = 256  # responses kept, least recently used evicted first
+RC_PARAMS = {"font.size": 8}  # on top of the rendering profile
+
+# Longest first, so ">=" is not read as ">"
+WHERE = re.compile(
+    r"^(\w+)\s*("
+    + "|".join(re.escape(op) for op in sorted(OPERATORS, key=len, reverse=True))
+    + r")\s*(.+)$"
+)
+CONTENT_TYPES = {
+    "json": "application/json",
+    "csv": "text/csv",
+    "png": "image/png",
+    "svg": "image/svg+xml",
+}
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def parse_value(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def parse_slice(query):
+    """
+    pyarrow-style filters of the query's column=value and where= items.
+    """
+    filters = []
+    for key, value in query:
+        if key == "format":
+            continue
+        if key == "where":
+            match = WHERE.match(value)
+            if match is None:
+                raise BadRequest(f"Cannot parse where={value}")
+            column, op, value = match.groups()
+            filters.append((column, op, parse_value(value)))
+        elif "," in value:
+            filters.append((key, "in", [parse_value(v) for v in value.split(",")]))
+        else:
+            filters.append((key, "==", parse_value(value)))
+    return filters
+
+
+def check_columns(filters, columns):
+    unknown = sorted({column for column, _, _ in filters} - set(columns))
+    if unknown:
+        raise BadRequest(f"Cannot slice on {unknown}, only on {sorted(columns)}")
+
+
+def rank_metrics(df, filters, scores, names, label):
+    # Every metric of every score on the slice, in one batched pass
+    check_columns(filters, df.columns)
+    mask = filter_mask(df, filters)
+    results = batched_metrics(scores, df["potency"].values, mask[None])[0]
+    table = pd.DataFrame(results, columns=METRICS)
+    table.insert(0, label, names)
+    table.insert(1, "Rows", int(mask.sum()))
+    return table
+
+
+def affinity_table(session, filters):
+    df = session.load(plot_affinity.PATH_TO_DF, AFFINITY_COLUMNS, plot_affinity.FILTERS)
+    names = list(plot_affinity.methods_info)
+    return rank_metrics(df, filters, plot_affinity.score_matrix(df), names, "Method")
+
+
+def confidence_table(session, filters):
+    df = session.load(PATH_TO_DF, FOLDER_COLUMNS, view="deduplicated")
+    scores = df[plot_folder.metrics].values.T
+    return rank_metrics(df, filters, scores, plot_folder.metrics, "Metric")
+
+
+def cube_total(filters):
+    check_columns(filters, DIMENSIONS)
+    cube = load_cube(PATH_TO_DF)
+    cells = cube.cells[filter_mask(cube.cells, filters)]
+    if cells.empty:
+        raise BadRequest(f"No rows in the slice {filters}")
+    return cube.total(filters)
+
+
+def posebusters_table(session, filters):
+    measures = cube_total(filters)
+    failures = dict(zip(pb_columns, measures[failure_columns()]))
+    checks = [check for check in pb_columns if check not in NO_RATE_CHECKS]
+    complete = measures["failed_complete"]
+    return pd.DataFrame(
+        {
+            "Check": checks,
+            "Failures": [failures[check] for check in checks],
+            "Failure rate (%)": [
+                failures[check] / complete * 100 if complete else np.nan
+                for check in checks
+            ],
+        }
+    )
+
+
+def families_table(session, filters):
+    check_columns(filters, DIMENSIONS)
+    families = load_cube(PATH_TO_DF).rollup(["family"], filters)
+    families = families.sort_values("first_row")
+    return pd.DataFrame(
+        {
+            "Family": families.index.values,
+            "Rows": families["rows"].values,
+            "Fraction": families["rows"].values / families["rows"].sum(),
+        }
+    )
+
+
+def potency_table(session, filters):
+    counts = cube_total(filters)[BIN_COLUMNS].values.astype(np.int64)
+    used = np.flatnonzero(counts)
+    first, last = (used[0], used[-1] + 1) if len(used) else (0, 0)
+    return pd.DataFrame(
+        {
+            "pIC50 from": POTENCY_EDGES[first:last],
+            "pIC50 to": POTENCY_EDGES[first + 1 : last + 1],
+            "Entries": counts[first:last],
+        }
+    )
+
+
+def plot_bars(column, value):
+    def plot(table, ax):
+        ax.bar(table[column].astype(str), table[value])
+        ax.set_ylabel(value)
+        ax.tick_params(axis="x", labelrotation=90)
+
+    return plot
+
+
+def plot_histogram(table, ax):
+    edges = np.append(table["pIC50 from"].values, table["pIC50 to"].values[-1:])
+    ax.stairs(table["Entries"].values, edges, fill=True)
+    ax.set_xlabel(r"$- \log_{10} \left( \mathrm{IC50 [nM]} \right) $")
+    ax.set_ylabel("Entries")
+
+
+@dataclass
+class Analysis:
+    name: str
+    description: str
+    compute: Callable  # (session, filters) -> DataFrame
+    plot: Callable  # (DataFrame, Axes) -> None
+
+
+ANALYSES = {
+    analysis.name: analysis
+    for analysis in [
+        Analysis(
+            "affinity",
+            "rank metrics of every docking method against potency (ChEMBL)",
+            affinity_table,
+            plot_bars("Method", "Spearman"),
+        ),
+        Analysis(
+            "confidence",
+            "rank metrics of every confidence metric against potency",
+            confidence_table,
+            plot_bars("Metric", "Spearman"),
+        ),
+        Analysis(
+            "posebusters",
+            "failure rate of every PoseBusters check",
+            posebusters_table,
+            plot_bars("Check", "Failure rate (%)"),
+        ),
+        Analysis(
+            "families",
+            "rows per protein family",
+            families_table,
+            plot_bars("Family", "Fraction"),
+        ),
+        Analysis(
+            "potency",
+            "pIC50 histogram of the unique entries",
+            potency_table,
+            plot_histogram,
+        ),
+    ]
+}
+
+
+class AnalysisServer:
+    def __init__(self, workers=4, cache_entries=CACHE_ENTRIES):
+        self.session = Session()
+        self.figures = load_figures()
+        self.figure_cache = FigureCache()
+        self.pool = ThreadPoolExecutor(workers)
+        self.cache_entries = cache_entries
+        self.responses = OrderedDict()  # (path, query) -> (content type, body)
+        self.pending = {}  # (path, query) -> Future
+        self.lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self.figure_data = {}  # computed figure data, by name
+        self.figure_locks = defaultdict(threading.Lock)
+
+    def preload(self):
+        """
+        Loads the frames and cubes the analyses read.
+        """
+        session = self.session
+        session.plan(plot_affinity.PATH_TO_DF, AFFINITY_COLUMNS, plot_affinity.FILTERS)
+        session.plan(PATH_TO_DF, FOLDER_COLUMNS)
+        session.load(plot_affinity.PATH_TO_DF, AFFINITY_COLUMNS, plot_affinity.FILTERS)
+        session.load(PATH_TO_DF, FOLDER_COLUMNS, view="deduplicated")
+        load_cube(PATH_TO_DF)
+
+    def get(self, path, query):
+        """
+        The (content type, body) of a request, from the cache or computed
+        on the pool.
+        """
+        key = (path, tuple(sorted(query)))
+        with self.lock:
+            if key in self.responses:
+                self.responses.move_to_end(key)
+                return self.responses[key]
+            future = self.pending.get(key)
+            if future is None:
+                future = self.pool.submit(self.respond, path, query)
+                self.pending[key] = future
+        try:
+            response = future.result()
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+        with self.lock:
+            self.responses[key] = response
+            while len(self.responses) > self.cache_entries:
+                self.responses.popitem(last=False)
+        return response
+
+    def respond(self, path, query):
+        parts = [part for part in path.split("/") if part]
+        options = dict(query)
+        if not parts:
+            return "json", json.dumps(self.index(), indent=2).encode()
+        if len(parts) != 2:
+            raise BadRequest(f"Unknown path {path}")
+        kind, name = parts
+        if kind == "table":
+            return self.table(name, query, options.get("format", "json"))
+        if kind == "figure":
+            return self.figure(name, options.get("format", "png"))
+        if kind == "run":
+            outputs = self.render(name)
+            return "json", json.dumps(outputs).encode()
+        raise BadRequest(f"Unknown path {path}")
+
+    def index(self):
+        return {
+            "analyses": {a.name: a.description for a in ANALYSES.values()},
+            "figures": list(self.figures),
+            "slice columns": {
+                "affinity": AFFINITY_COLUMNS,
+                "confidence": FOLDER_COLUMNS,
+                "posebusters, families, potency": DIMENSIONS,
+            },
+        }
+
+    def table(self, name, query, format):
+        if name not in ANALYSES:
+            raise BadRequest(f"Unknown analysis {name!r}, expected {list(ANALYSES)}")
+        if format not in CONTENT_TYPES:
+            raise BadRequest(f"Unknown format {format!r}")
+        analysis = ANALYSES[name]
+        table = analysis.compute(self.session, parse_slice(query))
+        if format == "json":
+            return format, table.to_json(orient="split", index=False).encode()
+        if format == "csv":
+            return format, table.to_csv(index=False).encode()
+        with self.render_lock, figure_style(RC_PARAMS):
+            fig, ax = plt.subplots(figsize=(4, 3))
+            analysis.plot(table, ax)
+            ax.set_title(name)
+            buffer = io.BytesIO()
+            fig.savefig(
+                buffer, format=format, dpi=active_profile()["dpi"], bbox_inches="tight"
+            )
+            plt.close(fig)
+        return format, buffer.getvalue()
+
+    def compute_figure(self, name):
+        if name not in self.figures:
+            raise BadRequest(f"Unknown figure {name!r}, expected {list(self.figures)}")
+        with self.figure_locks[name]:
+            if name not in self.figure_data:
+                figure = self.figures[name]
+                data, _ = self.figure_cache.compute(figure, self.session)
+                self.figure_data[name] = data
+        return self.figure_data[name]
+
+    def render(self, name, format=None):
+        """
+        Renders the figure, as make_plots.py would, and returns its output
+        files by path, base64 encoded. With format, the figure is also
+        written in that format next to the PNG.
+        """
+        data = self.compute_figure(name)
+        figure = self.figures[name]
+        outputs = list(figure.outputs)
+        if format is not None:
+            outputs += [
+                os.path.splitext(path)[0] + f".{format}"
+                for path in figure.outputs
+                if path.endswith(".png")
+            ]
+        with self.render_lock:
+            # The only thread saving figures, so the formats are its own
+            formats = os.environ.get("SAIR_FORMATS")
+            if format is not None:
+                os.environ["SAIR_FORMATS"] = format
+            try:
+                figure.render(data)
+            finally:
+                if formats is None:
+                    os.environ.pop("SAIR_FORMATS", None)
+                else:
+                    os.environ["SAIR_FORMATS"] = formats
+            encoded = {}
+            # Optional tables, such as the comparisons without resampling,
+            # may not be written
+            for path in filter(os.path.exists, outputs):
+                with open(path, "rb") as f:
+                    encoded[path] = base64.b64encode(f.read()).decode()
+        return encoded
+
+    def figure(self, name, format):
+        if format not in ("png", "svg"):
+            raise BadRequest(f"Unknown figure format {format!r}")
+        outputs = self.render(name, format if format != "png" else None)
+        images = [path for path in outputs if path.endswith(f".{format}")]
+        if not images:
+            raise BadRequest(f"Figure {name!r} has no {format} output")
+        return format, base64.b64decode(outputs[images[0]])
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "SAIRAnalysis/1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        start = time.perf_counter()
+        try:
+            format, body = self.server.analysis.get(url.path, parse_qsl(url.query))
+            status = 200
+        except BadRequest as error:
+            format, body, status = "text", f"{error}\n".encode(), 400
+        except Exception as error:
+            format, body, status = "text", f"{error!r}\n".encode(), 500
+        self.send_response(status)
+        self.send_header("Content-Type", CONTENT_TYPES.get(format, "text/plain"))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.log_message(
+            '"%s" %d %.3f s', self.path, status, time.perf_counter() - start
+        )
+
+    def log_request(self, code="-", size="-"):
+        pass  # do_GET logs with the time taken
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(analysis, port=DEFAULT_PORT, socket_path=None):
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = UnixHTTPServer(socket_path, Handler)
+        address = f"unix:{socket_path}"
+    else:
+        # Loopback only: the server runs arbitrary slices for anyone reaching it
+        httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        address = f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.analysis = analysis
+    print(f"Serving on {address} (SAIR_SERVER={address} for client.py)", flush=True)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    from rendering import DEFAULT_PROFILE, PROFILES, set_profile
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="TCP port")
+    parser.add_argument("--socket", help="serve on this Unix socket instead")
+    parser.add_argument("--workers", type=int, default=4, help="worker threads")
+    parser.add_argument(
+        "--profile",
+        choices=list(PROFILES),
+        default=DEFAULT_PROFILE,
+        help="rendering profile (see rendering.py)",
+    )
+    args = parser.parse_args()
+    set_profile(args.profile)
+
+    start = time.perf_counter()
+    analysis = AnalysisServer(workers=args.workers)
+    analysis.preload()
+    print(f"Loaded in {time.perf_counter() - start:.1f} s", flush=True)
+    serve(analysis, args.port, args.socket)
@@ -0,0 +1,503 @@
+"""
+Mergeable sketches for the approximate mode (make_plots.py --approximate).
+
+    QuantileSketch  KLL quantile sketch, for distributions such as pocket
+                    LDDT and pIC50: quantiles, CDFs and histograms with a
+                    bound on their rank error
+    Reservoir       uniform sample of at most SAMPLE_ROWS rows (bottom-k),
+                    for the rank correlations and AUC, reported with
+                    intervals for the value on every row (sample_metrics)
+
+Both hold a fixed number of values whatever the number of rows, merge with
+merge(), and save() to a file that load() reads back, so partial results of
+separate scans can be combined. sample_strata() fills one reservoir per
+stratum (e.g. per assay) in a single streaming pass over a parquet file.
+
+The affinity, folder, potencies, families and PoseBusters figures build
+neither the views nor the summary cube (cube.py) in the approximate mode, as
+those need O(rows) memory for the row numbers of the views. The families are
+counted exactly by cube.count_rows(), which needs no views. The pIC50
+histograms and the PoseBusters failure rates deduplicate entries, which no
+row sketch can do, so they come from sample_view(): the view applied to
+every row of a sample of the entries, with ratio_error() bounds on the
+frequencies. The pocket LDDT correlations stay exact: they join the LDDT
+table onto the deduplicated view, and hold one value per pocket. The other
+figures run as in the exact mode.
+
+    SAIR_DATA_DIR=/tmp/sair python sketches.py  # approximate vs exact, see
+                                                # synthetic.py for the data
+"""
+
+import json
+import math
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from data import filter_mask
+from external import BATCH_ROWS, scan
+from metrics import METRICS, batched_metrics
+from resampling import bootstrap_replicates
+from views import VIEWS, derive
+
+SKETCH_K = 200  # values of the top level of a quantile sketch
+SAMPLE_ROWS = 2**14  # rows kept per reservoir
+CONFIDENCE = 0.99  # of the reported rank error bounds
+INTERVAL_LEVEL = 0.95  # of the intervals of metrics on samples
+SAMPLE_BOOTSTRAP = 50  # replicates for the standard errors of those metrics
+KEY_COLUMN = "sample_key"
+
+
+class QuantileSketch:
+    """
+    KLL quantile sketch (Karnin, Lang and Liberty, 2016).
+
+    Level h holds values of weight 2**h. When a level outgrows its capacity
+    it is sorted and every other value, from a random offset, moves up a
+    level. A compaction moves the rank of any value by -2**h, 0 or +2**h,
+    with mean zero, so the sketch adds up their squares and bounds the rank
+    error with Hoeffding's inequality. Capacities shrink by 2/3 per level
+    below the top, so the sketch holds O(k) values.
+    """
+
+    def __init__(self, k=SKETCH_K, seed=0):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.n = 0
+        self.variance = 0.0  # sum of the squared weights of the compactions
+        self.rng = np.random.default_rng(seed)
+
+    def capacity(self, level):
+        depth = len(self.levels) - 1 - level
+        return max(2, math.ceil(self.k * (2 / 3) ** depth))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+
+    def merge(self, other):
+        for level, values in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.n += other.n
+        self.variance += other.variance
+        self.compress()
+        return self
+
+    def compress(self):
+        while True:
+            full = [
+                level
+                for level, values in enumerate(self.levels)
+                if len(values) > self.capacity(level)
+            ]
+            if not full:
+                return
+            self.compact(full[0])
+
+    def compact(self, level):
+        values = np.sort(self.levels[level])
+        # An odd value out stays behind
+        even = len(values) - len(values) % 2
+        kept, values = values[even:], values[:even]
+        if level + 1 == len(self.levels):
+            self.levels.append(np.empty(0))
+        promoted = values[self.rng.integers(2) :: 2]
+        self.levels[level] = kept
+        self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+        self.variance += 4.0**level
+
+    def items(self):
+        """
+        The values held, sorted, with their weights.
+        """
+        values = np.concatenate(self.levels)
+        weights = np.concatenate(
+            [np.full(len(v), 2.0**level) for level, v in enumerate(self.levels)]
+        )
+        order = np.argsort(values, kind="stable")
+        return values[order], weights[order]
+
+    def rank(self, x, inclusive=True):
+        """
+        Estimated number of values <= x (< x if not inclusive).
+        """
+        values, weights = self.items()
+        cumulative = np.concatenate([[0.0], np.cumsum(weights)])
+        side = "right" if inclusive else "left"
+        return cumulative[np.searchsorted(values, x, side=side)]
+
+    def rank_error(self, confidence=CONFIDENCE):
+        """
+        Bound on the error of one rank() estimate, in values, holding with
+        the given probability.
+        """
+        return math.sqrt(2 * self.variance * math.log(2 / (1 - confidence)))
+
+    def quantiles(self, q):
+        values, weights = self.items()
+        if not len(values):
+            return np.full(np.shape(q), np.nan)
+        cumulative = np.cumsum(weights)
+        at = np.searchsorted(cumulative, np.asarray(q) * self.n, side="left")
+        return values[np.minimum(at, len(values) - 1)]
+
+    def histogram(self, edges):
+        """
+        Estimated counts in the bins of np.histogram(values, edges), and a
+        bound on the error of each, from the rank errors of its two edges.
+        """
+        edges = np.asarray(edges, dtype=np.float64)
+        below = self.rank(edges, inclusive=False)
+        below[-1] = self.rank(edges[-1])  # the last bin is closed
+        return np.diff(below), 2 * self.rank_error()
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self.levels)
+
+    def save(self, path):
+        np.savez(
+            path,
+            values=np.concatenate(self.levels),
+            lengths=[len(values) for values in self.levels],
+            header=json.dumps(
+                {
+                    "k": self.k,
+                    "n": self.n,
+                    "variance": self.variance,
+                    "rng": self.rng.bit_generator.state,
+                }
+            ),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            header = json.loads(str(f["header"]))
+            sketch = cls(header["k"])
+            sketch.levels = np.split(f["values"], np.cumsum(f["lengths"])[:-1])
+        sketch.n = header["n"]
+        sketch.variance = header["variance"]
+        sketch.rng.bit_generator.state = header["rng"]
+        return sketch
+
+
+class Reservoir:
+    """
+    Uniform sample of the rows offered, at most size distinct keys.
+
+    Every row comes with a 64-bit key, random or a hash of its key columns,
+    and the rows with the size smallest keys are kept. The smallest keys of
+    two samples are those of their union, so reservoirs merge; rows sharing
+    a hashed key are kept or dropped together.
+    """
+
+    def __init__(self, size=SAMPLE_ROWS):
+        self.size = size
+        self.frame = None
+        self.seen = 0  # rows offered
+        self.cutoff = None  # largest key kept, once full
+
+    def update(self, frame, keys):
+        self.seen += len(frame)
+        keys = np.asarray(keys, dtype=np.uint64)
+        if self.cutoff is not None:
+            frame, keys = frame[keys <= self.cutoff], keys[keys <= self.cutoff]
+        frame = frame.assign(**{KEY_COLUMN: keys})
+        if self.frame is not None:
+            frame = pd.concat([self.frame, frame], ignore_index=True)
+        self.frame = self.trim(frame)
+
+    def merge(self, other):
+        self.seen += other.seen
+        frames = [f for f in (self.frame, other.frame) if f is not None]
+        if frames:
+            self.frame = self.trim(pd.concat(frames, ignore_index=True))
+        return self
+
+    def trim(self, frame):
+        keys = frame[KEY_COLUMN].values
+        distinct = np.unique(keys)
+        if len(distinct) >= self.size:
+            self.cutoff = distinct[self.size - 1]
+            frame = frame[keys <= self.cutoff]
+        return frame.reset_index(drop=True)
+
+    def sample(self):
+        """
+        The rows kept, without their keys.
+        """
+        if self.frame is None:
+            return pd.DataFrame()
+        return self.frame.drop(columns=KEY_COLUMN)
+
+    @property
+    def fraction(self):
+        """
+        Estimated fraction of the keys kept: the smallest keys of a uniform
+        hash or random draw, up to the largest kept, cover that much of the
+        key space.
+        """
+        return 1.0 if self.cutoff is None else (float(self.cutoff) + 1) / 2**64
+
+    @property
+    def nbytes(self):
+        return (
+            0 if self.frame is None else int(self.frame.memory_usage(deep=True).sum())
+        )
+
+    def save(self, path):
+        table = pa.Table.from_pandas(self.frame, preserve_index=False)
+        header = json.dumps({"size": self.size, "seen": self.seen})
+        pq.write_table(table.replace_schema_metadata({"reservoir": header}), path)
+
+    @classmethod
+    def load(cls, path):
+        table = pq.read_table(path)
+        header = json.loads(table.schema.metadata[b"reservoir"])
+        reservoir = cls(header["size"])
+        reservoir.seen = header["seen"]
+        reservoir.frame = reservoir.trim(table.to_pandas())
+        return reservoir
+
+
+def sample_strata(
+    path,
+    columns,
+    strata,
+    filters=None,
+    key_columns=None,
+    size=SAMPLE_ROWS,
+    seed=0,
+    batch_rows=BATCH_ROWS,
+):
+    """
+    One Reservoir per stratum (a filter list, [] for every row) of the rows
+    of the parquet file that pass filters, in one streaming pass. Rows are
+    keyed at random, or by a hash of key_columns so the rows of a key are
+    sampled together. The samples have a "row" column with the number of
+    every row among those passing filters, i.e. its file order.
+    """
+    reservoirs = [Reservoir(size) for _ in strata]
+    rng = np.random.default_rng(seed)
+    strata_columns = [column for stratum in strata for column, _, _ in stratum]
+    read = list(dict.fromkeys(columns + (key_columns or []) + strata_columns))
+    start = 0
+    for batch in scan(path, read, filters, batch_rows):
+        if key_columns is None:
+            keys = rng.integers(0, 2**64, len(batch), dtype=np.uint64)
+        else:
+            keys = pd.util.hash_pandas_object(batch[key_columns], index=False).values
+        batch = batch.assign(row=np.arange(start, start + len(batch)))
+        start += len(batch)
+        for reservoir, stratum in zip(reservoirs, strata):
+            mask = filter_mask(batch, stratum)
+            reservoir.update(batch[mask], keys[mask])
+    return reservoirs
+
+
+def sample_view(path, name, columns, key_columns=None, size=SAMPLE_ROWS):
+    """
+    The rows of a deduplicating view (see views.py) among a sample of size
+    keys of the parquet file, in file order, in one streaming pass and
+    without building the view. Keys are drawn by a hash of key_columns, by
+    default those the view deduplicates on, so every row of a sampled key is
+    there to choose from; key_columns can only be coarser. Returns the rows,
+    with their hash in KEY_COLUMN, and the fraction of the keys sampled.
+    """
+    view = VIEWS[name]
+    key_columns = key_columns or view.drop_duplicates[0]
+    read = list(dict.fromkeys(columns + view.drop_duplicates[0]))
+    if view.drop_duplicates[1] is not None:
+        read.append(view.drop_duplicates[1])
+    (reservoir,) = sample_strata(path, read, [[]], key_columns=key_columns, size=size)
+    if reservoir.frame is None:
+        return pd.DataFrame(columns=read + [KEY_COLUMN, "row"]), 1.0
+    sample = reservoir.frame.sort_values("row", ignore_index=True)
+    return derive(name, sample).reset_index(drop=True), reservoir.fraction
+
+
+def ratio_error(numerators, denominators, fraction, level=INTERVAL_LEVEL):
+    """
+    Half-width of the normal interval of the ratio of the column sums of
+    numerators to the sum of denominators, both totals per sampled key
+    (keys x ratios and keys), for a sample holding fraction of the keys:
+    the linearized variance of the ratio estimator, shrunk by the finite
+    population correction.
+    """
+    numerators = np.asarray(numerators, dtype=np.float64).reshape(len(denominators), -1)
+    denominators = np.asarray(denominators, dtype=np.float64)[:, None]
+    n = len(denominators)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = numerators.sum(axis=0) / denominators.sum()
+        residuals = numerators - ratio * denominators
+        variance = (residuals**2).sum(axis=0) * n / (n - 1) / denominators.sum() ** 2
+    z = NormalDist().inv_cdf((1 + level) / 2)
+    return z * np.sqrt(variance * max(0, 1 - fraction))
+
+
+def sample_metrics(
+    scores, potency, masks, fraction, keys=None, level=INTERVAL_LEVEL, seed=0
+):
+    """
+    batched_metrics() on a uniform sample holding fraction of the rows, or
+    of the keys for a sample drawn by key, with lower and upper bounds of the
+    value on every row. The bounds are normal intervals on the standard
+    error of SAMPLE_BOOTSTRAP bootstrap replicates of the sample, drawn per
+    key when keys (one per row) are given, since the rows of a key are
+    sampled together. They are shrunk by the finite population correction,
+    so they close when the sample holds every row.
+    """
+    scores = np.atleast_2d(scores)
+    masks = np.atleast_2d(masks)
+    potency = np.asarray(potency, dtype=np.float64)
+    results = batched_metrics(scores, potency, masks)
+    error = np.zeros_like(results)
+    if fraction < 1:
+        replicates = bootstrap_replicates(
+            scores, potency, masks, SAMPLE_BOOTSTRAP, seed=seed, keys=keys
+        )
+        half = NormalDist().inv_cdf((1 + level) / 2) * math.sqrt(1 - fraction)
+        with np.errstate(all="ignore"):
+            error = half * np.nanstd(replicates, axis=2, ddof=1)
+    floor = np.array([0.0 if metric == "AUC" else -1.0 for metric in METRICS])
+    lower = np.clip(results - error, floor, 1)
+    upper = np.clip(results + error, floor, 1)
+    # Without an error, e.g. when no replicate has both classes, the bounds
+    # are the value
+    return results, np.fmin(lower, results), np.fmax(upper, results)
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import time
+
+    import plot_affinity
+    import plot_folder
+    import pocket_confidence
+    from common import PATH_TO_DF, Session
+    from metrics import METRICS, batched_metrics
+    from pockets import POCKET_LDDT_FILE, load_table
+
+    def report(name, exact_time, approximate_time, **errors):
+        details = ", ".join(f"{key} {value}" for key, value in errors.items())
+        print(
+            f"{name:<22} exact {exact_time:6.2f} s, approximate "
+            f"{approximate_time:6.2f} s: {details}"
+        )
+
+    # pIC50 quantiles, from two partial sketches saved, loaded and merged
+    start = time.perf_counter()
+    exact = np.sort(
+        pq.read_table(PATH_TO_DF, columns=["pIC50"]).column(0).to_numpy(False)
+    )
+    exact = exact[~np.isnan(exact)]
+    exact_time = time.perf_counter() - start
+    start = time.perf_counter()
+    parts = [QuantileSketch(seed=0), QuantileSketch(seed=1)]
+    for i, batch in enumerate(scan(PATH_TO_DF, ["pIC50"])):
+        parts[i % 2].update(batch["pIC50"].values)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, f"part{i}.npz") for i in range(2)]
+        for part, path in zip(parts, paths):
+            part.save(path)
+        sketch = QuantileSketch.load(paths[0]).merge(QuantileSketch.load(paths[1]))
+    approximate_time = time.perf_counter() - start
+    q = np.linspace(0.01, 0.99, 99)
+    values = sketch.quantiles(q)
+    # Rank of each estimate against the target rank, allowing for ties
+    low = np.searchsorted(exact, values, side="left")
+    high = np.searchsorted(exact, values, side="right")
+    target = q * len(exact)
+    error = np.maximum(np.maximum(low - target, target - high), 0).max()
+    report(
+        "pIC50 quantiles",
+        exact_time,
+        approximate_time,
+        rank_error=f"{error / len(exact):.3%}",
+        bound=f"{sketch.rank_error() / sketch.n:.3%}",
+        sketch=f"{sketch.nbytes / 1e3:.1f} kB for {sketch.n} values",
+    )
+
+    # Pocket LDDT histogram
+    start = time.perf_counter()
+    lddt = load_table("pocket_lddt", POCKET_LDDT_FILE, rebuild=True)["lddt"]
+    lddt = lddt.to_numpy(zero_copy_only=False)
+    exact_time = time.perf_counter() - start
+    start = time.perf_counter()
+    sketch = pocket_confidence.lddt_sketch()
+    approximate_time = time.perf_counter() - start
+    edges = np.histogram_bin_edges(lddt, bins=50)
+    counts, bound = sketch.histogram(edges)
+    error = np.abs(counts - np.histogram(lddt, edges)[0]).max()
+    report(
+        "pocket LDDT histogram",
+        exact_time,
+        approximate_time,
+        bin_error=f"{error / len(lddt):.3%}",
+        bound=f"{bound / sketch.n:.3%}",
+    )
+
+    # Affinity metrics per bar, exact against the samples and their intervals
+    subsets = [[], [("assay", "==", "biochem")], [("assay", "==", "cell")]]
+    highconf = [("confidence_score", ">", plot_affinity.HIGH_CONFIDENCE)]
+    start = time.perf_counter()
+    df = Session().load(
+        plot_affinity.PATH_TO_DF,
+        columns=plot_affinity.COLUMNS,
+        filters=plot_affinity.FILTERS,
+    )
+    masks = np.array(
+        [
+            filter_mask(df, subset)
+            for subset in subsets + [s + highconf for s in subsets]
+        ]
+    )
+    exact = batched_metrics(plot_affinity.score_matrix(df), df["potency"].values, masks)
+    exact_time = time.perf_counter() - start
+    start = time.perf_counter()
+    results, lower, upper, _ = plot_affinity.compute_approximate(subsets)
+    approximate_time = time.perf_counter() - start
+    for m, metric in enumerate(METRICS):
+        covered = (lower[:, :, m] <= exact[:, :, m]) & (
+            exact[:, :, m] <= upper[:, :, m]
+        )
+        report(
+            f"affinity {metric}",
+            exact_time,
+            approximate_time,
+            max_error=f"{np.nanmax(np.abs(results[:, :, m] - exact[:, :, m])):.4f}",
+            mean_interval=f"{np.nanmean(upper[:, :, m] - lower[:, :, m]):.4f}",
+            covered=f"{covered.sum()}/{covered.size}",
+        )
+
+    # Confidence metrics, exact Spearman against the deduplicated sample
+    start = time.perf_counter()
+    df = Session().load(PATH_TO_DF, columns=plot_folder.COLUMNS, view="deduplicated")
+    exact = np.array(
+        plot_folder.get_spearman_results(
+            [df, df[df["assay"] == "biochem"], df[df["assay"] == "cell"]]
+        )
+    )
+    exact_time = time.perf_counter() - start
+    start = time.perf_counter()
+    data = plot_folder.compute_figure_data(Session(approximate=True))
+    approximate_time = time.perf_counter() - start
+    results = np.array(data["spearman_results"])
+    covered = (data["spearman_lower"] <= exact) & (exact <= data["spearman_upper"])
+    report(
+        "confidence Spearman",
+        exact_time,
+        approximate_time,
+        max_error=f"{np.nanmax(np.abs(results - exact)):.4f}",
+        mean_interval=f"{np.nanmean(data['spearman_upper'] - data['spearman_lower']):.4f}",
+        covered=f"{covered.sum()}/{covered.size}",
+    )
@@ -0,0 +1,223 @@
+"""
+Metrics of every method against a moving confidence threshold.
+
+Keeping the rows whose confidence exceeds a threshold keeps a prefix of the
+rows sorted by decreasing confidence, so the rows are sorted once and every
+threshold reads its metrics off that one order:
+
+    Pearson       cumulative sums of x, y, x^2, y^2 and xy
+    AUC           cumulative Mann-Whitney U: each row adds the rows of the
+                  other class before it that it outranks (ties count half),
+                  counted for all rows at once with per-row inversion counts
+    Spearman      rows per distinct value, updated as the prefix grows, give
+                  the average rank of every value; the correlation of the
+                  ranks is still one pass over the prefix per threshold
+    pass rates    cumulative counts
+
+Only the distinct prefixes are evaluated, so thresholds that keep the same
+rows cost nothing more. Pearson, AUC and the pass rates cost O(n log n) for
+all thresholds together, but Spearman costs O(thresholds x n): a row joining
+the prefix shifts the rank of every larger value, so the sum of rank
+products cannot be updated from counts alone. It remains the bulk of a sweep.
+Kendall is not swept: a joining row is concordant or not with every earlier
+row, which needs a two-dimensional count per row rather than a cumulative sum.
+
+    python sweeps.py   # checks against batched_metrics and times both
+"""
+
+import time
+
+import numpy as np
+from instrument import stage
+from metrics import ACTIVE_THRESHOLD, count_inversions, pearson
+
+SWEEP_METRICS = ["Spearman", "Pearson", "AUC"]
+
+
+def sweep_order(confidence, thresholds):
+    """
+    Rows by decreasing confidence (NaNs last) and, for every threshold, the
+    number of rows with confidence above it.
+    """
+    confidence = np.asarray(confidence, dtype=np.float64)
+    order = np.argsort(-confidence, kind="stable")
+    known = np.sort(confidence[~np.isnan(confidence)])
+    kept = len(known) - np.searchsorted(known, thresholds, side="right")
+    return order, kept
+
+
+def prefix_pearson(x, y, lengths):
+    """
+    Pearson correlation of x[:k] and y[:k] for every k in lengths.
+    """
+    # Centered on the full means, so the sums stay small
+    x = x - x.mean()
+    y = y - y.mean()
+    sums = np.zeros((len(x) + 1, 5))
+    np.cumsum(np.stack([x, y, x * x, y * y, x * y], axis=1), axis=0, out=sums[1:])
+    n = lengths.astype(np.float64)
+    sx, sy, sxx, syy, sxy = sums[lengths].T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = (sxy - sx * sy / n) / np.sqrt((sxx - sx * sx / n) * (syy - sy * sy / n))
+    return np.clip(r, -1.0, 1.0)
+
+
+def earlier_smaller(values):
+    """
+    For every element, the number of elements before it with a smaller
+    value, plus half of those with an equal one.
+    """
+    n = len(values)
+    if n == 0:
+        return np.zeros(0)
+    position = np.arange(n)
+    # Ties ranked in order of appearance, so earlier ties count as smaller
+    order = np.argsort(values, kind="stable")
+    ranks = np.empty(n, dtype=np.int64)
+    ranks[order] = position
+    greater = count_inversions(ranks, per_value=True)[0][ranks]
+    # Position of each element among its ties, i.e. its earlier ties
+    sorted_values = values[order]
+    new_value = np.ones(n, dtype=bool)
+    new_value[1:] = sorted_values[1:] != sorted_values[:-1]
+    first = np.maximum.accumulate(np.where(new_value, position, 0))
+    ties = np.empty(n)
+    ties[order] = position - first
+    return position - greater - ties / 2
+
+
+def prefix_auc(scores, labels, lengths):
+    """
+    ROC AUC of scores[:k] against labels[:k] for every k in lengths, ties
+    counted as half like sklearn.
+    """
+    position = np.arange(len(scores))
+    smaller = earlier_smaller(scores)
+    greater = position - smaller  # with the other half of the ties
+    same_smaller = np.empty(len(scores))
+    for label in (True, False):
+        rows = labels == label
+        same_smaller[rows] = earlier_smaller(scores[rows])
+    same_greater = np.cumsum(labels) - labels
+    same_greater = np.where(labels, same_greater, position - same_greater)
+    same_greater = same_greater - same_smaller
+    # A positive outranks the earlier negatives below it, a negative is
+    # outranked by the earlier positives above it
+    added = np.where(labels, smaller - same_smaller, greater - same_greater)
+    u = np.concatenate([[0.0], np.cumsum(added)])[lengths]
+    positives = np.concatenate([[0], np.cumsum(labels)])[lengths]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return u / (positives * (lengths - positives))
+
+
+def prefix_spearman(x, y, lengths):
+    """
+    Spearman correlation of x[:k] and y[:k] for every k in lengths, which
+    must be increasing. O(len(lengths) x len(x)), see the module docstring.
+    """
+    x_values = np.unique(x, return_inverse=True)[1]
+    y_values = np.unique(y, return_inverse=True)[1]
+    x_counts = np.zeros(x_values.max() + 1)
+    y_counts = np.zeros(y_values.max() + 1)
+    results = np.full(len(lengths), np.nan)
+    start = 0
+    for i, k in enumerate(lengths):
+        # Rows per distinct value, updated with the rows the prefix gained
+        x_counts += np.bincount(x_values[start:k], minlength=len(x_counts))
+        y_counts += np.bincount(y_values[start:k], minlength=len(y_counts))
+        start = k
+        if k < 2:
+            continue
+        # Average rank of each value: the rows below it plus its mid-point
+        x_ranks = np.cumsum(x_counts) - (x_counts - 1) / 2
+        y_ranks = np.cumsum(y_counts) - (y_counts - 1) / 2
+        results[i] = pearson(x_ranks[x_values[:k]], y_ranks[y_values[:k]])
+    return results
+
+
+@stage("sweep")
+def sweep_metrics(confidence, scores, potency, thresholds, threshold=ACTIVE_THRESHOLD):
+    """
+    Spearman, Pearson and AUC of every score row against potency, on the
+    rows whose confidence is above each threshold.
+
+    scores: (n_methods, n_rows) array, oriented so higher means more potent
+    potency, confidence: (n_rows,) arrays
+    thresholds: (n_thresholds,) array
+
+    Returns a (n_thresholds, n_methods, 3) array ordered as SWEEP_METRICS,
+    equal to batched_metrics on the masks confidence > threshold. Rows where
+    the score or the potency is NaN are dropped per method. Prefixes with
+    fewer than two rows or a single activity class are NaN.
+    """
+    scores = np.atleast_2d(scores)
+    potency = np.asarray(potency, dtype=np.float64)
+    order, kept = sweep_order(confidence, thresholds)
+    results = np.full((len(thresholds), len(scores), len(SWEEP_METRICS)), np.nan)
+
+    for m, method_scores in enumerate(scores):
+        valid = ~np.isnan(method_scores[order]) & ~np.isnan(potency[order])
+        rows = order[valid]
+        x = method_scores[rows].astype(np.float64)
+        y = potency[rows]
+        labels = y > threshold
+        lengths = np.concatenate([[0], np.cumsum(valid)])[kept]
+        distinct, inverse = np.unique(lengths, return_inverse=True)
+
+        positives = np.concatenate([[0], np.cumsum(labels)])[distinct]
+        usable = (distinct >= 2) & (positives > 0) & (positives < distinct)
+        if not usable.any():
+            continue
+        values = np.full((len(distinct), len(SWEEP_METRICS)), np.nan)
+        values[usable, 0] = prefix_spearman(x, y, distinct[usable])
+        values[usable, 1] = prefix_pearson(x, y, distinct[usable])
+        values[usable, 2] = prefix_auc(x, labels, distinct[usable])
+        results[:, m] = values[inverse]
+    return results
+
+
+def sweep_rates(confidence, flags, thresholds):
+    """
+    Rows kept at every threshold and the fraction of them whose flag is
+    True (1), ignoring missing (NaN) flags.
+    """
+    order, kept = sweep_order(confidence, thresholds)
+    flags = np.asarray(flags, dtype=np.float64)[order]
+    known = np.concatenate([[0], np.cumsum(~np.isnan(flags))])[kept]
+    passed = np.concatenate([[0], np.cumsum(flags == 1)])[kept]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return kept, passed / known
+
+
+if __name__ == "__main__":
+    from common import Session
+    from metrics import METRICS, batched_metrics
+    from plot_affinity import COLUMNS, FILTERS, PATH_TO_DF, score_matrix
+
+    session = Session()
+    df = session.load(PATH_TO_DF, columns=COLUMNS, filters=FILTERS)
+    scores = score_matrix(df)
+    potency = df["potency"].values
+    confidence = df["confidence_score"].values
+    thresholds = np.linspace(0, 1, 201)
+
+    start = time.perf_counter()
+    swept = sweep_metrics(confidence, scores, potency, thresholds)
+    sweep_time = time.perf_counter() - start
+
+    # Mask by mask on every tenth threshold, which is the slow part
+    checked = thresholds[::10]
+    start = time.perf_counter()
+    masked = batched_metrics(scores, potency, confidence[None] > checked[:, None])
+    masked_time = time.perf_counter() - start
+    columns = [METRICS.index(metric) for metric in SWEEP_METRICS]
+    max_diff = np.nanmax(np.abs(swept[::10] - masked[:, :, columns]))
+    same_nans = np.array_equal(np.isnan(swept[::10]), np.isnan(masked[:, :, columns]))
+
+    print(f"Rows: {len(df)}, thresholds: {len(thresholds)}")
+    print(f"Sweep:                     {sweep_time:.2f} s")
+    print(
+        f"batched_metrics per mask:  {masked_time:.2f} s for {len(checked)} "
+        f"thresholds, {masked_time / len(checked) * len(thresholds):.1f} s for all"
+    )
+    print(f"Max abs difference: {max_diff:.2e}, same NaNs: {same_nans}")
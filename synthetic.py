@@ -0,0 +1,325 @@
+"""
+Synthetic data shaped like the SAIR files, to run and benchmark the figures
+off the cluster.
+
+write_dataset() writes every input file the figures read into one
+directory, under the names they expect, so that SAIR_DATA_DIR can point at
+it (see common.data_path):
+
+    sair_v1.parquet                    SAIR rows, POSES poses per entry
+    sair_v0.parquet                    the previous release of the same rows
+    pocket_clusters.txt                distinct pockets per protein
+    subclust_pockets.csv               distinct pockets per batch
+    combined_pocket_lddt_vs_iptm.csv   pocket LDDT of some of the poses
+
+The parquet files have the column names and types of the real ones: the
+affinity scores, the confidence metrics, potency and pIC50, source, assay
+and family, entry_id and index, the PoseBusters checks and all_passed,
+protein_id and the receptor sequence. Scores track the potency, a share of
+the ChEMBL entries is repeated as BindingDB rows, and the columns that have
+missing values in the real files get them at NAN_RATES (scaled by
+nan_scale). sair_v0 lacks the entries added in v1 and has some potencies
+revised.
+
+Entries are generated in chunks, each from its own seed, so a dataset is
+reproducible and written in bounded memory at any size. A manifest records
+the parameters, and write_dataset() skips directories already holding the
+same dataset.
+
+    python synthetic.py /tmp/sair --rows 1000000
+    SAIR_DATA_DIR=/tmp/sair python make_plots.py --profile draft
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.parquet as pq
+import plot_affinity
+import plot_folder
+from plot_posebusters import pb_columns
+from sequences import AMINO_ACIDS
+
+POSES = 5
+CHUNK_ENTRIES = 2**15  # entries per chunk and row group
+MANIFEST = "_synthetic.json"
+
+SOURCES = {"ChEMBL": 0.65, "BindingDB": 0.35}
+ASSAYS = {"biochem": 0.6, "cell": 0.35, "homogenate": 0.05}  # ChEMBL only
+FAMILIES = ["kinase", "gpcr", "protease", "nuclear receptor", "ion channel", "other"]
+DUPLICATE_RATE = 0.1  # ChEMBL entries also present as BindingDB rows
+ENTRIES_PER_PROTEIN = 200
+BATCH_ENTRIES = 10  # entries per batch of predictions in subclust_pockets.csv
+LDDT_EVERY = 20  # every 20th entry has pocket LDDT scores
+NAN_RATES = {
+    "vina_score_min": 0.02,
+    "onionnet_score": 0.02,
+    "iptm": 0.02,
+    **{check: 0.01 for check in pb_columns},
+}
+CHECK_FAILURE_RATE = 0.05
+V0_NEW_EVERY = 20  # entries added in v1
+V0_REVISED_EVERY = 50  # entries whose potency changed in v1
+
+# Affinity scores other than the confidence metrics: docking scores (lower
+# is more potent) and learned ones
+DOCKING_SCORES = [
+    info["score_col"]
+    for info in plot_affinity.methods_info.values()
+    if info["negate"] and info["score_col"] not in plot_folder.metrics
+]
+LEARNED_SCORES = [
+    info["score_col"]
+    for info in plot_affinity.methods_info.values()
+    if not info["negate"] and info["score_col"] not in plot_folder.metrics
+]
+
+SCHEMA = pa.schema(
+    [
+        ("entry_id", pa.large_string()),
+        ("index", pa.int64()),
+        ("source", pa.large_string()),
+        ("assay", pa.string()),
+        ("family", pa.large_string()),
+        ("pIC50", pa.float64()),
+        ("potency", pa.float64()),
+        ("protein_id", pa.large_string()),
+        ("input_receptor", pa.large_string()),
+        *[(score, pa.float64()) for score in DOCKING_SCORES + LEARNED_SCORES],
+        *[(metric, pa.float64()) for metric in plot_folder.metrics],
+        *[(check, pa.bool_()) for check in pb_columns],
+        ("all_passed", pa.bool_()),
+    ]
+)
+
+
+def entries_for_rows(rows):
+    # Each entry has POSES rows, plus its BindingDB copy when duplicated
+    per_entry = POSES * (1 + DUPLICATE_RATE * SOURCES["ChEMBL"])
+    return max(1, round(rows / per_entry))
+
+
+def generate_proteins(n_proteins, seed):
+    """
+    protein_id, receptor sequence, family and number of distinct pockets
+    of every protein.
+    """
+    rng = np.random.default_rng([seed, 0])
+    lengths = np.clip(rng.lognormal(np.log(400), 0.5, n_proteins), 30, 2500)
+    letters = np.frombuffer(AMINO_ACIDS.encode(), dtype=np.uint8)
+    sequences = [
+        letters[rng.integers(0, len(letters), int(n))].tobytes().decode()
+        for n in lengths
+    ]
+    return pd.DataFrame(
+        {
+            "protein_id": [f"P{i}" for i in range(n_proteins)],
+            "input_receptor": sequences,
+            "family": rng.choice(FAMILIES, n_proteins),
+            "pockets": 1 + rng.poisson(6.5, n_proteins),
+        }
+    )
+
+
+def generate_chunk(first_entry, n_entries, proteins, seed, nan_scale):
+    """
+    The rows of entries first_entry .. first_entry + n_entries, as a
+    DataFrame in file order: the poses of every entry, then the BindingDB
+    copies of the duplicated entries. Also returns the entry number of
+    every row.
+    """
+    rng = np.random.default_rng([seed, 1, first_entry])
+    entries = first_entry + np.arange(n_entries)
+    # A few proteins hold most of the entries
+    weights = 1 / np.arange(1, len(proteins) + 1) ** 0.8
+    protein = rng.choice(len(proteins), n_entries, p=weights / weights.sum())
+    source = rng.choice(list(SOURCES), n_entries, p=list(SOURCES.values()))
+    assay = np.where(
+        source == "ChEMBL",
+        rng.choice(list(ASSAYS), n_entries, p=list(ASSAYS.values())),
+        None,
+    )
+    pic50 = np.round(rng.normal(6.5, 1.3, n_entries), 2)
+
+    n = n_entries * POSES
+    row_entry = np.repeat(np.arange(n_entries), POSES)
+    potency = pic50[row_entry]
+    confidence = rng.beta(4, 2, n_entries)[row_entry]
+    df = pd.DataFrame(
+        {
+            "entry_id": np.char.add("E", entries.astype(str))[row_entry],
+            "index": np.tile(np.arange(POSES), n_entries),
+            "source": source[row_entry],
+            "assay": assay[row_entry],
+            "family": proteins["family"].values[protein][row_entry],
+            "pIC50": potency,
+            "potency": potency,
+            "protein_id": proteins["protein_id"].values[protein][row_entry],
+            "input_receptor": proteins["input_receptor"].values[protein][row_entry],
+        }
+    )
+    for score in DOCKING_SCORES:
+        df[score] = np.round(-7 - 0.2 * potency + rng.normal(0, 1.2, n), 3)
+    for score in LEARNED_SCORES:
+        df[score] = np.round(0.3 * potency + rng.normal(0, 1, n), 3)
+    for metric in plot_folder.metrics:
+        value = np.clip(confidence + rng.normal(0, 0.1, n), 0, 1)
+        df[metric] = 1 - value if metric in plot_folder.negated_metrics else value
+    for column, rate in NAN_RATES.items():
+        if column not in pb_columns:
+            df.loc[rng.random(n) < rate * nan_scale, column] = np.nan
+    # A missing check counts as failed
+    passed = np.ones(n, dtype=bool)
+    for check in pb_columns:
+        values = rng.random(n) > CHECK_FAILURE_RATE
+        missing = rng.random(n) < NAN_RATES.get(check, 0) * nan_scale
+        passed &= values & ~missing
+        df[check] = pd.array(values, dtype="boolean")
+        df.loc[missing, check] = pd.NA
+    df["all_passed"] = passed
+
+    duplicated = (source == "ChEMBL") & (rng.random(n_entries) < DUPLICATE_RATE)
+    copies = df[duplicated[row_entry]].copy()
+    copies["source"] = "BindingDB"
+    copies["assay"] = None
+    row_entry = entries[row_entry]
+    return (
+        pd.concat([df, copies], ignore_index=True),
+        np.concatenate([row_entry, row_entry[duplicated[row_entry - first_entry]]]),
+    )
+
+
+def previous_release(df, entry, seed):
+    """
+    The v0 rows of a chunk of v1 rows with the given entry numbers: without
+    the entries added in v1, and with the old potency of the revised ones.
+    """
+    kept = entry % V0_NEW_EVERY != V0_NEW_EVERY - 1
+    df = df[kept].copy()
+    entry = entry[kept]
+    revised = entry % V0_REVISED_EVERY == 0
+    # The same shift for every pose of an entry
+    entries, codes = np.unique(entry[revised], return_inverse=True)
+    rng = np.random.default_rng([seed, 2, int(entry.min(initial=0))])
+    shift = rng.normal(0, 0.5, len(entries))[codes]
+    for column in ["pIC50", "potency"]:
+        df.loc[revised, column] = np.round(df.loc[revised, column] + shift, 2)
+    return df
+
+
+def write_dataset(directory, rows, seed=0, nan_scale=1.0):
+    """
+    Writes the synthetic dataset of about rows SAIR rows into directory,
+    unless it already holds it. Returns the directory.
+    """
+    manifest = {"rows": rows, "seed": seed, "nan_scale": nan_scale}
+    manifest_path = os.path.join(directory, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            if json.load(f) == manifest:
+                return directory
+    except (OSError, ValueError):
+        pass
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    n_entries = entries_for_rows(rows)
+    proteins = generate_proteins(max(1, n_entries // ENTRIES_PER_PROTEIN), seed)
+    writers = {
+        name: pq.ParquetWriter(os.path.join(directory, name), SCHEMA)
+        for name in ["sair_v1.parquet", "sair_v0.parquet"]
+    }
+    lddt_writer = None
+    try:
+        for first in range(0, n_entries, CHUNK_ENTRIES):
+            chunk, entry = generate_chunk(
+                first,
+                min(CHUNK_ENTRIES, n_entries - first),
+                proteins,
+                seed,
+                nan_scale,
+            )
+            for name, df in [
+                ("sair_v1.parquet", chunk),
+                ("sair_v0.parquet", previous_release(chunk, entry, seed)),
+            ]:
+                table = pa.Table.from_pandas(df, SCHEMA, preserve_index=False)
+                writers[name].write_table(table, row_group_size=len(table))
+
+            # Once per pose, without the BindingDB copies at the end
+            poses = chunk[entry % LDDT_EVERY == 0].drop_duplicates(
+                ["entry_id", "index"]
+            )
+            rng = np.random.default_rng([seed, 3, first])
+            lddt = pa.table(
+                {
+                    "entry_id": pa.array(poses["entry_id"], pa.string()),
+                    "index": poses["index"].values,
+                    "lddt": np.clip(
+                        poses["confidence_score"].values
+                        + rng.normal(0, 0.2, len(poses)),
+                        0,
+                        1,
+                    ),
+                    "iptm": poses["iptm"].values,
+                    "confidence_score": poses["confidence_score"].values,
+                    "qtmscore": rng.random(len(poses)),
+                }
+            )
+            if lddt_writer is None:
+                lddt_writer = csv.CSVWriter(
+                    os.path.join(directory, "combined_pocket_lddt_vs_iptm.csv"),
+                    lddt.schema,
+                )
+            lddt_writer.write_table(lddt)
+    finally:
+        for writer in writers.values():
+            writer.close()
+        if lddt_writer is not None:
+            lddt_writer.close()
+
+    proteins[["protein_id", "pockets"]].to_csv(
+        os.path.join(directory, "pocket_clusters.txt"),
+        sep="\t",
+        header=False,
+        index=False,
+    )
+    rng = np.random.default_rng([seed, 4])
+    pd.DataFrame(
+        {"numpockets": rng.integers(1, 6, max(1, n_entries // BATCH_ENTRIES))}
+    ).to_csv(os.path.join(directory, "subclust_pockets.csv"), index=False)
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    return directory
+
+
+if __name__ == "__main__":
+    import time
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("directory", help="where to write the files")
+    parser.add_argument(
+        "--rows", type=int, default=1_000_000, help="approximate SAIR rows"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--nan-scale",
+        type=float,
+        default=1.0,
+        help="multiplies the missing-value rates of NAN_RATES",
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    write_dataset(args.directory, args.rows, args.seed, args.nan_scale)
+    for name in sorted(os.listdir(args.directory)):
+        path = os.path.join(args.directory, name)
+        if os.path.isfile(path):
+            print(f"{name:<36}{os.path.getsize(path) / 1e6:>10.1f} MB")
+    print(f"Written in {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,74 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+# The modules are scripts at the repository root that import each other by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ROW_GROUP_ROWS = 700
+
+
+@pytest.fixture
+def sair_frame():
+    """
+    A small SAIR-like table: poses repeated across sources, missing assays,
+    scores with ties and NaNs, and checks with missing values.
+    """
+    rng = np.random.default_rng(0)
+    n = 3000
+    potency = np.round(rng.normal(7, 1, n) * 2) / 2  # ties, exact in float32
+    vina_score = -potency + rng.normal(0, 2, n)  # lower is better, not float32
+    vina_score[rng.random(n) < 0.1] = np.nan
+    confidence_score = np.round(rng.uniform(0, 1, n) * 8) / 8  # exact in float32
+    confidence_score[rng.random(n) < 0.1] = np.nan
+    return pd.DataFrame(
+        {
+            "entry_id": [f"entry {i}" for i in rng.integers(0, 800, n)],
+            "index": rng.integers(0, 2, n),
+            "source": rng.choice(["ChEMBL", "BindingDB", "PDBbind"], n),
+            "assay": rng.choice(["biochem", "cell", None], n),
+            "iptm": np.round(potency + rng.normal(0, 1, n), 1),  # ties
+            "vina_score": vina_score,
+            "confidence_score": confidence_score,
+            "potency": potency,
+            "all_passed": pd.array(
+                np.where(rng.random(n) < 0.1, None, rng.random(n) < 0.8),
+                dtype="boolean",
+            ),
+            "mol_pred_loaded": np.ones(n, dtype=bool),
+        }
+    )
+
+
+@pytest.fixture
+def parquet_file(tmp_path, sair_frame):
+    # Several row groups, so readers that stream them see more than one
+    path = str(tmp_path / "sair.parquet")
+    table = pa.Table.from_pandas(sair_frame, preserve_index=False)
+    pq.write_table(table, path, row_group_size=ROW_GROUP_ROWS)
+    return path
+
+
+@pytest.fixture(scope="session")
+def synthetic_dir(tmp_path_factory):
+    """
+    A small synthetic dataset (see synthetic.py) with every column and input
+    file the figures read, its parquet files in several row groups.
+    """
+    from synthetic import write_dataset
+
+    directory = write_dataset(str(tmp_path_factory.mktemp("synthetic")), 4000)
+    for name in ["sair_v0.parquet", "sair_v1.parquet"]:
+        path = os.path.join(directory, name)
+        pq.write_table(pq.read_table(path), path, row_group_size=ROW_GROUP_ROWS)
+    return directory
+
+
+@pytest.fixture
+def synthetic_file(synthetic_dir):
+    return os.path.join(synthetic_dir, "sair_v1.parquet")
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+from assemblies import AssemblyIndex
+
+
+def best_row(values):
+    # The first highest value, or the first row if all are NaN
+    if values.isna().all():
+        return values.index[0]
+    return values.index[np.nanargmax(values.values)]
+
+
+def test_reductions_match_a_groupby(sair_frame):
+    df = sair_frame.copy()
+    df.loc[::97, "entry_id"] = None  # rows of no assembly
+    df["passed"] = df["all_passed"].eq(True).fillna(False)
+    index = AssemblyIndex(df["entry_id"].values)
+
+    grouped = df.groupby("entry_id", sort=False)
+    expected = pd.DataFrame(
+        {
+            "poses": grouped.size(),
+            "any_passed": grouped["passed"].any(),
+            "all_passed": grouped["passed"].all(),
+            "first_index": grouped["index"].first(),
+            "vina_mean": grouped["vina_score"].mean(),
+            "vina_max": grouped["vina_score"].max(),
+            "best": grouped["confidence_score"].apply(best_row),
+        }
+    )
+    assert index.keys.tolist() == expected.index.tolist()
+    np.testing.assert_array_equal(index.counts(), expected["poses"])
+    passed = df["passed"].values
+    np.testing.assert_array_equal(index.any(passed), expected["any_passed"])
+    np.testing.assert_array_equal(index.all(passed), expected["all_passed"])
+    np.testing.assert_array_equal(
+        index.first(df["index"].values), expected["first_index"]
+    )
+    np.testing.assert_allclose(index.mean(df["vina_score"]), expected["vina_mean"])
+    np.testing.assert_allclose(index.max(df["vina_score"]), expected["vina_max"])
+    best = index.best(df["confidence_score"].values)
+    np.testing.assert_array_equal(best, expected["best"])
+    assert np.flatnonzero(index.best_mask(df["confidence_score"])).tolist() == sorted(
+        best
+    )
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from bitsets import BYTE_POPCOUNT, CheckBits, build_bits, popcount
+from data import filter_mask, read_sair
+from plot_posebusters import pb_columns
+
+FILTERS = [
+    None,
+    [("assay", "==", "biochem")],
+    [("assay", "!=", "cell"), ("family", "in", ["kinase", "gpcr"])],
+    [("assay", "not in", ["cell"])],
+]
+
+
+def expected_cofailures(df, filters):
+    structures = df.iloc[np.argsort(df["source"] != "ChEMBL", kind="stable")]
+    structures = structures.drop_duplicates(["entry_id", "index"])
+    subset = structures[filter_mask(structures, filters)]
+    failed = subset[subset["all_passed"].eq(False)].dropna(subset=pb_columns)
+    fails = failed[pb_columns].eq(False).values.astype(np.int64)
+    return fails.T @ fails
+
+
+@pytest.mark.parametrize("nullable", [False, True])
+@pytest.mark.parametrize("filters", FILTERS)
+def test_cofailures_match_pandas(synthetic_file, tmp_path, filters, nullable):
+    df = read_sair(synthetic_file)
+    path = synthetic_file
+    if nullable:
+        # Written from pandas, so the checks load as nullable booleans
+        path = str(tmp_path / "nullable.parquet")
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path)
+    # Batches that are not a multiple of 8 rows, so bytes span two batches
+    bits = build_bits(path, batch_rows=333)
+    path = str(tmp_path / "checks.npz")
+    bits.save(path)
+    for checks in [bits, CheckBits.read(path)]:
+        np.testing.assert_array_equal(
+            checks.cofailures(filters=filters).values,
+            expected_cofailures(df, filters),
+        )
+
+
+def test_popcount_table_matches_the_bits():
+    bits = np.random.default_rng(0).integers(0, 256, 1000, dtype=np.uint8)
+    expected = np.unpackbits(bits).sum()
+    assert popcount(bits) == expected
+    assert BYTE_POPCOUNT[bits].sum() == expected
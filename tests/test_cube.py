@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+from cube import (
+    BIN_COLUMNS,
+    DIMENSIONS,
+    POTENCY_EDGES,
+    check_columns,
+    confidence_buckets,
+    count_rows,
+    failure_columns,
+    load_cube,
+    structure_measures,
+)
+from data import read_sair
+from plot_posebusters import pb_columns
+
+
+def expected_cells(df):
+    # The measures of the cube, from the views deduplicated in memory
+    df = df.astype({"source": object, "assay": object, "family": object})
+    df["confidence_bucket"] = confidence_buckets(df["confidence_score"].values)
+    entries = df.drop_duplicates("entry_id")
+    structures = df.iloc[np.argsort(df["source"] != "ChEMBL", kind="stable")]
+    structures = structures.drop_duplicates(["entry_id", "index"])
+    failed = structures[structures["all_passed"].eq(False)]
+    complete = failed[failed[pb_columns].notna().all(axis=1)]
+
+    def by_cell(frame):
+        return frame.groupby(DIMENSIONS, dropna=False)
+
+    cells = pd.DataFrame({"rows": by_cell(df).size()})
+    cells["entries"] = by_cell(entries).size()
+    cells["structures"] = by_cell(structures).size()
+    cells["failed"] = by_cell(failed).size()
+    cells["failed_complete"] = by_cell(complete).size()
+    for check in pb_columns:
+        cells[f"{check}_failures"] = by_cell(complete)[check].apply(
+            lambda values: values.eq(False).sum()
+        )
+    counts, _ = np.histogram(entries["pIC50"], POTENCY_EDGES)
+    return cells.fillna(0).astype(np.int64), counts
+
+
+def test_cube_matches_the_views_in_memory(synthetic_file):
+    df = read_sair(synthetic_file)
+    cells, histogram = expected_cells(df)
+    cube = load_cube(synthetic_file, rebuild=True, n_jobs=2)
+
+    assert len(cube.cells) == len(cells)
+    built = cube.rollup(DIMENSIONS).reindex(cells.index)
+    pd.testing.assert_frame_equal(
+        built[cells.columns].astype(np.int64), cells, check_index_type=False
+    )
+    np.testing.assert_array_equal(cube.total()[BIN_COLUMNS], histogram)
+    assert cube.total()["pIC50_min"] == df["pIC50"].min()
+    assert cube.total()["pIC50_max"] == df["pIC50"].max()
+
+
+def test_count_rows_match_the_groups(parquet_file):
+    # Categories read back as strings in the cube
+    df = read_sair(parquet_file, ["source", "assay"]).astype(object)
+    grouped = df.assign(row=np.arange(len(df))).groupby(
+        ["source", "assay"], dropna=False
+    )["row"]
+    expected = pd.DataFrame({"rows": grouped.size(), "first_row": grouped.min()})
+
+    cube = count_rows(parquet_file, ["source", "assay"], n_jobs=2)
+    counts = cube.rollup(["source", "assay"])[["rows", "first_row"]]
+    pd.testing.assert_frame_equal(
+        counts.astype(np.int64),
+        expected.astype(np.int64),
+        check_names=False,
+        check_index_type=False,
+    )
+    assert cube.total()["rows"] == len(df)
+
+
+def test_structure_measures_skip_missing_flags():
+    checks = check_columns()
+    batch = pd.DataFrame(
+        {
+            check: pd.array([False, True, None, False], dtype="boolean")
+            for check in checks
+        }
+    )
+    batch["all_passed"] = pd.array([False, None, False, True], dtype="boolean")
+    measures = structure_measures(batch, np.array([True, True, True, False]))
+    assert measures["structures"].tolist() == [1, 1, 1, 0]
+    assert measures["failed"].tolist() == [1, 0, 1, 0]
+    # The third row misses its checks, so no check counts it
+    assert measures["failed_complete"].tolist() == [1, 0, 0, 0]
+    for column in failure_columns():
+        assert measures[column].tolist() == [1, 0, 0, 0]
@@ -0,0 +1,24 @@
+import numpy as np
+import pyarrow.parquet as pq
+import pytest
+from data import filter_mask, read_sair
+
+FILTERS = [
+    [("assay", "==", "cell")],
+    [("assay", "!=", "cell")],
+    [("assay", "in", ["biochem", "cell"])],
+    [("assay", "not in", ["cell"])],
+    [("source", "==", "ChEMBL"), ("vina_score", "<=", -7.0)],
+    [("confidence_score", ">", 0.5)],
+]
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_filter_mask_matches_pyarrow(parquet_file, filters):
+    df = read_sair(parquet_file)
+    table = pq.read_table(parquet_file, filters=filters)
+    kept = df[filter_mask(df, filters)]
+    np.testing.assert_array_equal(
+        kept["entry_id"].astype(str), table.column("entry_id").to_pylist()
+    )
+    np.testing.assert_array_equal(kept["index"], table.column("index").to_pylist())
@@ -0,0 +1,74 @@
+import numpy as np
+from data import filter_mask
+from external import external_metrics
+from metrics import ACTIVE_THRESHOLD, batched_metrics
+from scipy.stats import kendalltau, pearsonr, spearmanr
+
+SUBSETS = [[], [("assay", "==", "biochem")], [("assay", "==", "cell")]]
+PRIORITY = {"ChEMBL": 0, "BindingDB": 1}
+
+
+def in_memory(df):
+    masks = np.array([filter_mask(df, subset) for subset in SUBSETS])
+    scores = np.array([df["iptm"].values, -df["vina_score"].values])
+    return batched_metrics(scores, df["potency"].values, masks)
+
+
+def out_of_core(path, tmp_path, **kwargs):
+    # A budget of a few thousand records, so every sort spills several runs
+    return external_metrics(
+        path,
+        ["iptm", "vina_score"],
+        SUBSETS,
+        negate=[False, True],
+        memory_budget=2**14,
+        batch_rows=500,
+        directory=str(tmp_path),
+        **kwargs,
+    )
+
+
+def test_external_metrics_match_in_memory(parquet_file, sair_frame, tmp_path):
+    path, df = parquet_file, sair_frame
+    filters = [("source", "in", list(PRIORITY))]
+    results = out_of_core(path, tmp_path, filters=filters)
+    expected = in_memory(df[filter_mask(df, filters)])
+    np.testing.assert_allclose(results, expected, rtol=0, atol=1e-10)
+
+
+def test_external_deduplication_matches_pandas(parquet_file, sair_frame, tmp_path):
+    path, df = parquet_file, sair_frame
+    results = out_of_core(
+        path, tmp_path, drop_duplicates=(["entry_id", "index"], "source", PRIORITY)
+    )
+    # Per key, the row of the first source in PRIORITY, then the earliest
+    ranked = df.assign(priority=df["source"].map(PRIORITY).fillna(len(PRIORITY)))
+    kept = ranked.sort_values("priority", kind="stable").drop_duplicates(
+        ["entry_id", "index"]
+    )
+    expected = in_memory(kept.sort_index())
+    np.testing.assert_allclose(results, expected, rtol=0, atol=1e-10)
+
+
+def test_external_single_class_matches_scipy(parquet_file, sair_frame, tmp_path):
+    # Only actives: scipy still gives the correlations, AUC is undefined
+    actives = [("potency", ">", ACTIVE_THRESHOLD)]
+    results = external_metrics(
+        parquet_file,
+        ["iptm"],
+        [actives],
+        memory_budget=2**14,
+        batch_rows=500,
+        directory=str(tmp_path),
+        nan_single_class=False,
+    )[0, 0]
+    df = sair_frame[filter_mask(sair_frame, actives)]
+    x, y = df["iptm"].values, df["potency"].values
+    expected = [
+        spearmanr(x, y).correlation,
+        pearsonr(x, y)[0],
+        kendalltau(x, y).correlation,
+        np.nan,
+    ]
+    np.testing.assert_allclose(results, expected, rtol=0, atol=1e-10)
+    assert np.isnan(out_of_core(parquet_file, tmp_path, filters=actives)).all()
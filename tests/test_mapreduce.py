@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from conftest import ROW_GROUP_ROWS
+from mapreduce import map_reduce, row_group_tasks
+from plot_posebusters import (
+    ASSEMBLY_COLUMNS,
+    assembly_partial,
+    combine_assemblies,
+)
+
+
+def count_kernel(batch, start, threshold):
+    # Rows and potent rows per source, with the rows they start at
+    frame = batch.assign(row=np.arange(start, start + len(batch)))
+    frame["potent"] = frame["potency"] > threshold
+    return frame.groupby("source", observed=True).agg(
+        rows=("row", "size"), potent=("potent", "sum"), first_row=("row", "min")
+    )
+
+
+def combine_counts(parts):
+    frame = pd.concat(parts)
+    grouped = frame.groupby(level=0)
+    return pd.concat(
+        [grouped[["rows", "potent"]].sum(), grouped[["first_row"]].min()], axis=1
+    )
+
+
+def test_tasks_cover_the_row_groups(parquet_file):
+    metadata = pq.ParquetFile(parquet_file).metadata
+    tasks = row_group_tasks(parquet_file, 3)
+    assert [g for groups, _ in tasks for g in groups] == list(
+        range(metadata.num_row_groups)
+    )
+    starts = [start for _, start in tasks]
+    assert starts[0] == 0 and starts == sorted(starts)
+    assert all(start % ROW_GROUP_ROWS == 0 for start in starts)
+
+
+@pytest.mark.parametrize("n_jobs", [1, 3])
+def test_map_reduce_matches_pandas(sair_frame, parquet_file, n_jobs):
+    result = map_reduce(
+        parquet_file,
+        count_kernel,
+        combine_counts,
+        ["source", "potency"],
+        {"threshold": 7.0},
+        n_jobs=n_jobs,
+        batch_rows=300,
+    )
+    df = sair_frame.assign(row=np.arange(len(sair_frame)))
+    df["potent"] = df["potency"] > 7.0
+    expected = df.groupby("source").agg(
+        rows=("row", "size"), potent=("potent", "sum"), first_row=("row", "min")
+    )
+    pd.testing.assert_frame_equal(
+        result.astype(np.int64), expected.astype(np.int64), check_names=False
+    )
+
+
+def test_assemblies_match_a_groupby(sair_frame, parquet_file):
+    structure_rows = np.arange(0, len(sair_frame), 3)
+    assemblies = map_reduce(
+        parquet_file,
+        assembly_partial,
+        combine_assemblies,
+        ASSEMBLY_COLUMNS,
+        {"structure_rows": structure_rows},
+        n_jobs=3,
+        batch_rows=300,
+    )
+    df = sair_frame.iloc[structure_rows].assign(first_row=structure_rows)
+    df["passed"] = df["all_passed"].eq(True).fillna(False)
+    # The first pose of every entry, with whether any of them passes
+    expected = df.drop_duplicates("entry_id").set_index("entry_id")
+    expected["passed"] = df.groupby("entry_id", sort=False)["passed"].any()
+    assert assemblies["entry_id"].tolist() == expected.index.tolist()
+    np.testing.assert_array_equal(assemblies["first_row"], expected["first_row"])
+    np.testing.assert_array_equal(assemblies["passed"], expected["passed"])
+    np.testing.assert_array_equal(
+        pd.isna(assemblies["assay"]), expected["assay"].isna()
+    )
+    known = expected["assay"].notna().values
+    assert list(assemblies["assay"][known]) == list(expected["assay"][known])
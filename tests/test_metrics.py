@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from metrics import ACTIVE_THRESHOLD, METRICS, batched_metrics, count_inversions
+from scipy.stats import kendalltau, pearsonr, spearmanr
+from sklearn.metrics import roc_auc_score
+
+
+def reference(scores, potency):
+    # The scipy/sklearn loop batched_metrics replaces, on one method and subset
+    valid = ~np.isnan(scores) & ~np.isnan(potency)
+    x, y = scores[valid], potency[valid]
+    labels = y > ACTIVE_THRESHOLD
+    if len(x) < 2 or labels.all() or not labels.any():
+        return [np.nan] * len(METRICS)
+    return [
+        spearmanr(x, y).correlation,
+        pearsonr(x, y)[0],
+        kendalltau(x, y).correlation,
+        roc_auc_score(labels, x),
+    ]
+
+
+@pytest.fixture
+def frame():
+    rng = np.random.default_rng(0)
+    n = 400
+    potency = np.round(rng.normal(7, 1, n) * 2) / 2  # ties, both classes
+    scores = potency + rng.normal(0, [[0.5], [1], [3]], (3, n))
+    scores[0] = np.round(scores[0], 1)  # ties in a score
+    scores[1, rng.random(n) < 0.1] = np.nan
+    potency[rng.random(n) < 0.05] = np.nan
+    masks = np.array(
+        [
+            np.ones(n, dtype=bool),
+            rng.random(n) < 0.3,
+            np.arange(n) < 1,  # a single row
+            np.nan_to_num(potency) > ACTIVE_THRESHOLD,  # a single class
+        ]
+    )
+    return scores, potency, masks
+
+
+def test_batched_metrics_match_scipy_and_sklearn(frame):
+    scores, potency, masks = frame
+    results = batched_metrics(scores, potency, masks)
+    expected = np.array(
+        [[reference(s[mask], potency[mask]) for s in scores] for mask in masks]
+    )
+    assert results.shape == (len(masks), len(scores), len(METRICS))
+    np.testing.assert_allclose(results, expected, rtol=0, atol=1e-12)
+
+
+def test_count_inversions_matches_pairs():
+    values = np.random.default_rng(1).integers(0, 20, 300)
+    pairs = (values[:, None] > values[None, :])[np.triu_indices(len(values), 1)]
+    assert count_inversions(values) == pairs.sum()
@@ -0,0 +1,36 @@
+import pandas as pd
+import pytest
+from data import filter_mask, read_sair
+from partition import partitioned_source, write_partitioned
+from schema import rewrite
+
+COLUMNS = ["entry_id", "index", "source", "assay", "potency", "vina_score"]
+FILTERS = [
+    [("source", "==", "ChEMBL")],
+    [("source", "==", "BindingDB"), ("assay", "==", "cell")],
+    [("assay", "in", ["biochem", "cell"]), ("potency", ">", 7.0)],
+]
+
+
+def by_key(df):
+    # The copy is sorted within partitions, so rows are compared by key
+    df = df.astype({"entry_id": str, "source": str, "assay": str})
+    return df.sort_values(COLUMNS, kind="stable").reset_index(drop=True)
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_partitioned_reads_match_the_file(parquet_file, tmp_path, compact):
+    path = parquet_file
+    if compact:
+        # Dictionary-typed columns, partitioned on their values
+        path = str(tmp_path / "compact.parquet")
+        rewrite(parquet_file, path)
+    directory = write_partitioned(path, ["source", "assay"], row_group_rows=200)
+
+    for filters in FILTERS:
+        assert partitioned_source(path, filters)[0] == directory
+        expected = read_sair(parquet_file, COLUMNS)
+        expected = expected[filter_mask(expected, filters)]
+        pd.testing.assert_frame_equal(
+            by_key(read_sair(path, COLUMNS, filters)), by_key(expected)
+        )
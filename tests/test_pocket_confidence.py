@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import plot_folder
+import pyarrow as pa
+from pocket_confidence import lddt_correlations
+from scipy.stats import kendalltau, pearsonr, spearmanr
+from segments import MIN_GROUP_SIZE
+
+
+def test_lddt_correlations_match_scipy():
+    rng = np.random.default_rng(0)
+    n = 600
+    lddt = np.round(rng.uniform(0, 1, n), 2)  # ties
+    joined = {
+        "assay": rng.choice(["biochem", "cell", None], n),
+        # A family too small for its correlations
+        "family": rng.choice(["kinase", "gpcr", "other"], n, p=[0.6, 0.39, 0.01]),
+        "lddt": lddt,
+    }
+    for metric in plot_folder.metrics:
+        values = np.round(lddt + rng.normal(0, 0.5, n), 1)
+        values[rng.random(n) < 0.1] = np.nan
+        joined[metric] = values
+    df = pd.DataFrame(joined)
+    results = lddt_correlations(pa.Table.from_pandas(df, preserve_index=False))
+
+    for record in results.itertuples():
+        if record.Grouping == "All":
+            group = df
+        else:
+            group = df[df[record.Grouping] == record.Group]
+        group = group[group[record.Metric].notna()]
+        assert record.Poses == len(group)
+        for name, correlation in [
+            ("Spearman", spearmanr),
+            ("Pearson", pearsonr),
+            ("Kendall", kendalltau),
+        ]:
+            value = getattr(record, name)
+            if len(group) < MIN_GROUP_SIZE:
+                assert np.isnan(value)
+            else:
+                expected = correlation(group[record.Metric], group["lddt"])[0]
+                np.testing.assert_allclose(value, expected, rtol=0, atol=1e-10)
+    assert len(results) == (1 + 2 + 3) * len(plot_folder.metrics)
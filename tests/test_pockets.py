@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from data import read_sair
+from pockets import NO_POCKETS, PocketIndex, pocket_lddt
+
+
+def test_pocket_join_matches_a_merge():
+    table = pa.table(
+        {
+            "protein": ["P3", "P1", "P2", "P1"],  # P1 twice, the first wins
+            "pockets": pa.array([4, 7, 2, 9], pa.int32()),
+        }
+    )
+    df = pd.DataFrame({"protein_id": ["P1", "P9", None, "P3", "P1", "P2"]})
+    first = table.to_pandas().drop_duplicates("protein")
+    expected = df.merge(first, how="left", left_on="protein_id", right_on="protein")
+    expected = expected["pockets"].fillna(NO_POCKETS).astype(int)
+    np.testing.assert_array_equal(PocketIndex(table).join(df), expected)
+
+
+def test_pocket_lddt_matches_a_merge(synthetic_dir, tmp_path):
+    path = os.path.join(synthetic_dir, "sair_v1.parquet")
+    lddt = pd.read_csv(os.path.join(synthetic_dir, "combined_pocket_lddt_vs_iptm.csv"))
+    # Poses missing from the SAIR file: an unknown entry and pose index
+    lddt = pd.concat(
+        [
+            lddt.iloc[:50],
+            pd.DataFrame({"entry_id": ["E_unknown", "E0"], "index": [0, 99]}),
+            lddt.iloc[50:],
+        ]
+    ).fillna(0.5)
+    lddt_path = str(tmp_path / "pocket_lddt.csv")
+    lddt.to_csv(lddt_path, index=False)
+
+    df = read_sair(path, ["entry_id", "index", "source", "iptm"])
+    df["row"] = np.arange(len(df))
+    poses = df.iloc[np.argsort(df["source"] != "ChEMBL", kind="stable")]
+    poses = poses.drop_duplicates(["entry_id", "index"])
+    poses = poses.astype({"entry_id": str})
+    expected = lddt.drop(columns="iptm").merge(poses, on=["entry_id", "index"])
+
+    joined = pocket_lddt(path, ["iptm", "source"], lddt_path=lddt_path).to_pandas()
+    assert len(joined) == len(lddt) - 2
+    for column in ["entry_id", "index", "lddt", "row", "iptm"]:
+        np.testing.assert_array_equal(joined[column], expected[column])
+    np.testing.assert_array_equal(joined["source"].astype(str), expected["source"])
@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from conftest import ROW_GROUP_ROWS
+from releases import (
+    GROUP_COLUMNS,
+    KEY_COLUMNS,
+    build_aggregates,
+    diff_releases,
+    load_aggregates,
+    release_metrics,
+)
+
+
+def expected_diff(old, new):
+    old = old.assign(old_row=np.arange(len(old)))
+    new = new.assign(new_row=np.arange(len(new)))
+    merged = old.merge(new, on=KEY_COLUMNS, how="outer", suffixes=("_old", "_new"))
+    found = merged["old_row"].notna() & merged["new_row"].notna()
+    same = found.copy()
+    for column in old.columns.difference(KEY_COLUMNS + ["old_row"]):
+        a, b = merged[f"{column}_old"], merged[f"{column}_new"]
+        same &= (a == b).fillna(False) | (a.isna() & b.isna())
+    changed = merged[found & ~same]
+    return {
+        "removed": np.sort(merged.loc[merged["new_row"].isna(), "old_row"]),
+        "added": np.sort(merged.loc[merged["old_row"].isna(), "new_row"]),
+        "changed_old": np.sort(changed["old_row"]),
+        "changed_new": np.sort(changed["new_row"]),
+        "unchanged": int(same.sum()),
+    }
+
+
+def test_incremental_release_matches_pandas(synthetic_dir, tmp_path):
+    old_path = os.path.join(synthetic_dir, "sair_v0.parquet")
+    # The next release drops some rows and moves others to a new family
+    new = pq.read_table(os.path.join(synthetic_dir, "sair_v1.parquet")).to_pandas()
+    new.loc[new.index % 17 == 0, "family"] = "moved"
+    new = new[new.index % 13 != 0].reset_index(drop=True)
+    new_path = str(tmp_path / "sair_v2.parquet")
+    pq.write_table(
+        pa.Table.from_pandas(new, preserve_index=False),
+        new_path,
+        row_group_size=ROW_GROUP_ROWS,
+    )
+
+    diff = diff_releases(old_path, new_path)
+    expected = expected_diff(pq.read_table(old_path).to_pandas(), new)
+    for name in ["removed", "added", "changed_old", "changed_new"]:
+        np.testing.assert_array_equal(getattr(diff, name), expected[name])
+        assert len(expected[name])
+    assert diff.unchanged == expected["unchanged"]
+
+    aggregates = load_aggregates(new_path, base=old_path)
+    full = build_aggregates(new_path)
+    expected = (
+        new.fillna({"assay": ""})
+        .groupby(GROUP_COLUMNS)
+        .agg(rows=("entry_id", "size"), failed=("all_passed", lambda v: (~v).sum()))
+    )
+    for frame in [aggregates, full]:
+        frame = frame.reset_index().fillna({"assay": ""}).set_index(GROUP_COLUMNS)
+        pd.testing.assert_frame_equal(
+            frame[["rows", "failed"]].sort_index().astype(np.int64),
+            expected.astype(np.int64),
+        )
+
+    metrics = release_metrics(aggregates, by=["source"]).set_index(
+        ["Group", "Column", "Measure"]
+    )["Value"]
+    for source, rows in new.groupby("source"):
+        pair = rows[["iptm", "potency"]].dropna()
+        np.testing.assert_allclose(
+            metrics[source, "iptm", "mean"], pair["iptm"].mean(), rtol=1e-9
+        )
+        np.testing.assert_allclose(
+            metrics[source, "iptm", "pearson"],
+            pair["iptm"].corr(pair["potency"]),
+            rtol=1e-9,
+        )
@@ -0,0 +1,73 @@
+import numpy as np
+from metrics import METRICS
+from resampling import (
+    _init_worker,
+    _permutation_batch,
+    bootstrap_metrics,
+    poisson_weights,
+    replicate_metrics,
+    weighted_metrics,
+)
+
+
+def tied_values(n, seed=0):
+    # Rounded, so there are ties in both the scores and the potency
+    rng = np.random.default_rng(seed)
+    y = np.round(rng.normal(7, 1, n) * 2) / 2
+    a = np.round(y + rng.normal(0, 1, n), 1)
+    b = y + rng.normal(0, 2, n)
+    return a, b, y
+
+
+def test_weighted_metrics_match_repeated_rows():
+    x, _, y = tied_values(300)
+    seeds = np.random.SeedSequence(0).spawn(5)
+    weights = poisson_weights(seeds, len(y))
+    results = weighted_metrics(weights, x, y)
+    for row, replicate in zip(weights.astype(int), results):
+        repeated = replicate_metrics(np.repeat(x, row)[None], np.repeat(y, row)[None])
+        np.testing.assert_allclose(replicate, repeated[0], rtol=0, atol=1e-12)
+
+
+def test_poisson_weights_follow_the_distribution():
+    weights = poisson_weights(np.random.SeedSequence(0).spawn(4), 50_000)
+    counts = np.bincount(weights.astype(int).ravel(), minlength=5)[:5]
+    expected = np.exp(-1) / np.array([1, 1, 2, 6, 24]) * weights.size
+    assert (np.abs(counts - expected) < 5 * np.sqrt(expected)).all()
+
+
+def test_permutations_match_swapped_scores():
+    a, b, y = tied_values(300)
+    _init_worker(
+        {
+            "scores": np.array([a, b]),
+            "potency": y,
+            "masks": np.ones((1, len(y)), dtype=bool),
+            "threshold": 7,
+            "which": METRICS,
+        }
+    )
+    seeds = np.random.SeedSequence(0).spawn(5)
+    null = _permutation_batch(0, 0, 1, seeds)
+
+    # The scores each replicate gives the two methods, on one scale
+    a, b = (a - a.mean()) / a.std(), (b - b.mean()) / b.std()
+    swap = np.stack([np.random.default_rng(s).random(len(y)) < 0.5 for s in seeds])
+    ys = np.broadcast_to(y, swap.shape)
+    expected = replicate_metrics(np.where(swap, b, a), ys) - replicate_metrics(
+        np.where(swap, a, b), ys
+    )
+    np.testing.assert_allclose(null, expected, rtol=0, atol=1e-12)
+
+
+def test_bootstrap_does_not_depend_on_batches():
+    a, b, y = tied_values(500)
+    masks = np.array([np.ones(len(y), dtype=bool), y > 6.5])
+    args = np.array([a, b]), y, masks
+    lower, upper = bootstrap_metrics(*args, n_boot=20)
+    # A budget of a few replicates per batch
+    small = bootstrap_metrics(*args, n_boot=20, memory_budget=3 * 500 * 96)
+    np.testing.assert_allclose(small[0], lower, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(small[1], upper, rtol=0, atol=1e-12)
+    observed = weighted_metrics(np.ones((1, len(y))), a, y)[0]
+    assert (lower[0, 0] <= observed).all() and (observed <= upper[0, 0]).all()
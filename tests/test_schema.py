@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from data import read_sair
+from schema import compact_table, rewrite, to_pandas
+
+
+def assert_same_values(compact, default):
+    assert list(compact.columns) == list(default.columns)
+    for name in default.columns:
+        missing = pd.isna(default[name]).values
+        np.testing.assert_array_equal(pd.isna(compact[name]).values, missing)
+        np.testing.assert_array_equal(
+            compact[name].values[~missing].astype(object),
+            default[name].values[~missing].astype(object),
+        )
+
+
+def test_compact_schema_keeps_the_values(parquet_file):
+    default = pq.read_table(parquet_file).to_pandas()
+    compact = read_sair(parquet_file)
+    assert_same_values(compact, default)
+
+    dtypes = compact.dtypes
+    for name in ["entry_id", "source", "assay"]:
+        assert isinstance(dtypes[name], pd.CategoricalDtype)
+        categories = list(dtypes[name].categories)
+        assert categories == sorted(categories)
+    assert dtypes["index"] == np.int8
+    assert dtypes["potency"] == np.float32
+    assert dtypes["vina_score"] == np.float64
+    assert dtypes["iptm"] == np.float64
+    assert dtypes["confidence_score"] == np.float32
+    assert isinstance(dtypes["all_passed"], pd.BooleanDtype)
+    assert dtypes["mol_pred_loaded"] == bool
+    assert compact.memory_usage(deep=True).sum() < default.memory_usage(deep=True).sum()
+
+
+def test_compact_schema_keeps_sorting_and_filters(parquet_file):
+    default = pq.read_table(parquet_file).to_pandas()
+    compact = read_sair(parquet_file)
+    for name in ["entry_id", "source"]:
+        np.testing.assert_array_equal(
+            compact.sort_values(name, kind="stable").index,
+            default.sort_values(name, kind="stable").index,
+        )
+
+    filters = [("assay", "==", "cell"), ("vina_score", "<", -8.0)]
+    filtered = read_sair(parquet_file, filters=filters)
+    expected = default[(default["assay"] == "cell") & (default["vina_score"] < -8.0)]
+    assert_same_values(filtered, expected.reset_index(drop=True))
+
+
+def test_rewritten_file_loads_the_same(parquet_file, tmp_path):
+    target = str(tmp_path / "compact.parquet")
+    rewrite(parquet_file, target)
+    pd.testing.assert_frame_equal(read_sair(target), read_sair(parquet_file))
+
+
+def test_compact_schema_reads_columns_without_values():
+    # e.g. the assay of a row group holding only BindingDB rows
+    table = pa.table({"assay": pa.array([None, None], pa.string())})
+    compact = to_pandas(compact_table(table))
+    assert isinstance(compact.dtypes["assay"], pd.CategoricalDtype)
+    assert compact["assay"].isna().all()
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+from metrics import ACTIVE_THRESHOLD
+from scipy.stats import kendalltau, pearsonr, spearmanr
+from segments import MIN_GROUP_SIZE, group_codes, segment_metrics
+from sklearn.metrics import roc_auc_score
+
+
+def reference(group):
+    # groupby-apply with scipy/sklearn, one method
+    group = group.dropna()
+    x, y = group["score"].values, group["potency"].values
+    if len(x) < MIN_GROUP_SIZE:
+        return pd.Series([np.nan] * 4 + [len(x)])
+    labels = y > ACTIVE_THRESHOLD
+    auc = roc_auc_score(labels, x) if 0 < labels.sum() < len(x) else np.nan
+    return pd.Series(
+        [
+            spearmanr(x, y).correlation,
+            pearsonr(x, y)[0],
+            kendalltau(x, y).correlation,
+            auc,
+            len(x),
+        ]
+    )
+
+
+def synthetic_groups():
+    rng = np.random.default_rng(0)
+    sizes = [5, 12, 40, 200, 90]  # the first below MIN_GROUP_SIZE
+    targets = np.repeat([f"target {i}" for i in range(len(sizes))], sizes)
+    n = len(targets)
+    potency = np.round(rng.normal(7, 1, n) * 2) / 2
+    potency[targets == "target 2"] = rng.uniform(3, 6, 40)  # no actives
+    scores = potency + rng.normal(0, [[0.5], [2]], (2, n))
+    scores[0] = np.round(scores[0], 1)
+    scores[1, rng.random(n) < 0.1] = np.nan
+    order = rng.permutation(n)  # groups need not be contiguous
+    return scores[:, order], potency[order], targets[order]
+
+
+def test_segment_metrics_match_groupby_apply():
+    scores, potency, targets = synthetic_groups()
+    groups, keys = group_codes(targets)
+    results, sizes = segment_metrics(scores, potency, groups)
+    for m, method_scores in enumerate(scores):
+        frame = pd.DataFrame({"score": method_scores, "potency": potency})
+        expected = frame.groupby(groups).apply(reference)
+        np.testing.assert_allclose(
+            results[:, m], expected.values[:, :4], rtol=0, atol=1e-12
+        )
+        np.testing.assert_array_equal(sizes[:, m], expected.values[:, 4])
+    assert len(keys) == len(results)
+
+
+def test_segment_metrics_on_a_pool_match_one_process():
+    scores, potency, targets = synthetic_groups()
+    groups, _ = group_codes(targets)
+    serial, serial_sizes = segment_metrics(scores, potency, groups)
+    pooled, pooled_sizes = segment_metrics(scores, potency, groups, n_jobs=2)
+    np.testing.assert_array_equal(pooled, serial)
+    np.testing.assert_array_equal(pooled_sizes, serial_sizes)
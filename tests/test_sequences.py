@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from sequences import AMINO_ACIDS, HASH_BASE, build_stats, mix64, sequence_hashes
+
+
+def python_hash(sequence):
+    # The polynomial hash of the bytes, mixed with the length, mod 2**64
+    value = 0
+    for byte in sequence.encode():
+        value = (value * int(HASH_BASE) + byte) % 2**64
+    value ^= len(sequence) * 0x9E3779B97F4A7C15 % 2**64
+    return int(mix64(np.array([value], dtype=np.uint64))[0])
+
+
+def test_sequence_hashes_match_python():
+    sequences = ["MKV", "", "A" * 300, None, "WYWYW"]
+    # A slice, so the array starts at an offset into its buffers
+    array = pa.array(["X"] + sequences)[1:]
+    expected = [0 if s is None else python_hash(s) for s in sequences]
+    assert sequence_hashes(array).tolist() == expected
+
+
+@pytest.mark.parametrize("suffix", [".parquet", ".csv"])
+def test_stats_match_pandas(tmp_path, suffix):
+    rng = np.random.default_rng(0)
+    letters = np.array(list(AMINO_ACIDS))
+    distinct = ["".join(rng.choice(letters, n)) for n in rng.integers(1, 60, 40)]
+    values = rng.choice(distinct + [""], 2000).astype(object)
+    values[rng.random(2000) < 0.05] = None
+    df = pd.DataFrame({"input_receptor": values})
+    path = str(tmp_path / f"sequences{suffix}")
+    if suffix == ".parquet":
+        pq.write_table(pa.Table.from_pandas(df), path)
+    else:
+        df.to_csv(path, index=False)
+    # Batches, so sequences repeat across them
+    stats = build_stats(path, batch_rows=300)
+    if suffix == ".csv":
+        # Missing sequences are written as empty fields, read back as empty
+        df["input_receptor"] = df["input_receptor"].fillna("")
+
+    codes, uniques = pd.factorize(df["input_receptor"])
+    np.testing.assert_array_equal(stats.codes, codes)
+    assert stats.sequences["sequence"].to_pylist() == list(uniques)
+    lengths = df["input_receptor"].str.len().fillna(-1).astype(int)
+    np.testing.assert_array_equal(stats.lengths(), lengths)
+    duplicated = df["input_receptor"].notna() & df.duplicated("input_receptor")
+    np.testing.assert_array_equal(stats.duplicate_mask(), duplicated)
+    np.testing.assert_array_equal(
+        stats.sequences["rows"].to_numpy(), np.bincount(codes[codes >= 0])
+    )
+    for aa in AMINO_ACIDS:
+        assert stats.sequences[aa].to_pylist() == [s.count(aa) for s in uniques]
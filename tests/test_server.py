@@ -0,0 +1,57 @@
+import threading
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import plot_folder
+import pytest
+import server
+from client import table
+from data import read_sair
+from scipy.stats import spearmanr
+
+
+@pytest.fixture
+def address(synthetic_file, tmp_path, monkeypatch):
+    # A server on the synthetic file and a free port, in this process
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(server, "PATH_TO_DF", synthetic_file)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), server.Handler)
+    httpd.analysis = server.AnalysisServer(workers=2)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def as_frame(response):
+    return pd.DataFrame(response["data"], columns=response["columns"])
+
+
+def test_tables_match_pandas(synthetic_file, address):
+    df = read_sair(synthetic_file).astype({"source": str, "family": str})
+    poses = df.iloc[np.argsort(df["source"] != "ChEMBL", kind="stable")]
+    poses = poses.drop_duplicates(["entry_id", "index"])
+    poses = poses[(poses["assay"] == "cell") & (poses["confidence_score"] > 0.5)]
+
+    confidence = as_frame(
+        table("confidence", ["confidence_score>0.5"], address, assay="cell")
+    )
+    assert (confidence["Rows"] == len(poses)).all()
+    for metric, spearman in zip(confidence["Metric"], confidence["Spearman"]):
+        pair = poses[[metric, "potency"]].dropna()
+        expected = spearmanr(pair[metric], pair["potency"])[0]
+        np.testing.assert_allclose(spearman, expected, rtol=0, atol=1e-10)
+    assert confidence["Metric"].tolist() == plot_folder.metrics
+
+    families = as_frame(table("families", address=address, source="ChEMBL"))
+    counts = df.loc[df["source"] == "ChEMBL", "family"].value_counts()
+    assert dict(zip(families["Family"], families["Rows"])) == counts.to_dict()
+
+
+def test_bad_slices_are_rejected(address):
+    with pytest.raises(RuntimeError, match="400"):
+        table("families", address=address, entry_id="E0")
+    with pytest.raises(RuntimeError, match="400"):
+        table("unknown", address=address)
@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from data import read_sair
+from metrics import batched_metrics
+from sketches import (
+    KEY_COLUMN,
+    QuantileSketch,
+    Reservoir,
+    sample_metrics,
+    sample_strata,
+    sample_view,
+)
+from views import view_rows
+
+
+def skewed_values(n, seed=0):
+    # Rounded, so there are ties, with NaNs the sketch skips
+    rng = np.random.default_rng(seed)
+    values = np.round(rng.lognormal(1, 0.5, n), 2)
+    values[rng.random(n) < 0.01] = np.nan
+    return values
+
+
+def test_quantile_sketch_error_within_bound(tmp_path):
+    values = skewed_values(200_000)
+    parts = [QuantileSketch(seed=0), QuantileSketch(seed=1)]
+    for i, batch in enumerate(np.array_split(values, 40)):
+        parts[i % 2].update(batch)
+    paths = [str(tmp_path / f"part{i}.npz") for i in range(2)]
+    for part, path in zip(parts, paths):
+        part.save(path)
+    sketch = QuantileSketch.load(paths[0]).merge(QuantileSketch.load(paths[1]))
+
+    exact = np.sort(values[~np.isnan(values)])
+    assert sketch.n == len(exact)
+    assert len(sketch.items()[0]) < 4 * sketch.k  # O(k), not O(n)
+
+    q = np.linspace(0.01, 0.99, 99)
+    estimates = sketch.quantiles(q)
+    # Distance of each estimate's rank range from the target rank
+    low = np.searchsorted(exact, estimates, side="left")
+    high = np.searchsorted(exact, estimates, side="right")
+    target = q * len(exact)
+    error = np.maximum(np.maximum(low - target, target - high), 0)
+    assert error.max() <= sketch.rank_error()
+
+    edges = np.linspace(exact[0], exact[-1], 30)
+    counts, bound = sketch.histogram(edges)
+    assert np.abs(counts - np.histogram(exact, edges)[0]).max() <= bound
+
+
+def test_reservoirs_merge_to_the_sample_of_the_union():
+    rng = np.random.default_rng(0)
+    frame = pd.DataFrame({"value": np.arange(10_000)})
+    keys = rng.integers(0, 2**64, len(frame), dtype=np.uint64)
+
+    whole = Reservoir(500)
+    whole.update(frame, keys)
+    halves = [Reservoir(500), Reservoir(500)]
+    for reservoir, rows in zip(halves, np.array_split(np.arange(len(frame)), 2)):
+        for batch in np.array_split(rows, 7):
+            reservoir.update(frame.iloc[batch], keys[batch])
+    merged = halves[0].merge(halves[1])
+
+    assert len(whole.sample()) == 500
+    assert merged.seen == whole.seen == len(frame)
+    np.testing.assert_array_equal(
+        np.sort(merged.frame[KEY_COLUMN].values), np.sort(whole.frame[KEY_COLUMN])
+    )
+    assert abs(whole.fraction - 500 / len(frame)) < 0.01
+
+
+def test_sample_strata_keeps_keys_together(tmp_path):
+    rng = np.random.default_rng(0)
+    n = 20_000
+    df = pd.DataFrame(
+        {
+            "entry_id": rng.integers(0, 2_000, n),
+            "assay": rng.choice(["biochem", "cell"], n),
+            "value": rng.normal(size=n),
+        }
+    )
+    path = str(tmp_path / "sair.parquet")
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path, 3_000)
+
+    everything, cell = sample_strata(
+        path,
+        ["value"],
+        [[], [("assay", "==", "cell")]],
+        key_columns=["entry_id"],
+        size=100,
+        batch_rows=1_000,
+    )
+    sample = everything.sample()
+    assert sample["entry_id"].nunique() == 100
+    # Every row of a sampled key, in file order
+    expected = df[df["entry_id"].isin(sample["entry_id"])]
+    np.testing.assert_array_equal(sample["row"].sort_values(), expected.index)
+    assert (cell.sample()["assay"] == "cell").all()
+    assert cell.seen == (df["assay"] == "cell").sum()
+
+
+def test_sample_metrics_intervals_close_on_every_row():
+    rng = np.random.default_rng(0)
+    n = 2_000
+    potency = rng.normal(7, 1, n)
+    scores = potency + rng.normal(0, [[1], [2]], (2, n))
+    masks = np.array([np.ones(n, dtype=bool), rng.random(n) < 0.5])
+
+    exact = batched_metrics(scores, potency, masks)
+    results, lower, upper = sample_metrics(scores, potency, masks, fraction=1.0)
+    np.testing.assert_array_equal(results, exact)
+    np.testing.assert_allclose(lower, exact, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(upper, exact, rtol=0, atol=1e-12)
+
+    results, lower, upper = sample_metrics(scores, potency, masks, fraction=0.1)
+    assert (lower <= results).all() and (results <= upper).all()
+    assert (upper - lower > 0).all()
+
+
+def test_sample_metrics_intervals_cover_the_value_on_every_row():
+    # Rows of a key share their potency and most of their score, as the
+    # poses of one entry do, and keyed samples hold every row of a key
+    rng = np.random.default_rng(0)
+    n_keys, per_key = 2_000, 5
+    keys = np.repeat(np.arange(n_keys), per_key)
+    potency = np.round(rng.normal(7, 1, n_keys) * 4)[keys] / 4
+    scores = (potency + rng.normal(0, 1.5, n_keys)[keys])[None]
+    scores = scores + rng.normal(0, 0.3, scores.shape)
+    exact = batched_metrics(scores, potency, np.ones(len(keys), dtype=bool))[0, 0]
+
+    covered = []
+    for _ in range(100):
+        # Rows sampled by key, then rows sampled on their own
+        sampled = rng.random(n_keys) < 0.1
+        rows = np.flatnonzero(sampled[keys])
+        mask = np.ones(len(rows), dtype=bool)
+        _, lower, upper = sample_metrics(
+            scores[:, rows], potency[rows], mask, sampled.mean(), keys=keys[rows]
+        )
+        covered.append((lower[0, 0] <= exact) & (exact <= upper[0, 0]))
+        rows = np.flatnonzero(rng.random(len(keys)) < 0.1)
+        mask = np.ones(len(rows), dtype=bool)
+        _, lower, upper = sample_metrics(
+            scores[:, rows], potency[rows], mask, len(rows) / len(keys)
+        )
+        covered.append((lower[0, 0] <= exact) & (exact <= upper[0, 0]))
+    # 95% intervals, per metric and sampling scheme
+    assert (np.mean(covered[::2], axis=0) >= 0.85).all()
+    assert (np.mean(covered[1::2], axis=0) >= 0.85).all()
+
+
+@pytest.mark.parametrize("name", ["deduplicated", "unique_entries"])
+def test_sample_view_matches_the_view_on_the_sampled_keys(parquet_file, name):
+    exact = read_sair(parquet_file).iloc[view_rows(name, parquet_file)]
+    # Drawn by entry, so the poses of a sampled entry are all there
+    sample, fraction = sample_view(
+        parquet_file, name, ["potency"], key_columns=["entry_id"], size=300
+    )
+    assert 0 < fraction < 1
+    sampled = exact[exact["entry_id"].isin(sample["entry_id"])]
+    assert sampled["entry_id"].nunique() == 300
+    np.testing.assert_array_equal(sample["row"], sampled.index)
+    np.testing.assert_array_equal(sample["potency"], sampled["potency"])
@@ -0,0 +1,50 @@
+import numpy as np
+from metrics import ACTIVE_THRESHOLD
+from scipy.stats import pearsonr, spearmanr
+from sklearn.metrics import roc_auc_score
+from sweeps import SWEEP_METRICS, sweep_metrics, sweep_rates
+
+
+def test_sweep_matches_scipy_per_threshold():
+    rng = np.random.default_rng(0)
+    n = 800
+    potency = np.round(rng.normal(7, 1, n) * 2) / 2  # ties
+    scores = np.array([np.round(potency + rng.normal(0, s, n), 1) for s in [1, 3]])
+    scores[0, rng.random(n) < 0.1] = np.nan
+    confidence = np.round(rng.uniform(0, 1, n), 2)  # ties at the thresholds
+    confidence[rng.random(n) < 0.05] = np.nan
+    thresholds = np.array([0.0, 0.25, 0.5, 0.5, 0.9, 0.995, 1.0])
+
+    results = sweep_metrics(confidence, scores, potency, thresholds)
+    assert results.shape == (len(thresholds), len(scores), len(SWEEP_METRICS))
+    for t, threshold in enumerate(thresholds):
+        for m, method_scores in enumerate(scores):
+            keep = (confidence > threshold) & ~np.isnan(method_scores)
+            x, y = method_scores[keep], potency[keep]
+            labels = y > ACTIVE_THRESHOLD
+            if len(x) < 2 or labels.all() or not labels.any():
+                assert np.isnan(results[t, m]).all()
+                continue
+            expected = [
+                spearmanr(x, y)[0],
+                pearsonr(x, y)[0],
+                roc_auc_score(labels, x),
+            ]
+            np.testing.assert_allclose(results[t, m], expected, rtol=0, atol=1e-10)
+    assert np.isnan(results[-1]).all()
+
+
+def test_sweep_rates_match_the_masks():
+    rng = np.random.default_rng(1)
+    confidence = np.round(rng.uniform(0, 1, 500), 1)
+    flags = (rng.random(500) < 0.7).astype(np.float64)
+    flags[rng.random(500) < 0.1] = np.nan
+    thresholds = np.linspace(0, 1, 11)
+    kept, rates = sweep_rates(confidence, flags, thresholds)
+    for threshold, rows, rate in zip(thresholds, kept, rates):
+        above = flags[confidence > threshold]
+        assert rows == len(above)
+        if np.isnan(above).all():
+            assert np.isnan(rate)
+        else:
+            np.testing.assert_allclose(rate, np.nanmean(above))
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from data import read_sair
+from views import SOURCE_PRIORITY, VIEWS, build_rows, read_rows
+
+EXPECTED = {
+    # Sources without a priority rank after the others
+    "deduplicated": lambda df: df.iloc[
+        np.argsort(
+            df["source"].map(SOURCE_PRIORITY).astype(float).fillna(2).values,
+            kind="stable",
+        )
+    ].drop_duplicates(["entry_id", "index"]),
+    "unique_entries": lambda df: df.drop_duplicates("entry_id"),
+    "chembl": lambda df: df[df["source"] == "ChEMBL"],
+    "chembl_high_confidence": lambda df: df[
+        (df["source"] == "ChEMBL") & (df["confidence_score"] > 0.8)
+    ],
+}
+
+
+@pytest.mark.parametrize("name", list(VIEWS))
+def test_view_rows_match_pandas(parquet_file, name):
+    df = read_sair(parquet_file).astype({"source": object})
+    expected = np.sort(EXPECTED[name](df).index.values)
+    # A budget small enough to spread the keys over several partitions
+    rows = build_rows(VIEWS[name], parquet_file, memory_budget=2**14, batch_rows=333)
+    np.testing.assert_array_equal(rows, expected)
+    np.testing.assert_array_equal(
+        read_rows(parquet_file, rows, ["vina_score"])["vina_score"],
+        df["vina_score"].values[rows],
+    )
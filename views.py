@@ -0,0 +1,248 @@
+"""
+Materialized derived views of the SAIR parquet files.
+
+Several figures work on the same derived tables: the entries deduplicated
+with ChEMBL rows first, the first row of every entry, the ChEMBL rows, and
+the high-confidence ChEMBL rows. A view stores the sorted row numbers of the
+source file it keeps, so it is built once, with bounded memory and without
+sorting the whole dataset, and serves any set of columns afterwards.
+
+Views are stored next to the source file, in <file>.views/ (or under
+.cache/views when that directory is not writable), in a file named after a
+fingerprint of the source and of the view definition. Rewriting the source
+or changing a definition therefore rebuilds the view on its next use, and
+the stale file is removed.
+
+    python views.py                   # build every view, time view vs full load
+    python views.py --rebuild chembl  # rebuild one view
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass, field
+
+import numpy as np
+import pyarrow.parquet as pq
+from cache import file_fingerprint
+from data import filter_mask
+from external import BATCH_ROWS, MEMORY_BUDGET, first_rows, scan
+from instrument import stage
+from schema import compact_table, dictionary_columns, to_pandas
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+FALLBACK_DIR = os.path.join(REPO_DIR, ".cache", "views")
+
+# Source ranks for the deduplicated view, lowest kept: ChEMBL rows are the
+# ones with assay info
+SOURCE_PRIORITY = {"ChEMBL": 0, "BindingDB": 1}
+
+
+@dataclass
+class View:
+    name: str
+    description: str
+    filters: list = field(default_factory=list)  # rows kept, pyarrow format
+    # Optional (key_columns, column, priority) keeping one row per key: the
+    # one whose column comes first in the priority dict, then the earliest
+    drop_duplicates: tuple = None
+
+
+VIEWS = {
+    view.name: view
+    for view in [
+        View(
+            "deduplicated",
+            "one row per (entry_id, index), ChEMBL first",
+            drop_duplicates=(["entry_id", "index"], "source", SOURCE_PRIORITY),
+        ),
+        View(
+            "unique_entries",
+            "first row of every entry_id",
+            drop_duplicates=(["entry_id"], None, {}),
+        ),
+        View("chembl", "ChEMBL rows", filters=[("source", "==", "ChEMBL")]),
+        View(
+            "chembl_high_confidence",
+            "ChEMBL rows with confidence_score > 0.8",
+            filters=[("source", "==", "ChEMBL"), ("confidence_score", ">", 0.8)],
+        ),
+    ]
+}
+
+
+def view_directory(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    if os.access(directory, os.W_OK):
+        return os.path.join(directory, os.path.basename(path) + ".views")
+    return os.path.join(FALLBACK_DIR, os.path.basename(path) + ".views")
+
+
+def view_path(name, path):
+    view = VIEWS[name]
+    key = repr([file_fingerprint(path), view.filters, view.drop_duplicates])
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(view_directory(path), f"{name}-{digest}.npy")
+
+
+def build_rows(view, path, memory_budget=MEMORY_BUDGET, batch_rows=BATCH_ROWS):
+    """
+    Sorted row numbers of the source file kept by the view.
+    """
+    if view.drop_duplicates is not None:
+        if view.filters:
+            # first_rows() numbers the rows that pass its filters
+            raise ValueError(f"View {view.name!r} cannot filter and deduplicate")
+        key_columns, column, priority = view.drop_duplicates
+        directory = tempfile.mkdtemp(prefix="sair_")
+        try:
+            chunks = first_rows(
+                path,
+                key_columns,
+                column,
+                priority,
+                None,
+                batch_rows,
+                directory,
+                memory_budget,
+            )
+            return np.concatenate(
+                [chunk["row"] for chunk in chunks] + [np.empty(0, np.int64)]
+            )
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    columns = list(dict.fromkeys(column for column, _, _ in view.filters))
+    rows = []
+    start = 0
+    for batch in scan(path, columns, batch_rows=batch_rows):
+        rows.append(start + np.flatnonzero(filter_mask(batch, view.filters)))
+        start += len(batch)
+    return np.concatenate(rows + [np.empty(0, np.int64)])
+
+
+def view_rows(name, path, rebuild=False):
+    """
+    Row numbers of the view on the source file, built if missing or stale.
+    """
+    target = view_path(name, path)
+    if os.path.exists(target) and not rebuild:
+        return np.load(target)
+
+    view = VIEWS[name]
+    with stage("dedup" if view.drop_duplicates else "filter") as s:
+        rows = build_rows(view, path)
+        s.rows = len(rows)
+    directory = os.path.dirname(target)
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, rows)
+    os.replace(temporary, target)
+    for entry in os.listdir(directory):
+        stale = os.path.join(directory, entry)
+        if entry.startswith(f"{name}-") and entry.endswith(".npy") and stale != target:
+            os.remove(stale)
+    return rows
+
+
+def read_rows(path, rows, columns=None):
+    """
+    The rows of the source file as a DataFrame indexed by row number,
+    reading only the row groups that hold them.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    parquet = pq.ParquetFile(path, read_dictionary=dictionary_columns(columns))
+    sizes = [
+        parquet.metadata.row_group(i).num_rows
+        for i in range(parquet.metadata.num_row_groups)
+    ]
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    row_groups = np.searchsorted(offsets, rows, side="right") - 1
+    groups = np.unique(row_groups)
+    # Where each selected row group starts in the table read back
+    starts = np.concatenate([[0], np.cumsum(np.diff(offsets)[groups])[:-1]])
+    local = rows - offsets[row_groups] + starts[np.searchsorted(groups, row_groups)]
+
+    with stage("load", rows=len(rows)):
+        table = parquet.read_row_groups(groups.tolist(), columns=columns)
+        df = to_pandas(compact_table(table.take(local)))
+    df.index = rows
+    return df
+
+
+def derive(name, df):
+    """
+    The rows of an in-memory frame, in file order, that the view keeps,
+    given every row of each key it deduplicates (e.g. a sample drawn by
+    key, see sketches.sample_view).
+    """
+    view = VIEWS[name]
+    df = df[filter_mask(df, view.filters)]
+    if view.drop_duplicates is not None:
+        key_columns, column, priority = view.drop_duplicates
+        if column is not None:
+            order = df[column].map(priority).astype(np.float64)
+            order = order.fillna(len(priority))
+            df = df.iloc[np.argsort(order.values, kind="stable")]
+        df = df.drop_duplicates(key_columns, keep="first").sort_index()
+    return df
+
+
+def read_view(name, path, columns=None, filters=None):
+    """
+    The view as a DataFrame indexed by source row number, reading only the
+    row groups that hold its rows.
+    """
+    df = read_rows(path, view_rows(name, path), columns)
+    if filters:
+        df = df[filter_mask(df, filters)]
+    return df
+
+
+if __name__ == "__main__":
+    import time
+
+    import pandas as pd
+    from common import PATH_TO_DF
+    from data import read_sair
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("views", nargs="*", help="view names (default: all)")
+    parser.add_argument("--path", default=PATH_TO_DF, help="source parquet file")
+    parser.add_argument(
+        "--rebuild", action="store_true", help="rebuild even if up to date"
+    )
+    args = parser.parse_args()
+
+    rows = []
+    for name in args.views or list(VIEWS):
+        view = VIEWS[name]
+        start = time.perf_counter()
+        kept = view_rows(name, args.path, rebuild=args.rebuild)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        df = read_view(name, args.path)
+        view_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # What the figure scripts did before views, for the timings
+        expected = derive(name, read_sair(args.path))
+        full_time = time.perf_counter() - start
+        assert np.array_equal(np.sort(expected.index.values), kept)
+
+        rows.append(
+            {
+                "View": name,
+                "Rows": len(df),
+                "Open/build s": build_time,
+                "Open view s": view_time,
+                "Full load s": full_time,
+                "Speedup": full_time / view_time,
+            }
+        )
+    print(pd.DataFrame(rows).to_string(index=False, float_format="%.2f"))
+    print(f"Views stored in {view_directory(args.path)}")